@@ -1,29 +1,146 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, current_app, request, jsonify, make_response, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as SesionFlask
 from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
 from flask_cors import CORS
-from datetime import datetime
-import firebase_admin
-from firebase_admin import credentials, messaging
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
+from sqlalchemy import event, insert, select, update, tuple_, inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from functools import wraps
+from bisect import bisect_right
 import os
+import glob
+import gzip
+import csv
+import json
+import atexit
+import math
+import hmac
+import base64
+import hashlib
 import uuid
+import heapq
+import signal
+import time
+import threading
+import importlib
+import shutil
 
-app = Flask(__name__)
-CORS(app)
+api = Blueprint('api', __name__, cli_group=None)
 
-# Configuración base de datos y JWT
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root:@localhost/sistema_usuarios'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'd917007c5d609be36618dd76993244efa4d0bb644f4dc6b62de13d49441d462a'
+class SesionEnrutada(SesionFlask):
+    # En las rutas con @lectura_replica los SELECT van a la réplica elegida para la petición; el flush y
+    # cualquier consulta posterior a una escritura en la misma sesión siguen en la primaria
+    # Las tablas particionadas por usuario van al engine de su shard (ver PARTICIONADO POR USUARIO)
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and current_app.extensions['enrutador_shards'].shards and _tabla_particionada(mapper, clause):
+            shard = _shard_de_sesion(self)
+            if shard != SHARD_PRINCIPAL:
+                return self._db.engines[shard]
+        if bind is None and has_request_context() and not self._flushing and not self.info.get('escribio'):
+            replica = g.get('replica_lectura')
+            if replica and getattr(clause, 'is_select', False):
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-jwt = JWTManager(app)
+db = SQLAlchemy(session_options={'class_': SesionEnrutada})
+bcrypt = Bcrypt()
+jwt = JWTManager()
 
-# Inicializar Firebase Admin con la clave de cuenta de servicio
-cred = credentials.Certificate('serviceAccountKey.json')  # Ajusta la ruta si es diferente
-firebase_admin.initialize_app(cred)
+class _ModuloDiferido:
+    # Importa el módulo en el primer acceso a un atributo (numpy solo lo necesitan las rutas de analítica)
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nombre)
+        return getattr(self._modulo, atributo)
+
+np = _ModuloDiferido('numpy')
+
+def create_app(config=None):
+    app = Flask(__name__)
+    CORS(app)
+
+    # Configuración base de datos y JWT
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('MEDNOTIFY_DATABASE_URI', 'mysql+pymysql://root:@localhost/sistema_usuarios')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_recycle': 280}
+    app.config['ARCHIVO_DIR'] = os.environ.get('MEDNOTIFY_ARCHIVO_DIR', 'archivo')
+    app.config['JWT_SECRET_KEY'] = os.environ.get('MEDNOTIFY_JWT_SECRET_KEY', 'd917007c5d609be36618dd76993244efa4d0bb644f4dc6b62de13d49441d462a')
+    replicas = [uri.strip() for uri in os.environ.get('MEDNOTIFY_REPLICA_URIS', '').split(',') if uri.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {f'replica_{i}': uri for i, uri in enumerate(replicas)}
+    shards = [uri.strip() for uri in os.environ.get('MEDNOTIFY_SHARD_URIS', '').split(',') if uri.strip()]
+    app.config['SQLALCHEMY_BINDS'].update({f'shard_{i}': uri for i, uri in enumerate(shards)})
+    # Proxies inversos de confianza delante de gunicorn (MEDNOTIFY_PROXIES): remote_addr pasa a ser la IP del cliente
+    # según X-Forwarded-For. Con 0 no se confía en la cabecera, que el cliente podría falsificar
+    app.config['PROXIES_CONFIANZA'] = int(os.environ.get('MEDNOTIFY_PROXIES', 0))
+    if config:
+        app.config.update(config)
+    if app.config['PROXIES_CONFIANZA']:
+        proxies = app.config['PROXIES_CONFIANZA']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    jwt.init_app(app)
+    app.register_blueprint(api)
+
+    # Ajusta la ruta de la clave de cuenta de servicio con MEDNOTIFY_FIREBASE_KEY si es diferente.
+    # MEDNOTIFY_TRANSPORTE=consola (desarrollo, pruebas) solo registra los envíos en consola
+    ruta_credenciales = os.environ.get('MEDNOTIFY_FIREBASE_KEY', 'serviceAccountKey.json')
+    if 'transporte_notificaciones' not in app.extensions:
+        transporte = app.config.get('TRANSPORTE_NOTIFICACIONES', os.environ.get('MEDNOTIFY_TRANSPORTE', 'fcm'))
+        if transporte == 'consola':
+            app.extensions['transporte_notificaciones'] = TransporteConsola()
+        elif transporte == 'fcm':
+            if not os.path.exists(ruta_credenciales):
+                print(f"Aviso: no existe {ruta_credenciales}; los envíos push fallarán hasta configurarlo")
+            app.extensions['transporte_notificaciones'] = TransporteFCM(ruta_credenciales)
+        else:
+            raise ValueError(f'Transporte de notificaciones desconocido: {transporte}')
+    if 'limitador_tasa' not in app.extensions:
+        url_redis = os.environ.get('MEDNOTIFY_LIMITE_TASA_REDIS_URL')
+        app.extensions['limitador_tasa'] = AlmacenCubetasRedis(url_redis) if url_redis else AlmacenCubetasMemoria()
+    if 'enrutador_replicas' not in app.extensions:
+        app.extensions['enrutador_replicas'] = EnrutadorReplicas(app, sorted(
+            nombre for nombre in app.config['SQLALCHEMY_BINDS'] if nombre.startswith('replica_')
+        ))
+    if 'enrutador_shards' not in app.extensions:
+        app.extensions['enrutador_shards'] = EnrutadorShards(sorted(
+            nombre for nombre in app.config['SQLALCHEMY_BINDS'] if nombre.startswith('shard_')
+        ))
+    if 'buffer_streaming' not in app.extensions:
+        # MEDNOTIFY_STREAM_WAL activa un WAL local para no perder muestras aún no volcadas si el proceso cae
+        buffer = BufferEscritura(
+            app,
+            app.config.get('TAMANO_LOTE_STREAMING', TAMANO_LOTE_STREAMING),
+            app.config.get('INTERVALO_STREAMING', INTERVALO_STREAMING),
+            app.config.get('WAL_STREAMING', os.environ.get('MEDNOTIFY_STREAM_WAL')),
+        )
+        app.extensions['buffer_streaming'] = buffer
+        atexit.register(buffer.cerrar)
+    return app
+
+def reiniciar_tras_fork(app):
+    # Con preload_app el maestro puede haber abierto el pool de conexiones o el cliente de Firebase antes del fork:
+    # cada worker descarta los heredados (sin cerrar los del maestro) y abre los suyos
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    app.extensions['transporte_notificaciones'].reiniciar()
 
 # MODELOS
 class Usuario(db.Model):
@@ -57,6 +174,7 @@ class FcmToken(db.Model):
 
 class Glucosa(db.Model):
     __tablename__ = 'glucosas'
+    __table_args__ = (db.Index('ix_glucosas_usuario_fecha_hora', 'usuario_id', 'fecha', 'hora'),)
     id = db.Column(db.Integer, primary_key=True)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
@@ -66,6 +184,7 @@ class Glucosa(db.Model):
 
 class PresionArterial(db.Model):
     __tablename__ = 'presiones_arteriales'
+    __table_args__ = (db.Index('ix_presiones_arteriales_usuario_fecha_hora', 'usuario_id', 'fecha', 'hora'),)
     id = db.Column(db.Integer, primary_key=True)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
@@ -76,6 +195,7 @@ class PresionArterial(db.Model):
 
 class Oxigenacion(db.Model):
     __tablename__ = 'oxigenaciones'
+    __table_args__ = (db.Index('ix_oxigenaciones_usuario_fecha_hora', 'usuario_id', 'fecha', 'hora'),)
     id = db.Column(db.Integer, primary_key=True)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
@@ -85,6 +205,7 @@ class Oxigenacion(db.Model):
 
 class FrecuenciaCardiaca(db.Model):
     __tablename__ = 'frecuencias_cardiacas'
+    __table_args__ = (db.Index('ix_frecuencias_cardiacas_usuario_fecha_hora', 'usuario_id', 'fecha', 'hora'),)
     id = db.Column(db.Integer, primary_key=True)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
@@ -102,6 +223,10 @@ class Medicamento(db.Model):
     fecha = db.Column(db.Date, nullable=False)
     sintomas = db.Column(db.Text)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_medicamentos_usuario_fecha_hora', 'usuario_id', 'fecha', 'hora_toma'),
+        db.Index('ix_medicamentos_fecha_hora', 'fecha', 'hora_toma'),
+    )
 
 class Notificacion(db.Model):
     __tablename__ = 'notificaciones'
@@ -113,6 +238,238 @@ class Notificacion(db.Model):
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     delete_request_id = db.Column(db.String(36))  # Nuevo campo para rastrear solicitudes de eliminación
 
+class ResumenDiarioUsuario(db.Model):
+    __tablename__ = 'resumen_diario_usuario'
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    tipo = db.Column(db.String(30), primary_key=True)
+    lecturas = db.Column(db.Integer, nullable=False, default=0)
+    fuera_rango = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_resumen_diario_usuario_fecha_tipo', 'fecha', 'tipo'),)
+
+class ResumenDiarioPoblacion(db.Model):
+    __tablename__ = 'resumen_diario_poblacion'
+    fecha = db.Column(db.Date, primary_key=True)
+    tipo = db.Column(db.String(30), primary_key=True)
+    usuarios = db.Column(db.Integer, nullable=False, default=0)
+    usuarios_fuera_rango = db.Column(db.Integer, nullable=False, default=0)
+    lecturas = db.Column(db.Integer, nullable=False, default=0)
+    lecturas_fuera_rango = db.Column(db.Integer, nullable=False, default=0)
+    fecha_calculo = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PuntoControlTrabajo(db.Model):
+    __tablename__ = 'puntos_control_trabajos'
+    trabajo = db.Column(db.String(150), primary_key=True)
+    ultimo_id = db.Column(db.BigInteger, nullable=False, default=0)
+    # Trabajos que avanzan por tiempo y no por ids (cambios de la analítica poblacional, latido de réplicas)
+    marca_tiempo = db.Column(db.DateTime)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ReglaAlerta(db.Model):
+    __tablename__ = 'reglas_alerta'
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=True)  # NULL = regla global
+    tipo = db.Column(db.String(30), nullable=False)
+    campo = db.Column(db.String(20), nullable=False, default='valor')
+    minimo = db.Column(db.Float)  # la alerta salta si minimo <= valor < maximo; NULL = sin límite
+    maximo = db.Column(db.Float)
+    mensaje = db.Column(db.String(255))
+    activa = db.Column(db.Boolean, nullable=False, default=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (db.Index('ix_reglas_alerta_usuario_tipo', 'usuario_id', 'tipo'),)
+
+class RecordatorioEnviado(db.Model):
+    __tablename__ = 'recordatorios_enviados'
+    clave = db.Column(db.String(100), primary_key=True)  # clave de idempotencia de la toma
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    programado_para = db.Column(db.DateTime, nullable=False)
+    propietario = db.Column(db.String(36), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='enviando')
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)  # momento del último reclamo
+    intentos = db.Column(db.Integer, nullable=False, default=0)  # envíos fallidos
+    proximo_intento = db.Column(db.DateTime)  # UTC; NULL si no hay que reintentar
+    __table_args__ = (
+        db.Index('ix_recordatorios_enviados_programado', 'programado_para'),
+        db.Index('ix_recordatorios_enviados_estado_intento', 'estado', 'proximo_intento'),
+    )
+
+class PautaMedicamento(db.Model):
+    __tablename__ = 'pautas_medicamento'
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    nombre = db.Column(db.String(100), nullable=False)
+    dosis = db.Column(db.String(50), nullable=False)
+    frecuencia = db.Column(db.String(10), nullable=False, default='diaria')  # diaria | semanal
+    intervalo = db.Column(db.Integer, nullable=False, default=1)  # cada N días o N semanas
+    dias_semana = db.Column(db.String(20))  # "0,2,4" (lunes = 0), solo para frecuencia semanal
+    horas = db.Column(db.String(255), nullable=False)  # "08:00:00,20:00:00"
+    fecha_inicio = db.Column(db.Date, nullable=False)
+    fecha_fin = db.Column(db.Date)
+    sintomas = db.Column(db.Text)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    # Siguiente toma aún no recordada (hora local); FIN_PAUTA si no quedan. El programador solo carga las pautas
+    # con proxima_toma dentro de su ventana
+    proxima_toma = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_pautas_medicamento_usuario_inicio', 'usuario_id', 'fecha_inicio'),
+        db.Index('ix_pautas_medicamento_proxima_toma', 'proxima_toma'),
+    )
+
+class TomaMedicamento(db.Model):
+    __tablename__ = 'tomas_medicamento'
+    id = db.Column(db.Integer, primary_key=True)
+    pauta_id = db.Column(db.Integer, db.ForeignKey('pautas_medicamento.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    fecha = db.Column(db.Date, nullable=False)
+    hora = db.Column(db.Time, nullable=False)
+    tomada_en = db.Column(db.DateTime, default=datetime.utcnow)
+    sintomas = db.Column(db.Text)
+    __table_args__ = (
+        db.UniqueConstraint('pauta_id', 'fecha', 'hora', name='uq_tomas_medicamento_pauta_fecha_hora'),
+        db.Index('ix_tomas_medicamento_usuario_fecha', 'usuario_id', 'fecha'),
+    )
+
+class CambioSync(db.Model):
+    __tablename__ = 'cambios_sync'
+    # seq es correlativo por usuario y se asigna al confirmar la transacción (ver _asignar_seq_sync)
+    usuario_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    tabla = db.Column(db.String(40), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    operacion = db.Column(db.String(1), nullable=False)  # i = alta, u = cambio, d = baja (tombstone)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_cambios_sync_fecha', 'fecha_creacion'),)
+
+class SecuenciaSync(db.Model):
+    __tablename__ = 'secuencias_sync'
+    usuario_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)  # último seq asignado (y confirmado)
+    compactado = db.Column(db.BigInteger, nullable=False, default=0)  # seq hasta el que se borró el historial
+
+class ClaveIdempotencia(db.Model):
+    __tablename__ = 'claves_idempotencia'
+    usuario_id = db.Column(db.Integer, primary_key=True)
+    clave = db.Column(db.String(64), primary_key=True)
+    ruta = db.Column(db.String(100), nullable=False)
+    hash_cuerpo = db.Column(db.String(64))  # sha256 del cuerpo: la misma clave con otro cuerpo es un error del cliente
+    estado_http = db.Column(db.Integer)  # NULL mientras la petición original sigue en curso
+    respuesta = db.Column(db.Text)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class DirectorioShard(db.Model):
+    __tablename__ = 'directorio_shards'
+    usuario_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.String(40), nullable=False)
+    moviendo = db.Column(db.Boolean, nullable=False, default=False)  # escrituras congeladas mientras se mueve de shard
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class AccesoCuidador(db.Model):
+    __tablename__ = 'accesos_cuidador'
+    cuidador_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), primary_key=True)
+    paciente_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), primary_key=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_accesos_cuidador_paciente', 'paciente_id'),)
+
+class PurgaCuenta(db.Model):
+    __tablename__ = 'purgas_cuenta'
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, nullable=False, index=True)  # sin FK: la fila del usuario se borra al final
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente | en_curso | completada | fallida
+    propietario = db.Column(db.String(36))
+    tabla_actual = db.Column(db.String(40))
+    filas_borradas = db.Column(db.BigInteger, nullable=False, default=0)
+    total_estimado = db.Column(db.BigInteger)
+    error = db.Column(db.String(255))
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ElementoEliminacion(db.Model):
+    # Registros de una solicitud de eliminación por lotes: comparten delete_request_id y notificación
+    __tablename__ = 'elementos_eliminacion'
+    id = db.Column(db.Integer, primary_key=True)
+    delete_request_id = db.Column(db.String(36), nullable=False, index=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    tipo = db.Column(db.String(30), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+
+# TRANSPORTE DE NOTIFICACIONES
+class TransporteNotificaciones(ABC):
+    # envios: lista de (token, titulo, mensaje, data); devuelve [(ok, error)] en el mismo orden
+    @abstractmethod
+    def enviar(self, envios):
+        pass
+
+    def reiniciar(self):
+        pass
+
+class TransporteFCM(TransporteNotificaciones):
+    # firebase_admin y las credenciales se cargan en el primer envío, no al importar la app
+    def __init__(self, ruta_credenciales):
+        self.ruta_credenciales = ruta_credenciales
+        self._messaging = None
+        self._lock = threading.Lock()
+
+    def _cliente(self):
+        if self._messaging is None:
+            with self._lock:
+                if self._messaging is None:
+                    import firebase_admin
+                    from firebase_admin import credentials, messaging
+                    try:
+                        firebase_admin.get_app()
+                    except ValueError:
+                        firebase_admin.initialize_app(credentials.Certificate(self.ruta_credenciales))
+                    self._messaging = messaging
+        return self._messaging
+
+    def enviar(self, envios):
+        try:
+            messaging = self._cliente()
+        except Exception as e:
+            # Sin credenciales o sin firebase_admin ningún envío sale: se informa como fallo, no como enviado
+            print(f"Error al iniciar el cliente FCM: {str(e)}")
+            return [(False, str(e)) for _ in envios]
+        resultados = []
+        for inicio in range(0, len(envios), 500):
+            bloque = envios[inicio:inicio + 500]
+            mensajes = [messaging.Message(
+                notification=messaging.Notification(title=titulo, body=mensaje),
+                token=token,
+                android=messaging.AndroidConfig(priority='high'),
+                data=data
+            ) for token, titulo, mensaje, data in bloque]
+            try:
+                respuesta = messaging.send_each(mensajes)
+                resultados.extend((r.success, None if r.success else str(r.exception)) for r in respuesta.responses)
+            except Exception as e:
+                resultados.extend((False, str(e)) for _ in bloque)
+        return resultados
+
+    def reiniciar(self):
+        # Tras un fork el cliente HTTP heredado no se reutiliza: se recrea en el siguiente envío
+        with self._lock:
+            if self._messaging is not None:
+                import firebase_admin
+                try:
+                    firebase_admin.delete_app(firebase_admin.get_app())
+                except ValueError:
+                    pass
+                self._messaging = None
+
+class TransporteConsola(TransporteNotificaciones):
+    # Solo con MEDNOTIFY_TRANSPORTE=consola (desarrollo, pruebas): los envíos solo se registran
+    def enviar(self, envios):
+        for token, titulo, mensaje, _ in envios:
+            print(f'[sin FCM] {titulo}: {mensaje} -> {token}')
+        return [(True, None) for _ in envios]
+
+def obtener_transporte():
+    return current_app.extensions['transporte_notificaciones']
+
+def _token_invalido(error):
+    return error is not None and ('InvalidRegistration' in error or 'NotRegistered' in error)
+
 def enviar_notificacion_fcm(usuario_id, titulo, mensaje, delete_request_id=None):
     try:
         usuario = db.session.get(Usuario, usuario_id)
@@ -120,21 +477,18 @@ def enviar_notificacion_fcm(usuario_id, titulo, mensaje, delete_request_id=None)
             print(f"No hay tokens FCM para usuario_id: {usuario_id}")
             return False
 
+        tokens = list(usuario.fcm_tokens)
+        data = {'delete_request_id': delete_request_id} if delete_request_id else None
+        resultados = obtener_transporte().enviar([(t.token, titulo, mensaje, data) for t in tokens])
+
         success = False
-        for fcm_token in usuario.fcm_tokens:
-            message = messaging.Message(
-                notification=messaging.Notification(title=titulo, body=mensaje),
-                token=fcm_token.token,
-                android=messaging.AndroidConfig(priority='high'),
-                data={'delete_request_id': delete_request_id} if delete_request_id else None
-            )
-            try:
-                response = messaging.send(message)
-                print(f'Notificación enviada con éxito al token {fcm_token.token}: {response}')
+        for fcm_token, (ok, error) in zip(tokens, resultados):
+            if ok:
+                print(f'Notificación enviada con éxito al token {fcm_token.token}')
                 success = True
-            except Exception as e:
-                print(f'Error al enviar notificación al token {fcm_token.token}: {str(e)}')
-                if 'InvalidRegistration' in str(e) or 'NotRegistered' in str(e):
+            else:
+                print(f'Error al enviar notificación al token {fcm_token.token}: {error}')
+                if _token_invalido(error):
                     db.session.delete(fcm_token)
                     db.session.commit()
                     print(f'Token FCM eliminado: {fcm_token.token}')
@@ -144,8 +498,931 @@ def enviar_notificacion_fcm(usuario_id, titulo, mensaje, delete_request_id=None)
         print(f'Error general al enviar notificación FCM: {str(e)}')
         return False
 
+def enviar_lote_fcm(mensajes):
+    # mensajes: lista de (usuario_id, titulo, mensaje); un push por token en una sola llamada al transporte
+    if not mensajes:
+        return {}
+    usuario_ids = {int(m[0]) for m in mensajes}
+    tokens = {}
+    for fcm_token in FcmToken.query.filter(FcmToken.usuario_id.in_(usuario_ids)).all():
+        tokens.setdefault(fcm_token.usuario_id, []).append(fcm_token)
+
+    destinos = []
+    for indice, (usuario_id, titulo, mensaje) in enumerate(mensajes):
+        for fcm_token in tokens.get(int(usuario_id), []):
+            destinos.append((indice, fcm_token, (fcm_token.token, titulo, mensaje, None)))
+
+    exito = {indice: False for indice in range(len(mensajes))}
+    invalidos = []
+    resultados = obtener_transporte().enviar([d[2] for d in destinos])
+    for (indice, fcm_token, _), (ok, error) in zip(destinos, resultados):
+        if ok:
+            exito[indice] = True
+        elif _token_invalido(error):
+            invalidos.append(fcm_token)
+    print(f'Lote FCM enviado: {sum(1 for ok, _ in resultados if ok)} correctos, {sum(1 for ok, _ in resultados if not ok)} fallidos')
+    for fcm_token in invalidos:
+        db.session.delete(fcm_token)
+    if invalidos:
+        db.session.commit()
+        print(f'Tokens FCM eliminados: {len(invalidos)}')
+    return exito
+
+# LIMITACIÓN DE TASA (token bucket)
+# nombre: (capacidad de la cubeta, fichas recargadas por segundo, claves por las que se limita)
+# Se puede ajustar por despliegue con app.config['LIMITES_TASA'] = {nombre: (...)}
+LIMITES_TASA = {
+    # Por IP y por (correo, IP): quien prueba contraseñas desde su IP no bloquea al titular desde otra
+    'login': (5, 5 / 60, ('ip', 'correo_ip')),
+    # Tope global por correo contra ataques repartidos entre IPs; solo lo gastan los intentos fallidos (ver login)
+    'login_fallido': (50, 50 / 3600, ('correo',)),
+    'registro': (5, 5 / 600, ('ip',)),
+    'confirmar_eliminacion': (5, 5 / 60, ('usuario', 'ip')),
+    'dispositivo': (30, 0.5, ('usuario', 'dispositivo', 'ip')),
+    'escritura': (60, 1.0, ('usuario', 'ip')),
+    'streaming': (120, 2.0, ('usuario', 'dispositivo')),
+}
+FRAGMENTOS_LIMITADOR = 64
+MAX_CUBETAS_POR_FRAGMENTO = 10000
+
+class AlmacenCubetasMemoria:
+    # Cubetas repartidas en fragmentos con su propio lock para que los hilos no compitan por uno global.
+    # Cada fragmento es un LRU: al llenarse se descarta la cubeta usada hace más tiempo, que casi siempre ya se
+    # habría rellenado del todo (equivale a no tener entrada)
+    def __init__(self, fragmentos=FRAGMENTOS_LIMITADOR):
+        self._fragmentos = [(OrderedDict(), threading.Lock()) for _ in range(fragmentos)]
+
+    def consumir(self, claves, capacidad, recarga, coste=1):
+        # Todas las cubetas o ninguna: una petición rechazada no gasta fichas de las demás claves.
+        # Con coste = 0 solo se comprueba que quede al menos una ficha
+        n = len(self._fragmentos)
+        locks = [self._fragmentos[i][1] for i in sorted({hash(clave) % n for clave in claves})]
+        ahora = time.monotonic()
+        for lock in locks:  # siempre en el mismo orden, sin interbloqueos
+            lock.acquire()
+        try:
+            estados = []
+            for clave in claves:
+                cubetas = self._fragmentos[hash(clave) % n][0]
+                fichas, ultima = cubetas.get(clave, (capacidad, ahora))
+                estados.append((cubetas, clave, min(capacidad, fichas + (ahora - ultima) * recarga)))
+            espera = max(((1 - fichas) / recarga for _, _, fichas in estados if fichas < 1), default=0.0)
+            for cubetas, clave, fichas in estados:
+                cubetas[clave] = (fichas - coste if espera == 0 else fichas, ahora)
+                cubetas.move_to_end(clave)
+                if len(cubetas) > MAX_CUBETAS_POR_FRAGMENTO:
+                    cubetas.popitem(last=False)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return espera == 0, espera
+
+class AlmacenCubetasRedis:
+    # Modo compartido entre procesos y nodos: la comprobación y el cobro de todas las cubetas son atómicos en un script Lua
+    SCRIPT = """
+    local capacidad = tonumber(ARGV[1])
+    local recarga = tonumber(ARGV[2])
+    local ahora = tonumber(ARGV[3])
+    local coste = tonumber(ARGV[4])
+    local fichas = {}
+    local espera = 0
+    for i, clave in ipairs(KEYS) do
+        local datos = redis.call('HMGET', clave, 'f', 't')
+        local f = tonumber(datos[1]) or capacidad
+        local t = tonumber(datos[2]) or ahora
+        fichas[i] = math.min(capacidad, f + math.max(0, ahora - t) * recarga)
+        if fichas[i] < 1 then
+            espera = math.max(espera, (1 - fichas[i]) / recarga)
+        end
+    end
+    for i, clave in ipairs(KEYS) do
+        if espera == 0 then
+            fichas[i] = fichas[i] - coste
+        end
+        redis.call('HSET', clave, 'f', fichas[i], 't', ahora)
+        redis.call('EXPIRE', clave, math.ceil(capacidad / recarga) + 1)
+    end
+    if espera == 0 then
+        return {1, '0'}
+    end
+    return {0, tostring(espera)}
+    """
+
+    def __init__(self, url):
+        import redis
+        self._cliente = redis.Redis.from_url(url)
+        self._script = self._cliente.register_script(self.SCRIPT)
+
+    def consumir(self, claves, capacidad, recarga, coste=1):
+        permitido, espera = self._script(
+            keys=[f'limite:{clave}' for clave in claves], args=[capacidad, recarga, time.time(), coste])
+        return bool(permitido), float(espera)
+
+def _valores_clave_tasa(tipo):
+    if tipo == 'ip':
+        return request.remote_addr
+    # En rutas con token de dispositivo el usuario y el dispositivo salen del token ya verificado (ver token_dispositivo)
+    verificado = g.get('token_dispositivo')
+    if tipo == 'usuario':
+        if verificado:
+            return verificado[0]
+        try:
+            verify_jwt_in_request(optional=True)
+            return get_jwt_identity()
+        except Exception:
+            return None
+    if tipo == 'dispositivo':
+        return verificado[1] if verificado else request.headers.get('X-Device-Id')
+    if tipo in ('correo', 'correo_ip'):
+        data = request.get_json(silent=True) or {}
+        correo = (data.get('correo') or '').strip().lower() or None
+        if tipo == 'correo_ip' and correo:
+            return f'{correo}|{request.remote_addr}'
+        return correo
+    return None
+
+def consumir_tasa(nombre, coste=1):
+    capacidad, recarga, claves = current_app.config.get('LIMITES_TASA', {}).get(nombre, LIMITES_TASA[nombre])
+    almacen = current_app.extensions['limitador_tasa']
+    valores = [(tipo, _valores_clave_tasa(tipo)) for tipo in claves]
+    claves_cubeta = [f'{nombre}:{tipo}:{valor}' for tipo, valor in valores if valor is not None]
+    return almacen.consumir(claves_cubeta, capacidad, recarga, coste) if claves_cubeta else (True, 0.0)
+
+def respuesta_limite_tasa(nombre, espera):
+    print(f"Límite de tasa superado en {nombre} desde {request.remote_addr}, reintentar en {espera:.1f}s")
+    respuesta = jsonify({"msg": "Demasiadas solicitudes, intenta más tarde"})
+    respuesta.headers['Retry-After'] = str(math.ceil(espera))
+    return respuesta, 429
+
+def limitar(nombre):
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            permitido, espera = consumir_tasa(nombre)
+            if not permitido:
+                return respuesta_limite_tasa(nombre, espera)
+            return vista(*args, **kwargs)
+        return envoltura
+    return decorador
+
+# TOKENS DE LECTURA PARA DISPOSITIVOS (smartwatch y TV)
+# Formato: v1.<kid>.<usuario_id>.<alcance>.<expira>.<firma HMAC-SHA256>. Se verifican sin consultar la BD.
+ALCANCES_DISPOSITIVO = ('smartwatch', 'tv')
+DURACION_TOKEN_DISPOSITIVO = 3600
+MAX_DURACION_TOKEN_DISPOSITIVO = 86400
+MAX_AGE_DISPOSITIVO = 15
+
+def _claves_dispositivo():
+    # {kid: clave} se calcula una vez por app y queda en memoria; MEDNOTIFY_DEVICE_TOKEN_KEYS="k1:secreto1,k2:secreto2"
+    # permite rotar: se firma con la primera y se aceptan todas
+    claves = current_app.extensions.get('claves_dispositivo')
+    if claves is None:
+        configuradas = os.environ.get('MEDNOTIFY_DEVICE_TOKEN_KEYS')
+        if configuradas:
+            claves = {}
+            for par in configuradas.split(','):
+                kid, secreto = par.split(':', 1)
+                claves[kid.strip()] = secreto.strip().encode()
+        else:
+            base = current_app.config['JWT_SECRET_KEY'].encode()
+            claves = {'k0': hmac.new(base, b'tokens-dispositivo', hashlib.sha256).digest()}
+        current_app.extensions['claves_dispositivo'] = claves
+    return claves
+
+def _firmar_dispositivo(clave, contenido):
+    firma = hmac.new(clave, contenido.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(firma[:24]).decode().rstrip('=')
+
+def crear_token_dispositivo(usuario_id, alcance, duracion):
+    claves = _claves_dispositivo()
+    kid = next(iter(claves))
+    expira = int(time.time()) + duracion
+    contenido = f'v1.{kid}.{int(usuario_id)}.{alcance}.{expira}'
+    return f'{contenido}.{_firmar_dispositivo(claves[kid], contenido)}', expira
+
+def verificar_token_dispositivo(token, usuario_id, alcance):
+    partes = (token or '').split('.')
+    if len(partes) != 6 or partes[0] != 'v1':
+        return False
+    _, kid, uid, alcance_token, expira, firma = partes
+    clave = _claves_dispositivo().get(kid)
+    if clave is None or not hmac.compare_digest(firma, _firmar_dispositivo(clave, '.'.join(partes[:5]))):
+        return False
+    return uid == str(usuario_id) and alcance_token == alcance and expira.isdigit() and int(expira) > time.time()
+
+def token_dispositivo(alcance):
+    # Solo en "Authorization: Device <token>": en la URL acabaría en el access log de gunicorn y en cachés compartidas.
+    # Va antes de @limitar: las cubetas se asignan al usuario y al token verificados, no a lo que diga la ruta
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            cabecera = request.headers.get('Authorization', '')
+            token = cabecera[len('Device '):] if cabecera.startswith('Device ') else None
+            if not verificar_token_dispositivo(token, kwargs.get('usuario_id'), alcance):
+                print(f"Token de dispositivo inválido para {alcance}, usuario_id: {kwargs.get('usuario_id')}")
+                return jsonify({"msg": "Token de dispositivo inválido o caducado"}), 401
+            g.token_dispositivo = (str(kwargs.get('usuario_id')), token.rsplit('.', 1)[1])
+            respuesta = make_response(vista(*args, **kwargs))
+            if respuesta.status_code == 200:
+                # public + s-maxage: una caché compartida no guarda respuestas a peticiones con Authorization si no
+                # se le permite expresamente; Vary separa la copia de cada token
+                respuesta.cache_control.public = True
+                respuesta.cache_control.max_age = MAX_AGE_DISPOSITIVO
+                respuesta.cache_control.s_maxage = MAX_AGE_DISPOSITIVO
+                respuesta.vary.add('Authorization')
+                # Débil: la compresión posterior (after_request) cambia los bytes pero no el contenido
+                respuesta.add_etag(weak=True)
+                respuesta.make_conditional(request)
+            return respuesta
+        return envoltura
+    return decorador
+
+# RÉPLICAS DE LECTURA
+# Las réplicas se configuran como binds "replica_N" (MEDNOTIFY_REPLICA_URIS="uri1,uri2"). Las rutas marcadas con
+# @lectura_replica envían sus SELECT a una réplica sana por turnos; todo lo demás sigue en la primaria.
+VENTANA_LECTURA_PROPIA = 5  # segundos que un cliente lee de la primaria después de escribir
+MAX_RETRASO_REPLICA = 10
+INTERVALO_LATIDO_REPLICA = 2
+TRABAJO_LATIDO_REPLICA = 'latido_replicas'
+# El instante de la última escritura viaja con el cliente (cookie y cabecera) y no en memoria de un worker:
+# cualquier worker que atienda su siguiente lectura lo conoce. Los clientes sin cookies reenvían la cabecera.
+COOKIE_ULTIMA_ESCRITURA = 'mednotify_escritura'
+CABECERA_ULTIMA_ESCRITURA = 'X-Ultima-Escritura'
+
+class EnrutadorReplicas:
+    def __init__(self, app, nombres):
+        self.app = app
+        self.nombres = list(nombres)
+        self._lock = threading.Lock()
+        self._turno = 0
+        self._sanas = {nombre: False for nombre in self.nombres}
+        self._verificado = None
+        self._pid = None
+
+    def _arrancar(self):
+        # El latido corre en su propio hilo (uno por proceso): las peticiones nunca esperan a la primaria ni a una réplica
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._sanas = {nombre: False for nombre in self.nombres}
+            self._verificado = None
+            threading.Thread(target=self._bucle, name='latido-replicas', daemon=True).start()
+
+    def _bucle(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._verificar()
+            except Exception as e:
+                print(f"Error al verificar las réplicas: {str(e)}")
+            time.sleep(INTERVALO_LATIDO_REPLICA)
+
+    def elegir(self, ultima_escritura=None):
+        # Devuelve el bind de la réplica a usar o None para leer de la primaria.
+        # ultima_escritura: instante (epoch en segundos) de la última escritura del cliente, si se conoce
+        if not self.nombres:
+            return None
+        self._arrancar()
+        if ultima_escritura is not None and time.time() - ultima_escritura < VENTANA_LECTURA_PROPIA:
+            return None
+        with self._lock:
+            # Si el hilo de latido lleva tiempo sin verificar, el estado de las réplicas ya no es fiable
+            if self._verificado is None or time.monotonic() - self._verificado > MAX_RETRASO_REPLICA:
+                return None
+            sanas = [nombre for nombre in self.nombres if self._sanas[nombre]]
+            if not sanas:
+                return None
+            self._turno += 1
+            return sanas[self._turno % len(sanas)]
+
+    def _verificar(self):
+        # Latido: cada verificación escribe una marca en la primaria y comprueba que las réplicas tienen la anterior
+        anterior = self._escribir_latido()
+        sanas = {}
+        for nombre in self.nombres:
+            try:
+                with db.engines[nombre].connect() as conexion:
+                    latido = conexion.execute(
+                        select(PuntoControlTrabajo.marca_tiempo).where(PuntoControlTrabajo.trabajo == TRABAJO_LATIDO_REPLICA)
+                    ).scalar()
+                sanas[nombre] = latido is not None and (
+                    anterior is None or anterior - latido <= timedelta(seconds=MAX_RETRASO_REPLICA)
+                )
+            except Exception as e:
+                print(f"Error al verificar la réplica {nombre}: {str(e)}")
+                sanas[nombre] = False
+            if sanas[nombre] != self._sanas[nombre]:
+                print(f"Réplica {nombre} {'disponible' if sanas[nombre] else 'retrasada o caída; se lee de la primaria'}")
+        with self._lock:
+            self._sanas = sanas
+            self._verificado = time.monotonic()
+
+    def _escribir_latido(self):
+        marca = datetime.utcnow()
+        tabla = PuntoControlTrabajo.__table__
+        try:
+            with db.engines[None].begin() as conexion:
+                existe, anterior = conexion.execute(
+                    select(tabla.c.trabajo, tabla.c.marca_tiempo).where(tabla.c.trabajo == TRABAJO_LATIDO_REPLICA)
+                ).first() or (None, None)
+                if existe is None:
+                    conexion.execute(insert(tabla).values(trabajo=TRABAJO_LATIDO_REPLICA, marca_tiempo=marca))
+                else:
+                    conexion.execute(tabla.update().where(tabla.c.trabajo == TRABAJO_LATIDO_REPLICA).values(marca_tiempo=marca))
+            return anterior
+        except IntegrityError:
+            return None  # otro worker creó el latido a la vez
+        except Exception as e:
+            print(f"Error al escribir el latido de réplicas: {str(e)}")
+            return None
+
+def _identidad_opcional():
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+def _ultima_escritura_cliente():
+    valor = request.headers.get(CABECERA_ULTIMA_ESCRITURA) or request.cookies.get(COOKIE_ULTIMA_ESCRITURA)
+    try:
+        return int(valor) / 1000
+    except (TypeError, ValueError):
+        return None
+
+def lectura_replica(vista):
+    # Lee de la primaria durante VENTANA_LECTURA_PROPIA tras una escritura del mismo cliente
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        enrutador = current_app.extensions['enrutador_replicas']
+        if enrutador.nombres:
+            g.replica_lectura = enrutador.elegir(_ultima_escritura_cliente())
+        return vista(*args, **kwargs)
+    return envoltura
+
+@api.after_app_request
+def registrar_escritura_reciente(respuesta):
+    enrutador = current_app.extensions['enrutador_replicas']
+    if enrutador.nombres and request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and respuesta.status_code < 400:
+        if _identidad_opcional() is not None or g.get('token_dispositivo'):
+            marca = str(int(time.time() * 1000))
+            respuesta.headers[CABECERA_ULTIMA_ESCRITURA] = marca
+            respuesta.set_cookie(
+                COOKIE_ULTIMA_ESCRITURA, marca, max_age=VENTANA_LECTURA_PROPIA, httponly=True, samesite='Lax',
+                secure=request.is_secure,
+            )
+    return respuesta
+
+def _marcar_sesion_escrita(session, flush_context):
+    session.info['escribio'] = True
+
+event.listen(Session, 'after_flush', _marcar_sesion_escrita)
+
+# PARTICIONADO POR USUARIO (SHARDING)
+# Los datos de salud de cada usuario viven en un único shard: la BD principal o un bind "shard_N"
+# (MEDNOTIFY_SHARD_URIS="uri1,uri2"). directorio_shards, en la principal, fija el shard de cada usuario; los usuarios
+# nuevos se reparten con hashing consistente y los que no tienen entrada siguen en la principal.
+# Al mover un usuario sus filas conservan el id: cada shard debe generar ids disjuntos
+# (auto_increment_increment / auto_increment_offset en MySQL).
+# cambios_sync y secuencias_sync viven con los datos: sus filas se confirman en la misma transacción
+TABLAS_SHARD = (
+    'glucosas', 'presiones_arteriales', 'oxigenaciones', 'frecuencias_cardiacas', 'medicamentos', 'notificaciones',
+    'cambios_sync', 'secuencias_sync',
+)
+# Tablas de la principal que además existen en cada shard y se usan con conexiones explícitas (no las enruta la
+# sesión): los puntos de control de importación se confirman en la misma transacción que las lecturas importadas
+TABLAS_LOCALES_SHARD = ('puntos_control_trabajos',)
+SHARD_PRINCIPAL = 'principal'
+NODOS_VIRTUALES_SHARD = 100
+TTL_DIRECTORIO_SHARD = 30
+MAX_CACHE_DIRECTORIO_SHARD = 100000
+MARGEN_MOVIMIENTO_SHARD = 5  # segundos extra para las transacciones en curso al caducar las cachés
+REINTENTO_MOVIMIENTO_SHARD = 10
+
+class UsuarioEnMovimiento(Exception):
+    pass
+
+class EnrutadorShards:
+    def __init__(self, nombres):
+        self.shards = list(nombres)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # usuario_id -> (instante de la consulta, shard, moviendo)
+        self._anillo = sorted(
+            (self._hash(f'{nombre}#{i}'), nombre)
+            for nombre in [SHARD_PRINCIPAL] + self.shards
+            for i in range(NODOS_VIRTUALES_SHARD)
+        )
+        self._posiciones = [posicion for posicion, _ in self._anillo]
+
+    @staticmethod
+    def _hash(texto):
+        return int.from_bytes(hashlib.md5(texto.encode()).digest()[:8], 'big')
+
+    def por_hash(self, usuario_id):
+        # Añadir un shard solo reasigna los usuarios del tramo del anillo que pasa a cubrir
+        indice = bisect_right(self._posiciones, self._hash(str(int(usuario_id)))) % len(self._posiciones)
+        return self._anillo[indice][1]
+
+    def _entrada(self, usuario_id):
+        usuario_id = int(usuario_id)
+        ahora = time.monotonic()
+        entrada = self._cache.get(usuario_id)
+        if entrada is not None and ahora - entrada[0] < TTL_DIRECTORIO_SHARD:
+            return entrada
+        tabla = DirectorioShard.__table__
+        with db.engines[None].connect() as conexion:
+            fila = conexion.execute(select(tabla.c.shard, tabla.c.moviendo).where(tabla.c.usuario_id == usuario_id)).first()
+        entrada = (ahora, fila.shard, bool(fila.moviendo)) if fila else (ahora, SHARD_PRINCIPAL, False)
+        with self._lock:
+            self._cache.pop(usuario_id, None)
+            self._cache[usuario_id] = entrada
+            while len(self._cache) > MAX_CACHE_DIRECTORIO_SHARD:
+                self._cache.popitem(last=False)
+        return entrada
+
+    def shard_de(self, usuario_id):
+        if not self.shards:
+            return SHARD_PRINCIPAL
+        return self._entrada(usuario_id)[1]
+
+    def en_movimiento(self, usuario_id):
+        # Las escrituras de un usuario que se está moviendo se rechazan (ver mover_usuario_shard)
+        return bool(self.shards) and self._entrada(usuario_id)[2]
+
+    def shards_de(self, usuario_ids):
+        # Como shard_de para muchos usuarios, con una sola consulta para los que no están en caché
+        usuario_ids = [int(u) for u in usuario_ids]
+        if not self.shards:
+            return {u: SHARD_PRINCIPAL for u in usuario_ids}
+        ahora = time.monotonic()
+        resultado, pendientes = {}, []
+        for usuario_id in usuario_ids:
+            entrada = self._cache.get(usuario_id)
+            if entrada is not None and ahora - entrada[0] < TTL_DIRECTORIO_SHARD:
+                resultado[usuario_id] = entrada[1]
+            else:
+                pendientes.append(usuario_id)
+        if pendientes:
+            tabla = DirectorioShard.__table__
+            with db.engines[None].connect() as conexion:
+                encontrados = {u: (shard, bool(moviendo)) for u, shard, moviendo in conexion.execute(
+                    select(tabla.c.usuario_id, tabla.c.shard, tabla.c.moviendo).where(tabla.c.usuario_id.in_(pendientes))
+                )}
+            with self._lock:
+                for usuario_id in pendientes:
+                    shard, moviendo = encontrados.get(usuario_id, (SHARD_PRINCIPAL, False))
+                    resultado[usuario_id] = shard
+                    self._cache.pop(usuario_id, None)
+                    self._cache[usuario_id] = (ahora, shard, moviendo)
+                while len(self._cache) > MAX_CACHE_DIRECTORIO_SHARD:
+                    self._cache.popitem(last=False)
+        return resultado
+
+    def invalidar(self, usuario_id):
+        with self._lock:
+            self._cache.pop(int(usuario_id), None)
+
+def enrutador_shards():
+    return current_app.extensions['enrutador_shards']
+
+def _respuesta_en_movimiento(usuario_id):
+    print(f"Escritura rechazada: usuario_id {usuario_id} se está moviendo de shard")
+    respuesta = jsonify({"msg": "Tus datos se están trasladando, intenta de nuevo en unos segundos"})
+    respuesta.headers['Retry-After'] = str(REINTENTO_MOVIMIENTO_SHARD)
+    return respuesta, 503
+
+@api.before_app_request
+def rechazar_escrituras_en_movimiento():
+    if request.method not in ('POST', 'PUT', 'PATCH', 'DELETE') or not enrutador_shards().shards:
+        return None
+    usuario_id = (request.view_args or {}).get('usuario_id')
+    if usuario_id is None:
+        try:
+            verify_jwt_in_request(optional=True)
+        except Exception:
+            return None  # la vista responde al token inválido
+        usuario_id = _identidad_opcional()
+    if usuario_id is not None and enrutador_shards().en_movimiento(usuario_id):
+        return _respuesta_en_movimiento(usuario_id)
+    return None
+
+@api.app_errorhandler(UsuarioEnMovimiento)
+def escritura_en_movimiento(e):
+    # Red de seguridad para las escrituras que llegan al commit con la caché del directorio aún sin el aviso
+    db.session.rollback()
+    return _respuesta_en_movimiento(e.args[0])
+
+def nombres_shard():
+    return [SHARD_PRINCIPAL] + enrutador_shards().shards
+
+def engine_shard(shard):
+    return db.engines[None if shard == SHARD_PRINCIPAL else shard]
+
+def _tabla_particionada(mapper, clause):
+    if mapper is not None:
+        return sa_inspect(mapper).local_table.name in TABLAS_SHARD
+    if clause is not None:
+        return any(getattr(t, 'name', None) in TABLAS_SHARD for t in find_tables(clause, include_crud=True))
+    return False
+
+def _shard_de_sesion(session):
+    # Shard fijado con usar_shard() o, dentro de una petición, el del usuario de la ruta o del JWT
+    if 'shard' in session.info:
+        return session.info['shard']
+    usuario_id = None
+    if has_request_context():
+        usuario_id = (request.view_args or {}).get('usuario_id')
+        if usuario_id is None:
+            usuario_id = _identidad_opcional()
+    if usuario_id is None:
+        raise RuntimeError('Consulta a una tabla particionada sin usuario; usa usar_shard()')
+    return enrutador_shards().shard_de(usuario_id)
+
+@contextmanager
+def usar_shard(shard):
+    # Para trabajos que recorren varios usuarios: fija el shard de las tablas particionadas en la sesión actual
+    info = db.session.info
+    anterior = info.get('shard')
+    tenia = 'shard' in info
+    info['shard'] = shard
+    try:
+        yield
+    finally:
+        if tenia:
+            info['shard'] = anterior
+        else:
+            info.pop('shard', None)
+
+def usar_shard_de(usuario_id):
+    return usar_shard(enrutador_shards().shard_de(usuario_id))
+
+def asignar_shard(usuario_id):
+    # Se llama al crear el usuario, dentro de su misma transacción
+    enrutador = enrutador_shards()
+    if enrutador.shards:
+        db.session.add(DirectorioShard(usuario_id=usuario_id, shard=enrutador.por_hash(usuario_id)))
+
+def _columna_orden(tabla):
+    # Columna de la clave primaria que no es el usuario (id, o seq en cambios_sync); None en secuencias_sync
+    return next((c for c in tabla.primary_key.columns if c.name != 'usuario_id'), None)
+
+def _copiar_tabla_usuario(origen, destino, tabla, usuario_id, lote):
+    columna = _columna_orden(tabla)
+    copiadas = 0
+    ultimo = None
+    while True:
+        consulta = select(tabla).where(tabla.c.usuario_id == usuario_id)
+        if columna is not None:
+            if ultimo is not None:
+                consulta = consulta.where(columna > ultimo)
+            consulta = consulta.order_by(columna).limit(lote)
+        with origen.connect() as conexion:
+            filas = [dict(f._mapping) for f in conexion.execute(consulta)]
+        if filas:
+            with destino.begin() as conexion:
+                conexion.execute(insert(tabla), filas)
+            copiadas += len(filas)
+        if columna is None or len(filas) < lote:
+            return copiadas
+        ultimo = filas[-1][columna.name]
+
+def _borrar_tabla_usuario(engine, tabla, usuario_id, lote):
+    columna = _columna_orden(tabla)
+    while True:
+        with engine.begin() as conexion:
+            if columna is None:
+                conexion.execute(tabla.delete().where(tabla.c.usuario_id == usuario_id))
+                return
+            claves = [c for (c,) in conexion.execute(select(columna).where(tabla.c.usuario_id == usuario_id).limit(lote))]
+            if not claves:
+                return
+            conexion.execute(tabla.delete().where(tabla.c.usuario_id == usuario_id, columna.in_(claves)))
+
+def _condicion_puntos_importacion(usuario_id):
+    return PuntoControlTrabajo.__table__.c.trabajo.like(f'importar:{int(usuario_id)}:%')
+
+def _copiar_puntos_importacion(origen, destino, usuario_id):
+    tabla = PuntoControlTrabajo.__table__
+    with origen.connect() as conexion:
+        filas = [dict(f._mapping) for f in conexion.execute(select(tabla).where(_condicion_puntos_importacion(usuario_id)))]
+    with destino.begin() as conexion:
+        conexion.execute(tabla.delete().where(_condicion_puntos_importacion(usuario_id)))
+        if filas:
+            conexion.execute(insert(tabla), filas)
+
+def _marcar_directorio(usuario_id, shard, moviendo):
+    entrada = db.session.get(DirectorioShard, usuario_id) or DirectorioShard(usuario_id=usuario_id)
+    entrada.shard = shard
+    entrada.moviendo = moviendo
+    db.session.add(entrada)
+    db.session.commit()
+    enrutador_shards().invalidar(usuario_id)
+
+def mover_usuarios_shard(destinos, lote=1000, espera=TTL_DIRECTORIO_SHARD):
+    # destinos: {usuario_id: shard}. Las escrituras de los usuarios se congelan durante la copia (503 con Retry-After);
+    # las lecturas siguen en el origen. Las dos esperas a que caduquen las cachés del directorio se hacen una vez por
+    # tanda y no por usuario. Devuelve ({usuario_id: filas copiadas}, {usuario_id: error})
+    enrutador = enrutador_shards()
+    origenes = {}
+    for usuario_id, destino in destinos.items():
+        if destino not in nombres_shard():
+            raise ValueError(f'Shard desconocido: {destino}')
+        enrutador.invalidar(usuario_id)
+        origen = enrutador.shard_de(usuario_id)
+        if origen != destino:
+            origenes[usuario_id] = origen
+    if not origenes:
+        return {}, {}
+
+    # 1. Se congelan los usuarios y se espera a que todas las cachés del directorio lo vean
+    congelados = []
+    try:
+        for usuario_id, origen in origenes.items():
+            _marcar_directorio(usuario_id, origen, True)
+            congelados.append(usuario_id)
+        time.sleep(espera + MARGEN_MOVIMIENTO_SHARD)
+    except Exception:
+        for usuario_id in congelados:
+            _marcar_directorio(usuario_id, origenes[usuario_id], False)
+        raise
+
+    copiadas, errores = {}, {}
+    for usuario_id, origen in origenes.items():
+        destino = destinos[usuario_id]
+        engine_origen, engine_destino = engine_shard(origen), engine_shard(destino)
+        try:
+            # 2. Copia completa, incluido el historial de sync; se descartan restos de un intento anterior
+            total = 0
+            for nombre in TABLAS_SHARD:
+                tabla = db.metadata.tables[nombre]
+                _borrar_tabla_usuario(engine_destino, tabla, usuario_id, lote)
+                total += _copiar_tabla_usuario(engine_origen, engine_destino, tabla, usuario_id, lote)
+                print(f"Usuario {usuario_id}: {nombre} copiada, {total} filas en total")
+            # Una importación a medias continúa desde su punto de control en el nuevo shard
+            _copiar_puntos_importacion(engine_origen, engine_destino, usuario_id)
+
+            # 3. Cambio de directorio; con ello se descongelan sus escrituras
+            _marcar_directorio(usuario_id, destino, False)
+            copiadas[usuario_id] = total
+        except Exception as e:
+            _marcar_directorio(usuario_id, origen, False)
+            print(f"Error al mover usuario {usuario_id} de {origen} a {destino}: {str(e)}")
+            errores[usuario_id] = e
+
+    # 4. Hasta que caducan las cachés aún puede haber lecturas en el origen; después se limpia
+    if copiadas:
+        time.sleep(espera + MARGEN_MOVIMIENTO_SHARD)
+    for usuario_id, total in copiadas.items():
+        engine_origen = engine_shard(origenes[usuario_id])
+        for nombre in TABLAS_SHARD:
+            _borrar_tabla_usuario(engine_origen, db.metadata.tables[nombre], usuario_id, lote)
+        with engine_origen.begin() as conexion:
+            conexion.execute(PuntoControlTrabajo.__table__.delete().where(_condicion_puntos_importacion(usuario_id)))
+        invalidar_cache_usuario(usuario_id)
+        print(f"Usuario {usuario_id} movido de {origenes[usuario_id]} a {destinos[usuario_id]}: {total} filas")
+    return copiadas, errores
+
+def mover_usuario_shard(usuario_id, destino, lote=1000, espera=TTL_DIRECTORIO_SHARD):
+    copiadas, errores = mover_usuarios_shard({usuario_id: destino}, lote, espera)
+    if usuario_id in errores:
+        raise errores[usuario_id]
+    return copiadas.get(usuario_id, 0)
+
+@api.cli.command('crear-tablas-shards')
+def crear_tablas_shards():
+    # Las tablas particionadas se crean sin claves foráneas: usuarios solo existe en la principal
+    metadata = db.MetaData()
+    tablas = []
+    for nombre in TABLAS_SHARD:
+        original = db.metadata.tables[nombre]
+        tabla = db.Table(nombre, metadata, *[
+            db.Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, autoincrement=c.autoincrement)
+            for c in original.columns
+        ])
+        for indice in original.indexes:
+            db.Index(indice.name, *[tabla.c[c.name] for c in indice.columns], unique=indice.unique)
+        tablas.append(tabla)
+    tablas += [db.metadata.tables[nombre].to_metadata(metadata) for nombre in TABLAS_LOCALES_SHARD]
+    for shard in enrutador_shards().shards:
+        metadata.create_all(db.engines[shard], tables=tablas)
+        print(f"Tablas creadas en {shard}")
+
+@api.cli.command('mover-usuario-shard')
+@click.argument('usuario_id', type=int)
+@click.argument('destino')
+@click.option('--lote', default=1000, show_default=True, help='Filas copiadas por lote')
+@click.option('--espera', default=TTL_DIRECTORIO_SHARD, show_default=True, help='Segundos hasta que caducan las cachés del directorio')
+def mover_usuario_shard_cli(usuario_id, destino, lote, espera):
+    try:
+        mover_usuario_shard(usuario_id, destino, lote, espera)
+    except IntegrityError as e:
+        # El directorio aún no ha cambiado: el usuario sigue en el origen y el movimiento se puede relanzar
+        print(f"Error: ids repetidos en el destino, los shards deben generar ids disjuntos: {str(e)}")
+
+@api.cli.command('rebalancear-shards')
+@click.option('--lote', default=1000, show_default=True, help='Filas copiadas por lote')
+@click.option('--max-usuarios', default=100, show_default=True, help='Usuarios movidos como máximo en esta ejecución')
+@click.option('--tanda', default=20, show_default=True, help='Usuarios congelados y movidos a la vez (comparten las esperas)')
+@click.option('--espera', default=TTL_DIRECTORIO_SHARD, show_default=True)
+@click.option('--simular', is_flag=True, help='Solo muestra el plan')
+def rebalancear_shards(lote, max_usuarios, tanda, espera, simular):
+    # Mueve los usuarios cuyo shard actual no coincide con el del anillo (p. ej. tras añadir un shard)
+    enrutador = enrutador_shards()
+    plan = []
+    ultimo_id = 0
+    while len(plan) < max_usuarios:
+        ids = [i for (i,) in db.session.query(Usuario.id).filter(Usuario.id > ultimo_id).order_by(Usuario.id).limit(1000)]
+        if not ids:
+            break
+        actuales = dict(db.session.query(DirectorioShard.usuario_id, DirectorioShard.shard).filter(DirectorioShard.usuario_id.in_(ids)))
+        db.session.commit()
+        for usuario_id in ids:
+            actual, destino = actuales.get(usuario_id, SHARD_PRINCIPAL), enrutador.por_hash(usuario_id)
+            if actual == destino:
+                continue
+            print(f"Usuario {usuario_id}: {actual} -> {destino}")
+            plan.append((usuario_id, destino))
+            if len(plan) >= max_usuarios:
+                break
+        ultimo_id = ids[-1]
+    if simular:
+        print(f"Rebalanceo simulado: {len(plan)} usuarios")
+        return
+
+    movidos = fallidos = 0
+    for inicio in range(0, len(plan), tanda):
+        copiadas, errores = mover_usuarios_shard(dict(plan[inicio:inicio + tanda]), lote, espera)
+        movidos += len(copiadas)
+        fallidos += len(errores)
+    print(f"Rebalanceo completado: {movidos} usuarios, {fallidos} con error")
+
+# IDEMPOTENCIA
+TTL_IDEMPOTENCIA = timedelta(hours=24)
+MAX_CACHE_IDEMPOTENCIA = 10000
+_cache_idempotencia = OrderedDict()
+_lock_idempotencia = threading.Lock()
+
+def _respuesta_guardada(ruta, estado_http, cuerpo):
+    respuesta = current_app.response_class(cuerpo, status=estado_http, mimetype='application/json')
+    respuesta.headers['Idempotent-Replayed'] = 'true'
+    print(f"Respuesta idempotente repetida para {ruta}: {estado_http}")
+    return respuesta
+
+def _recordar_idempotencia(clave, valor):
+    with _lock_idempotencia:
+        _cache_idempotencia[clave] = valor
+        _cache_idempotencia.move_to_end(clave)
+        while len(_cache_idempotencia) > MAX_CACHE_IDEMPOTENCIA:
+            _cache_idempotencia.popitem(last=False)
+
+def idempotente(vista):
+    # Con cabecera Idempotency-Key, los reintentos de la misma petición devuelven la respuesta original.
+    # La reclamación es un INSERT sobre la clave primaria (usuario_id, clave); el LRU evita ir a la BD en repeticiones recientes.
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        clave = request.headers.get('Idempotency-Key')
+        if not clave:
+            return vista(*args, **kwargs)
+        if len(clave) > 64:
+            return jsonify({"msg": "Idempotency-Key admite como máximo 64 caracteres"}), 400
+        usuario_id = int(get_jwt_identity())
+        ahora = datetime.utcnow()
+        hash_cuerpo = hashlib.sha256(request.get_data()).hexdigest()
+
+        with _lock_idempotencia:
+            guardada = _cache_idempotencia.get((usuario_id, clave))
+        if guardada and ahora - guardada[0] < TTL_IDEMPOTENCIA and guardada[1] == request.path:
+            if guardada[4] != hash_cuerpo:
+                return jsonify({"msg": "Idempotency-Key ya usada con otro cuerpo"}), 422
+            return _respuesta_guardada(request.path, guardada[2], guardada[3])
+
+        try:
+            db.session.add(ClaveIdempotencia(
+                usuario_id=usuario_id, clave=clave, ruta=request.path, hash_cuerpo=hash_cuerpo, fecha_creacion=ahora
+            ))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            fila = db.session.get(ClaveIdempotencia, (usuario_id, clave))
+            if fila is None or ahora - fila.fecha_creacion >= TTL_IDEMPOTENCIA:
+                # Clave caducada: se reutiliza como si fuera nueva
+                if fila is not None:
+                    db.session.delete(fila)
+                    db.session.commit()
+                return envoltura(*args, **kwargs)
+            if fila.ruta != request.path:
+                return jsonify({"msg": "Idempotency-Key ya usada en otra ruta"}), 422
+            if fila.hash_cuerpo != hash_cuerpo:
+                return jsonify({"msg": "Idempotency-Key ya usada con otro cuerpo"}), 422
+            if fila.estado_http is None:
+                return jsonify({"msg": "La petición original todavía se está procesando"}), 409
+            _recordar_idempotencia(
+                (usuario_id, clave), (fila.fecha_creacion, fila.ruta, fila.estado_http, fila.respuesta, fila.hash_cuerpo)
+            )
+            return _respuesta_guardada(request.path, fila.estado_http, fila.respuesta)
+
+        try:
+            respuesta = make_response(vista(*args, **kwargs))
+        except Exception:
+            # Sin liberar la clave, cada reintento recibiría 409 hasta que caducara
+            db.session.rollback()
+            ClaveIdempotencia.query.filter_by(usuario_id=usuario_id, clave=clave).delete()
+            db.session.commit()
+            raise
+        try:
+            if respuesta.status_code >= 500:
+                # Los errores del servidor no se memorizan: el cliente puede reintentar
+                ClaveIdempotencia.query.filter_by(usuario_id=usuario_id, clave=clave).delete()
+            else:
+                cuerpo = respuesta.get_data(as_text=True)
+                ClaveIdempotencia.query.filter_by(usuario_id=usuario_id, clave=clave).update(
+                    {"estado_http": respuesta.status_code, "respuesta": cuerpo}
+                )
+                _recordar_idempotencia((usuario_id, clave), (ahora, request.path, respuesta.status_code, cuerpo, hash_cuerpo))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al guardar clave de idempotencia: {str(e)}")
+        return respuesta
+    return envoltura
+
+@api.cli.command('purgar-idempotencia')
+@click.option('--lote', default=10000, show_default=True)
+def purgar_idempotencia(lote):
+    limite = datetime.utcnow() - TTL_IDEMPOTENCIA
+    eliminadas = 0
+    while True:
+        claves = db.session.query(ClaveIdempotencia.usuario_id, ClaveIdempotencia.clave).filter(
+            ClaveIdempotencia.fecha_creacion < limite
+        ).limit(lote).all()
+        if not claves:
+            break
+        ClaveIdempotencia.query.filter(
+            tuple_(ClaveIdempotencia.usuario_id, ClaveIdempotencia.clave).in_(claves)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        eliminadas += len(claves)
+    print(f"Claves de idempotencia caducadas eliminadas: {eliminadas}")
+
+# COMPRESIÓN Y FORMATOS COMPACTOS
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+UMBRAL_COMPRESION = 1024
+TIPOS_COMPRIMIBLES = ('application/json', 'application/msgpack', 'application/vnd.mednotify.columnar+json')
+FORMATO_COLUMNAR = 'application/vnd.mednotify.columnar+json'
+
+def responder_lista(filas):
+    # JSON por defecto; con Accept columnar o ?formato=columnar cada clave se envía una sola vez
+    # ({"fecha": [...], "valor": [...]}), y con Accept application/msgpack lo mismo en MessagePack
+    formato = request.accept_mimetypes.best_match(
+        ['application/json', FORMATO_COLUMNAR, 'application/msgpack'], default='application/json'
+    )
+    if request.args.get('formato') == 'columnar':
+        formato = FORMATO_COLUMNAR
+    if formato == 'application/json' or (formato == 'application/msgpack' and msgpack is None):
+        return jsonify(filas), 200
+
+    columnas = {clave: [fila[clave] for fila in filas] for clave in (filas[0].keys() if filas else ())}
+    if formato == 'application/msgpack':
+        return current_app.response_class(msgpack.packb(columnas, use_bin_type=True), status=200, mimetype='application/msgpack')
+    respuesta = jsonify(columnas)
+    respuesta.mimetype = FORMATO_COLUMNAR
+    return respuesta, 200
+
+@api.after_app_request
+def comprimir_respuesta(respuesta):
+    if (
+        respuesta.direct_passthrough
+        or respuesta.status_code < 200
+        or 'Content-Encoding' in respuesta.headers
+        or respuesta.mimetype not in TIPOS_COMPRIMIBLES
+    ):
+        return respuesta
+    respuesta.vary.add('Accept-Encoding')
+    datos = respuesta.get_data()
+    if len(datos) < UMBRAL_COMPRESION:
+        return respuesta
+    codificaciones = request.accept_encodings
+    if brotli is not None and codificaciones['br']:
+        respuesta.set_data(brotli.compress(datos, quality=5))
+        respuesta.headers['Content-Encoding'] = 'br'
+    elif codificaciones['gzip']:
+        respuesta.set_data(gzip.compress(datos, compresslevel=6))
+        respuesta.headers['Content-Encoding'] = 'gzip'
+    return respuesta
+
 # RUTAS
-@app.route('/api/registro', methods=['POST'])
+@api.route('/api/registro', methods=['POST'])
+@limitar('registro')
 def registro():
     print("Solicitud recibida en /api/registro:", request.json)
     data = request.get_json(force=True)
@@ -168,6 +1445,7 @@ def registro():
     try:
         db.session.add(usuario)
         db.session.flush()  
+        asignar_shard(usuario.id)
         if fcm_token:
             fcm_token_entry = FcmToken(usuario_id=usuario.id, token=fcm_token)
             db.session.add(fcm_token_entry)
@@ -181,7 +1459,8 @@ def registro():
         db.session.rollback()
         return jsonify({"msg": f"Error interno: {str(e)}"}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
+@limitar('login')
 def login():
     print("Solicitud recibida en /api/login:", request.json)
     data = request.get_json(force=True)
@@ -189,8 +1468,15 @@ def login():
     password = data.get('password')
     fcm_token = data.get('fcm_token')
 
+    permitido, espera = consumir_tasa('login_fallido', coste=0)
+    if not permitido:
+        return respuesta_limite_tasa('login_fallido', espera)
+
     usuario = Usuario.query.filter_by(correo=correo).first()
     if usuario and usuario.check_password(password):
+        if PurgaCuenta.query.filter(PurgaCuenta.usuario_id == usuario.id, PurgaCuenta.estado != 'completada').first():
+            print("Error: Cuenta en proceso de eliminación:", correo)
+            return jsonify({"msg": "La cuenta se está eliminando"}), 403
         if fcm_token:
             existing_token = FcmToken.query.filter_by(token=fcm_token).first()
             if not existing_token:
@@ -207,11 +1493,12 @@ def login():
         print("Login exitoso para:", correo)
         return jsonify({"access_token": access_token}), 200
     else:
+        consumir_tasa('login_fallido')
         print("Error: Credenciales inválidas")
         return jsonify({"msg": "Credenciales inválidas"}), 401
 
 
-@app.route('/api/save_fcm_token', methods=['POST'])
+@api.route('/api/save_fcm_token', methods=['POST'])
 @jwt_required()
 def save_fcm_token():
     usuario_id = get_jwt_identity()
@@ -241,10 +1528,13 @@ def save_fcm_token():
 
 # ... (importaciones y configuraciones previas se mantienen iguales)
 
-@app.route('/api/registros_salud', methods=['POST'])
+@api.route('/api/registros_salud', methods=['POST'])
+@limitar('escritura')
 @jwt_required()
+@idempotente
 def crear_registro():
     usuario_id = get_jwt_identity()
+    aviso_nivel = None
     try:
         data = request.get_json(force=True)
         print(f"Datos recibidos en registros_salud: {data}")
@@ -257,91 +1547,44 @@ def crear_registro():
             print("Error: Faltan datos obligatorios")
             return jsonify({"msg": "Fecha, hora y tipo son requeridos"}), 400
 
-        try:
-            fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
-            hora = datetime.strptime(hora_str, '%H:%M:%S').time()
-        except ValueError as e:
-            print(f"Error de formato: {str(e)}")
-            return jsonify({"msg": f"Formato de fecha o hora inválido: {str(e)}"}), 400
-
-        if tipo == 'glucosa':
-            try:
-                valor = float(data.get('valor'))
-                if valor < 0 or valor > 999.99:
-                    print("Error: Valor de glucosa fuera de rango")
-                    return jsonify({"msg": "El valor de glucosa debe estar entre 0 y 999.99"}), 400
-                registro = Glucosa(usuario_id=usuario_id, fecha=fecha, hora=hora, valor=valor)
-
-                nivel = 'Normal' if 70 <= valor <= 180 else 'Bajo' if valor < 70 else 'Alto'
-                mensaje = f'Tu glucosa está en nivel {nivel.lower()} ({valor} mg/dL)'
-                
-                notificacion = Notificacion(
-                    usuario_id=usuario_id,
-                    mensaje=mensaje,
-                    fecha=fecha,
-                    hora=hora,
-                )
-                db.session.add(notificacion)
-
-                enviar_notificacion_fcm(
-                    usuario_id,
-                    'WHS Medicine - Glucosa',
-                    mensaje,
-                    None
-                )
-
-            except (ValueError, TypeError):
-                print("Error: Valor de glucosa inválido")
-                return jsonify({"msg": "Valor de glucosa inválido"}), 400
-
-        elif tipo == 'presion_arterial':
-            try:
-                sistolica = int(data.get('sistolica'))
-                diastolica = int(data.get('diastolica'))
-                if sistolica < 0 or diastolica < 0:
-                    print("Error: Valores de presión arterial inválidos")
-                    return jsonify({"msg": "Los valores de presión arterial deben ser positivos"}), 400
-                registro = PresionArterial(
-                    usuario_id=usuario_id,
-                    fecha=fecha,
-                    hora=hora,
-                    sistolica=sistolica,
-                    diastolica=diastolica
-                )
-            except (ValueError, TypeError):
-                print("Error: Valores de presión arterial inválidos")
-                return jsonify({"msg": "Valores de presión arterial inválidos"}), 400
-
-        elif tipo == 'oxigenacion':
-            try:
-                valor = int(data.get('valor'))
-                if valor < 0 or valor > 100:
-                    print("Error: Valor de oxigenación fuera de rango")
-                    return jsonify({"msg": "El valor de oxigenación debe estar entre 0 y 100"}), 400
-                registro = Oxigenacion(usuario_id=usuario_id, fecha=fecha, hora=hora, valor=valor)
-            except (ValueError, TypeError):
-                print("Error: Valor de oxigenación inválido")
-                return jsonify({"msg": "Valor de oxigenación inválido"}), 400
-
-        elif tipo == 'frecuencia_cardiaca':
-            try:
-                valor = int(data.get('valor'))
-                if valor < 0 or valor > 300:
-                    print("Error: Valor de frecuencia cardíaca fuera de rango")
-                    return jsonify({"msg": "El valor de frecuencia cardíaca debe estar entre 0 y 300"}), 400
-                registro = FrecuenciaCardiaca(usuario_id=usuario_id, fecha=fecha, hora=hora, valor=valor)
-            except (ValueError, TypeError):
-                print("Error: Valor de frecuencia cardíaca inválido")
-                return jsonify({"msg": "Valor de frecuencia cardíaca inválido"}), 400
-
-        else:
+        if tipo not in RANGOS_LECTURA:
             print("Error: Tipo de registro inválido")
             return jsonify({"msg": "Tipo de registro inválido"}), 400
 
+        # Mismos rangos que la ingesta en streaming
+        lectura, error = validar_lectura(tipo, data)
+        if error:
+            print(f"Error: {error}")
+            return jsonify({"msg": error}), 400
+        fecha, hora = lectura['fecha'], lectura['hora']
+        registro = METRICAS[tipo][0](usuario_id=usuario_id, **lectura)
+
+        # Con reglas de alerta de glucosa activas el aviso lo da el motor de reglas: un solo push por lectura
+        if tipo == 'glucosa' and not motor_reglas.tiene_reglas(usuario_id, 'glucosa'):
+            valor = lectura['valor']
+            nivel = 'Normal' if 70 <= valor <= 180 else 'Bajo' if valor < 70 else 'Alto'
+            aviso_nivel = f'Tu glucosa está en nivel {nivel.lower()} ({valor} mg/dL)'
+            db.session.add(Notificacion(
+                usuario_id=usuario_id,
+                mensaje=aviso_nivel,
+                fecha=fecha,
+                hora=hora,
+            ))
+
         db.session.add(registro)
         db.session.commit()
         print(f"Registro creado para usuario: {usuario_id}, tipo: {tipo}")
 
+        if aviso_nivel:
+            enviar_notificacion_fcm(usuario_id, 'WHS Medicine - Glucosa', aviso_nivel, None)
+
+        try:
+            lectura = {campo: getattr(registro, campo) for campo in METRICAS[tipo][1]}
+            emitir_alertas(usuario_id, tipo, motor_reglas.evaluar(usuario_id, tipo, [lectura]), fecha, hora)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al evaluar reglas de alerta: {str(e)}")
+
         hoy = fecha
         total_registros = (
             db.session.query(Glucosa).filter_by(usuario_id=usuario_id, fecha=hoy).count() +
@@ -394,8 +1637,9 @@ def crear_registro():
         return jsonify({"msg": f"Error procesando la solicitud: {str(e)}"}), 422
 
 
-@app.route('/api/notificaciones', methods=['GET'])
+@api.route('/api/notificaciones', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_notificaciones():
     usuario_id = get_jwt_identity()
     notificaciones = Notificacion.query.filter_by(usuario_id=usuario_id).order_by(
@@ -410,9 +1654,9 @@ def obtener_notificaciones():
         "delete_request_id": n.delete_request_id if n.delete_request_id else None
     } for n in notificaciones]
     print(f"Notificaciones obtenidas para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
+    return responder_lista(resultado)
 
-@app.route('/api/glucosas/<int:id>', methods=['DELETE'])
+@api.route('/api/glucosas/<int:id>', methods=['DELETE'])
 @jwt_required()
 def eliminar_glucosa(id):
     usuario_id = get_jwt_identity()
@@ -454,7 +1698,8 @@ def eliminar_glucosa(id):
         print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
         return jsonify({"msg": "Error al enviar notificación"}), 500
 
-@app.route('/api/confirm_delete', methods=['POST'])
+@api.route('/api/confirm_delete', methods=['POST'])
+@limitar('confirmar_eliminacion')
 @jwt_required()
 def confirm_delete():
     usuario_id = get_jwt_identity()
@@ -476,6 +1721,12 @@ def confirm_delete():
         print(f"Notificación no encontrada para delete_request_id: {delete_request_id}, usuario_id: {usuario_id}")
         return jsonify({"msg": "Solicitud de eliminación no encontrada"}), 404
 
+    elementos = db.session.query(ElementoEliminacion.tipo, ElementoEliminacion.registro_id).filter_by(
+        usuario_id=int(usuario_id), delete_request_id=delete_request_id
+    ).all()
+    if elementos:
+        return confirmar_eliminacion_lote(int(usuario_id), notificacion, elementos)
+
     try:
         print(f"Mensaje de notificación: {notificacion.mensaje}")
         id_str = notificacion.mensaje.split('(ID: ')[1].split(')')[0].strip()
@@ -539,7 +1790,7 @@ def confirm_delete():
         print(f"Error al eliminar registro de {tipo}: {str(e)}")
         return jsonify({"msg": f"Error al eliminar registro: {str(e)}"}), 500
 
-@app.route('/api/presiones_arteriales/<int:id>', methods=['DELETE'])
+@api.route('/api/presiones_arteriales/<int:id>', methods=['DELETE'])
 @jwt_required()
 def eliminar_presion_arterial(id):
     usuario_id = get_jwt_identity()
@@ -581,7 +1832,7 @@ def eliminar_presion_arterial(id):
         print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
         return jsonify({"msg": "Error al enviar notificación"}), 500
 
-@app.route('/api/oxigenaciones/<int:id>', methods=['DELETE'])
+@api.route('/api/oxigenaciones/<int:id>', methods=['DELETE'])
 @jwt_required()
 def eliminar_oxigenacion(id):
     usuario_id = get_jwt_identity()
@@ -623,7 +1874,7 @@ def eliminar_oxigenacion(id):
         print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
         return jsonify({"msg": "Error al enviar notificación"}), 500
 
-@app.route('/api/frecuencias_cardiacas/<int:id>', methods=['DELETE'])
+@api.route('/api/frecuencias_cardiacas/<int:id>', methods=['DELETE'])
 @jwt_required()
 def eliminar_frecuencia_cardiaca(id):
     usuario_id = get_jwt_identity()
@@ -665,7 +1916,7 @@ def eliminar_frecuencia_cardiaca(id):
         print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
         return jsonify({"msg": "Error al enviar notificación"}), 500
 
-@app.route('/api/medicamentos/<int:id>', methods=['DELETE'])
+@api.route('/api/medicamentos/<int:id>', methods=['DELETE'])
 @jwt_required()
 def eliminar_medicamento(id):
     usuario_id = get_jwt_identity()
@@ -707,11 +1958,13 @@ def eliminar_medicamento(id):
         print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
         return jsonify({"msg": "Error al enviar notificación"}), 500
 
-@app.route('/api/glucosas', methods=['GET'])
+@api.route('/api/glucosas', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_glucosas():
     usuario_id = get_jwt_identity()
     fecha_str = request.args.get('fecha')
+    fecha = None
 
     query = Glucosa.query.filter_by(usuario_id=usuario_id)
     if fecha_str:
@@ -730,27 +1983,38 @@ def obtener_glucosas():
         "valor": float(g.valor),
         "fecha_creacion": g.fecha_creacion.isoformat()
     } for g in glucosas]
+    resultado = combinar_con_archivo(resultado, usuario_id, 'glucosa', fecha, fecha)
     print(f"Glucosas obtenidas para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
+    return responder_lista(resultado)
 
 
-@app.route('/api/medicamentos', methods=['GET'])
+@api.route('/api/medicamentos', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_medicamentos():
     usuario_id = get_jwt_identity()
     fecha_str = request.args.get('fecha')
 
-    if not fecha_str:
+    if not fecha_str and not (request.args.get('desde') and request.args.get('hasta')):
         print("Fecha no proporcionada en obtener_medicamentos")
-        return jsonify({"msg": "Fecha es requerida (YYYY-MM-DD)"}), 400
+        return jsonify({"msg": "Fecha (YYYY-MM-DD) o desde y hasta son requeridos"}), 400
 
     try:
-        fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
+        if fecha_str:
+            desde = hasta = datetime.strptime(fecha_str, '%Y-%m-%d').date()
+        else:
+            desde, hasta = leer_rango_fechas()
     except ValueError:
-        print(f"Formato de fecha inválido: {fecha_str}")
+        print(f"Formato de fecha inválido: fecha={fecha_str}, desde={request.args.get('desde')}, hasta={request.args.get('hasta')}")
         return jsonify({"msg": "Formato de fecha inválido"}), 400
+    if (hasta - desde).days > MAX_DIAS_OCURRENCIAS:
+        return jsonify({"msg": f"El rango máximo es de {MAX_DIAS_OCURRENCIAS} días"}), 400
 
-    medicamentos = Medicamento.query.filter_by(usuario_id=usuario_id, fecha=fecha).all()
+    medicamentos = Medicamento.query.filter(
+        Medicamento.usuario_id == usuario_id,
+        Medicamento.fecha >= desde,
+        Medicamento.fecha <= hasta,
+    ).order_by(Medicamento.fecha, Medicamento.hora_toma).all()
     resultado = [{
         "id": m.id,
         "nombre": m.nombre,
@@ -759,9 +2023,19 @@ def obtener_medicamentos():
         "fecha": m.fecha.isoformat(),
         "sintomas": m.sintomas
     } for m in medicamentos]
-    print(f"Medicamentos obtenidos para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
-@app.route('/api/glucosas/<int:id>', methods=['PUT'])
+    print(f"Medicamentos obtenidos para usuario_id: {usuario_id}, desde: {desde}, hasta: {hasta}, total: {len(resultado)}")
+    if fecha_str:
+        return responder_lista(resultado)
+
+    # En el rango también van las tomas de las pautas recurrentes (con pauta_id y si ya se tomaron)
+    resultado += ocurrencias_pautas(usuario_id, desde, hasta)
+    resultado.sort(key=lambda m: (m["fecha"], m["hora_toma"]))
+    dias = {}
+    for m in resultado:
+        dias.setdefault(m["fecha"], []).append(m)
+    return jsonify({"desde": desde.isoformat(), "hasta": hasta.isoformat(), "dias": dias}), 200
+
+@api.route('/api/glucosas/<int:id>', methods=['PUT'])
 @jwt_required()
 def actualizar_glucosa(id):
     usuario_id = get_jwt_identity()
@@ -806,7 +2080,7 @@ def actualizar_glucosa(id):
         print(f"Error al actualizar glucosa: {str(e)}")
         return jsonify({"msg": f"Error al actualizar registro: {str(e)}"}), 500
     
-@app.route('/api/presiones_arteriales/<int:id>', methods=['PUT'])
+@api.route('/api/presiones_arteriales/<int:id>', methods=['PUT'])
 @jwt_required()
 def actualizar_presion_arterial(id):
     usuario_id = get_jwt_identity()
@@ -852,7 +2126,7 @@ def actualizar_presion_arterial(id):
         print(f"Error al actualizar presión arterial: {str(e)}")
         return jsonify({"msg": f"Error al actualizar registro: {str(e)}"}), 500
 
-@app.route('/api/oxigenaciones/<int:id>', methods=['PUT'])
+@api.route('/api/oxigenaciones/<int:id>', methods=['PUT'])
 @jwt_required()
 def actualizar_oxigenacion(id):
     usuario_id = get_jwt_identity()
@@ -896,7 +2170,7 @@ def actualizar_oxigenacion(id):
         print(f"Error al actualizar oxigenación: {str(e)}")
         return jsonify({"msg": f"Error al actualizar registro: {str(e)}"}), 500
 
-@app.route('/api/frecuencias_cardiacas/<int:id>', methods=['PUT'])
+@api.route('/api/frecuencias_cardiacas/<int:id>', methods=['PUT'])
 @jwt_required()
 def actualizar_frecuencia_cardiaca(id):
     usuario_id = get_jwt_identity()
@@ -941,8 +2215,10 @@ def actualizar_frecuencia_cardiaca(id):
         print(f"Error al actualizar frecuencia cardíaca: {str(e)}")
         return jsonify({"msg": f"Error al actualizar registro: {str(e)}"}), 500
 
-@app.route('/api/medicamentos', methods=['POST'])
+@api.route('/api/medicamentos', methods=['POST'])
+@limitar('escritura')
 @jwt_required()
+@idempotente
 def crear_medicamento():
     usuario_id = get_jwt_identity()
     data = request.get_json()
@@ -983,7 +2259,7 @@ def crear_medicamento():
         print(f"Error al crear medicamento: {str(e)}")
         return jsonify({"msg": f"Error al crear medicamento: {str(e)}"}), 500
 
-@app.route('/api/medicamentos/<int:id>', methods=['PUT'])
+@api.route('/api/medicamentos/<int:id>', methods=['PUT'])
 @jwt_required()
 def actualizar_medicamento(id):
     usuario_id = get_jwt_identity()
@@ -1024,46 +2300,77 @@ def actualizar_medicamento(id):
         print(f"Error al actualizar medicamento: {str(e)}")
         return jsonify({"msg": f"Error al actualizar medicamento: {str(e)}"}), 500
 
-@app.route('/api/smartwatch/<int:usuario_id>', methods=['GET'])
-def datos_smartwatch(usuario_id):
+def ultimos_signos(usuario_id):
     glucosa = Glucosa.query.filter_by(usuario_id=usuario_id).order_by(Glucosa.fecha.desc(), Glucosa.hora.desc()).first()
     presion = PresionArterial.query.filter_by(usuario_id=usuario_id).order_by(PresionArterial.fecha.desc(), PresionArterial.hora.desc()).first()
     oxigenacion = Oxigenacion.query.filter_by(usuario_id=usuario_id).order_by(Oxigenacion.fecha.desc(), Oxigenacion.hora.desc()).first()
     frecuencia = FrecuenciaCardiaca.query.filter_by(usuario_id=usuario_id).order_by(FrecuenciaCardiaca.fecha.desc(), FrecuenciaCardiaca.hora.desc()).first()
+    # Las muestras de streaming aún sin volcar también cuentan como última lectura
+    oxigenacion = _mas_reciente(oxigenacion, buffer_streaming().ultima(usuario_id, 'oxigenacion'))
+    frecuencia = _mas_reciente(frecuencia, buffer_streaming().ultima(usuario_id, 'frecuencia_cardiaca'))
+    return glucosa, presion, oxigenacion, frecuencia
 
-    if not any([glucosa, presion, oxigenacion, frecuencia]):
-        print(f"No hay registros para usuario_id: {usuario_id}")
-        return jsonify({"msg": "No hay registros para este usuario"}), 404
+def _mas_reciente(registro, pendiente):
+    if pendiente is None or (registro is not None and (registro.fecha, registro.hora) >= (pendiente.fecha, pendiente.hora)):
+        return registro
+    return pendiente
 
-    response = {
+def _resumen_signos(usuario_id):
+    glucosa, presion, oxigenacion, frecuencia = ultimos_signos(usuario_id)
+    if not any([glucosa, presion, oxigenacion, frecuencia]):
+        return None
+    return {
         "presion_arterial": f"{presion.sistolica}/{presion.diastolica} mmHg" if presion else "N/A",
         "oxigenacion": f"{oxigenacion.valor}%" if oxigenacion else "N/A",
         "glucosa": f"{glucosa.valor} mg/dL" if glucosa else "N/A",
         "frecuencia_cardiaca": f"{frecuencia.valor} bpm" if frecuencia else "N/A"
     }
+
+@api.route('/api/smartwatch/<int:usuario_id>', methods=['GET'])
+@token_dispositivo('smartwatch')
+@limitar('dispositivo')
+@lectura_replica
+def datos_smartwatch(usuario_id):
+    response = _resumen_signos(usuario_id)
+    if response is None:
+        print(f"No hay registros para usuario_id: {usuario_id}")
+        return jsonify({"msg": "No hay registros para este usuario"}), 404
     print(f"Datos de smartwatch obtenidos para usuario_id: {usuario_id}")
     return jsonify(response), 200
 
-@app.route('/api/tv/salud/<int:usuario_id>', methods=['GET'])
+@api.route('/api/tv/salud/<int:usuario_id>', methods=['GET'])
+@token_dispositivo('tv')
+@limitar('dispositivo')
+@lectura_replica
 def datos_tv_salud(usuario_id):
-    glucosa = Glucosa.query.filter_by(usuario_id=usuario_id).order_by(Glucosa.fecha.desc(), Glucosa.hora.desc()).first()
-    presion = PresionArterial.query.filter_by(usuario_id=usuario_id).order_by(PresionArterial.fecha.desc(), PresionArterial.hora.desc()).first()
-    oxigenacion = Oxigenacion.query.filter_by(usuario_id=usuario_id).order_by(Oxigenacion.fecha.desc(), Oxigenacion.hora.desc()).first()
-    frecuencia = FrecuenciaCardiaca.query.filter_by(usuario_id=usuario_id).order_by(FrecuenciaCardiaca.fecha.desc(), FrecuenciaCardiaca.hora.desc()).first()
-
-    if not any([glucosa, presion, oxigenacion, frecuencia]):
+    response = _resumen_signos(usuario_id)
+    if response is None:
         print(f"No hay registros para usuario_id: {usuario_id}")
         return jsonify({"msg": "No hay registros para este usuario"}), 404
-
-    response = {
-        "presion_arterial": f"{presion.sistolica}/{presion.diastolica} mmHg" if presion else "N/A",
-        "oxigenacion": f"{oxigenacion.valor}%" if oxigenacion else "N/A",
-        "glucosa": f"{glucosa.valor} mg/dL" if glucosa else "N/A",
-        "frecuencia_cardiaca": f"{frecuencia.valor} bpm" if frecuencia else "N/A"
-    }
     print(f"Datos de TV salud obtenidos para usuario_id: {usuario_id}")
     return jsonify(response), 200
-@app.route('/api/logout', methods=['POST'])
+
+@api.route('/api/dispositivos/token', methods=['POST'])
+@jwt_required()
+def emitir_token_dispositivo():
+    usuario_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    alcance = data.get('alcance')
+    if alcance not in ALCANCES_DISPOSITIVO:
+        return jsonify({"msg": "alcance debe ser smartwatch o tv"}), 400
+    try:
+        duracion = int(data.get('duracion', DURACION_TOKEN_DISPOSITIVO))
+    except (ValueError, TypeError):
+        return jsonify({"msg": "duracion inválida"}), 400
+    duracion = max(60, min(duracion, MAX_DURACION_TOKEN_DISPOSITIVO))
+    token, expira = crear_token_dispositivo(usuario_id, alcance, duracion)
+    print(f"Token de dispositivo emitido para usuario_id: {usuario_id}, alcance: {alcance}")
+    # usuario_id para que el dispositivo construya la ruta de lectura (/api/tv/salud/<usuario_id>)
+    return jsonify({
+        "token": token, "usuario_id": int(usuario_id), "expira": datetime.utcfromtimestamp(expira).isoformat()
+    }), 200
+
+@api.route('/api/logout', methods=['POST'])
 @jwt_required()
 def logout():
     usuario_id = get_jwt_identity()
@@ -1088,7 +2395,7 @@ def logout():
         db.session.rollback()
         print(f"Error al cerrar sesión: {str(e)}")
         return jsonify({"msg": f"Error al cerrar sesión: {str(e)}"}), 500
-@app.route('/api/salud/normales', methods=['GET'])
+@api.route('/api/salud/normales', methods=['GET'])
 def valores_normales():
     info = {
         "Presion Arterial": "120/80 mmHg (normal)",
@@ -1098,11 +2405,13 @@ def valores_normales():
     }
     print("Valores normales de salud devueltos")
     return jsonify(info), 200
-@app.route('/api/frecuencias_cardiacas', methods=['GET'])
+@api.route('/api/frecuencias_cardiacas', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_frecuencias_cardiacas():
     usuario_id = get_jwt_identity()
     fecha_str = request.args.get('fecha')
+    fecha = None
 
     query = FrecuenciaCardiaca.query.filter_by(usuario_id=usuario_id)
     if fecha_str:
@@ -1121,13 +2430,16 @@ def obtener_frecuencias_cardiacas():
         "valor": int(f.valor),
         "fecha_creacion": f.fecha_creacion.isoformat()
     } for f in frecuencias]
+    resultado = combinar_con_archivo(resultado, usuario_id, 'frecuencia_cardiaca', fecha, fecha)
     print(f"Frecuencias cardíacas obtenidas para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
-@app.route('/api/presiones_arteriales', methods=['GET'])
+    return responder_lista(resultado)
+@api.route('/api/presiones_arteriales', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_presiones_arteriales():
     usuario_id = get_jwt_identity()
     fecha_str = request.args.get('fecha')
+    fecha = None
 
     query = PresionArterial.query.filter_by(usuario_id=usuario_id)
     if fecha_str:
@@ -1147,14 +2459,17 @@ def obtener_presiones_arteriales():
         "diastolica": int(p.diastolica),
         "fecha_creacion": p.fecha_creacion.isoformat()
     } for p in presiones]
+    resultado = combinar_con_archivo(resultado, usuario_id, 'presion_arterial', fecha, fecha)
     print(f"Presiones arteriales obtenidas para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
+    return responder_lista(resultado)
 
-@app.route('/api/oxigenaciones', methods=['GET'])
+@api.route('/api/oxigenaciones', methods=['GET'])
 @jwt_required()
+@lectura_replica
 def obtener_oxigenaciones():
     usuario_id = get_jwt_identity()
     fecha_str = request.args.get('fecha')
+    fecha = None
 
     query = Oxigenacion.query.filter_by(usuario_id=usuario_id)
     if fecha_str:
@@ -1173,10 +2488,2764 @@ def obtener_oxigenaciones():
         "valor": int(o.valor),
         "fecha_creacion": o.fecha_creacion.isoformat()
     } for o in oxigenaciones]
+    resultado = combinar_con_archivo(resultado, usuario_id, 'oxigenacion', fecha, fecha)
     print(f"Oxigenaciones obtenidas para usuario_id: {usuario_id}, total: {len(resultado)}")
-    return jsonify(resultado), 200
+    return responder_lista(resultado)
+
+# SERIES TEMPORALES
+# Modelo y columnas numéricas de cada tipo de registro de salud
+METRICAS = {
+    'glucosa': (Glucosa, ('valor',)),
+    'presion_arterial': (PresionArterial, ('sistolica', 'diastolica')),
+    'oxigenacion': (Oxigenacion, ('valor',)),
+    'frecuencia_cardiaca': (FrecuenciaCardiaca, ('valor',)),
+}
+
+INTERVALOS_SERIE = {'hora': 3600, 'dia': 86400, 'semana': 7 * 86400}
+PUNTOS_SERIE_DEFECTO = 500
+MAX_PUNTOS_SERIE = 2000
+_ORDINAL_EPOCH = date(1970, 1, 1).toordinal()
+_DESFASE_SEMANA = 3 * 86400  # 1970-01-01 fue jueves; las semanas empiezan en lunes
+
+def leer_rango_fechas():
+    desde_str = request.args.get('desde')
+    hasta_str = request.args.get('hasta')
+    desde = datetime.strptime(desde_str, '%Y-%m-%d').date() if desde_str else None
+    hasta = datetime.strptime(hasta_str, '%Y-%m-%d').date() if hasta_str else None
+    if desde and hasta and desde > hasta:
+        raise ValueError('desde es posterior a hasta')
+    return desde, hasta
+
+def cargar_serie(usuario_id, tipo, desde=None, hasta=None):
+    # Devuelve (timestamps en segundos, {campo: valores}) ordenados por fecha y hora
+    modelo, campos = METRICAS[tipo]
+    query = db.session.query(modelo.fecha, modelo.hora, *[getattr(modelo, c) for c in campos]).filter(
+        modelo.usuario_id == usuario_id
+    )
+    if desde:
+        query = query.filter(modelo.fecha >= desde)
+    if hasta:
+        query = query.filter(modelo.fecha <= hasta)
+    filas = query.order_by(modelo.fecha, modelo.hora).all()
+
+    n = len(filas)
+    if n == 0:
+        ts, valores = np.empty(0, dtype=np.int64), {c: np.empty(0, dtype=np.float64) for c in campos}
+    else:
+        columnas = list(zip(*filas))
+        dias = np.fromiter((f.toordinal() for f in columnas[0]), dtype=np.int64, count=n) - _ORDINAL_EPOCH
+        segundos = np.fromiter((h.hour * 3600 + h.minute * 60 + h.second for h in columnas[1]), dtype=np.int64, count=n)
+        ts = dias * 86400 + segundos
+        valores = {c: np.asarray(columnas[2 + i], dtype=np.float64) for i, c in enumerate(campos)}
+
+    archivadas = leer_archivo(usuario_id, tipo, desde, hasta)
+    if archivadas.size:
+        ts = np.concatenate([archivadas['ts'], ts])
+        valores = {c: np.concatenate([archivadas[c].astype(np.float64), v]) for c, v in valores.items()}
+        orden = np.argsort(ts, kind='stable')
+        ts, valores = ts[orden], {c: v[orden] for c, v in valores.items()}
+    return ts, valores
+
+def agregar_serie(ts, valores, intervalo):
+    # Agrupa una serie ordenada en cubetas de hora/día/semana con min, max, promedio y conteo
+    ancho = INTERVALOS_SERIE[intervalo]
+    desfase = _DESFASE_SEMANA if intervalo == 'semana' else 0
+    if ts.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), {}
+    cubetas = (ts + desfase) // ancho
+    inicios = np.flatnonzero(np.r_[True, cubetas[1:] != cubetas[:-1]])
+    conteos = np.diff(np.r_[inicios, ts.size])
+    estadisticas = {}
+    for campo, v in valores.items():
+        estadisticas[campo] = {
+            'min': np.minimum.reduceat(v, inicios),
+            'max': np.maximum.reduceat(v, inicios),
+            'promedio': np.add.reduceat(v, inicios) / conteos,
+        }
+    return cubetas[inicios] * ancho - desfase, conteos, estadisticas
+
+def lttb(x, y, puntos):
+    # Largest-Triangle-Three-Buckets: índices de los puntos que conservan la forma de la serie
+    n = x.size
+    if puntos >= n or puntos < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    indices = np.empty(puntos, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    limites = np.linspace(1, n - 1, puntos - 1).astype(np.int64)
+    a = 0
+    for i in range(puntos - 2):
+        ini, fin = limites[i], limites[i + 1]
+        sig_fin = limites[i + 2] if i + 2 < puntos - 1 else n
+        prom_x = x[fin:sig_fin].mean()
+        prom_y = y[fin:sig_fin].mean()
+        areas = np.abs((x[a] - prom_x) * (y[ini:fin] - y[a]) - (x[a] - x[ini:fin]) * (prom_y - y[a]))
+        a = ini + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices
+
+def _ts_a_fecha_hora(ts):
+    dt = datetime.utcfromtimestamp(int(ts))
+    return dt.date().isoformat(), dt.time().strftime('%H:%M:%S')
+
+@api.route('/api/series/<tipo>', methods=['GET'])
+@jwt_required()
+@lectura_replica
+def obtener_serie(tipo):
+    usuario_id = get_jwt_identity()
+    if tipo not in METRICAS:
+        print(f"Tipo de serie inválido: {tipo}")
+        return jsonify({"msg": "Tipo de registro inválido"}), 400
+    try:
+        desde, hasta = leer_rango_fechas()
+    except ValueError:
+        print(f"Rango de fechas inválido: desde={request.args.get('desde')}, hasta={request.args.get('hasta')}")
+        return jsonify({"msg": "Formato de fecha inválido"}), 400
+    intervalo = request.args.get('intervalo')
+    if intervalo and intervalo not in INTERVALOS_SERIE:
+        print(f"Intervalo inválido: {intervalo}")
+        return jsonify({"msg": "Intervalo inválido (hora, dia o semana)"}), 400
+    try:
+        puntos = int(request.args.get('puntos', PUNTOS_SERIE_DEFECTO))
+    except ValueError:
+        return jsonify({"msg": "Número de puntos inválido"}), 400
+    puntos = max(3, min(puntos, MAX_PUNTOS_SERIE))
+
+    ts, valores = cargar_serie(usuario_id, tipo, desde, hasta)
+    campo_principal = METRICAS[tipo][1][0]
+
+    if intervalo:
+        inicios, conteos, estadisticas = agregar_serie(ts, valores, intervalo)
+        seleccion = lttb(inicios, estadisticas[campo_principal]['promedio'], puntos) if inicios.size else inicios
+        resultado = []
+        for i in seleccion:
+            fecha, hora = _ts_a_fecha_hora(inicios[i])
+            punto = {"fecha": fecha, "hora": hora, "conteo": int(conteos[i])}
+            for campo, est in estadisticas.items():
+                punto[campo] = {
+                    "min": float(est['min'][i]),
+                    "max": float(est['max'][i]),
+                    "promedio": round(float(est['promedio'][i]), 2),
+                }
+            resultado.append(punto)
+    else:
+        seleccion = lttb(ts, valores[campo_principal], puntos) if ts.size else ts
+        resultado = []
+        for i in seleccion:
+            fecha, hora = _ts_a_fecha_hora(ts[i])
+            punto = {"fecha": fecha, "hora": hora}
+            for campo, v in valores.items():
+                punto[campo] = float(v[i])
+            resultado.append(punto)
+
+    print(f"Serie de {tipo} obtenida para usuario_id: {usuario_id}, lecturas: {ts.size}, puntos: {len(resultado)}")
+    return jsonify({
+        "tipo": tipo,
+        "intervalo": intervalo,
+        "total_lecturas": int(ts.size),
+        "puntos": resultado
+    }), 200
+
+# ALMACENAMIENTO EN FRÍO
+# Los meses completos más antiguos que MESES_EN_CALIENTE salen de las tablas a un fichero .npy por usuario, tipo y mes
+# (<MEDNOTIFY_ARCHIVO_DIR>/<tipo>/<usuario_id>/<AAAA-MM>.npy). No se usa np.savez_compressed: los miembros de un .npz
+# no admiten mmap y cada consulta de historial descomprimiría el mes entero (y al archivar, también el mes previo
+# para fusionarlo); con .npy sin comprimir se abre con mmap y se leen solo las páginas del rango pedido por
+# searchsorted. Para ahorrar espacio se usan tipos compactos: float32 para glucosa e int32 para el resto (int16
+# desbordaría con valores por encima de 32767, p. ej. una presión sin límite superior en validar_lectura).
+# Las lecturas archivadas ya no se pueden editar ni borrar por id.
+MESES_EN_CALIENTE = 12
+
+def _dtype_archivo(tipo):
+    campos = METRICAS[tipo][1]
+    tipo_valor = np.float32 if tipo == 'glucosa' else np.int32
+    return np.dtype([('id', np.int64), ('ts', np.int64)] + [(c, tipo_valor) for c in campos] + [('creado_us', np.int64)])
+
+def _dir_archivo(tipo, usuario_id):
+    return os.path.join(current_app.config['ARCHIVO_DIR'], tipo, str(int(usuario_id)))
+
+def _inicio_mes(fecha, meses=0):
+    total = fecha.year * 12 + fecha.month - 1 + meses
+    return date(total // 12, total % 12 + 1, 1)
+
+def _ts_de(fecha, hora):
+    return (fecha.toordinal() - _ORDINAL_EPOCH) * 86400 + hora.hour * 3600 + hora.minute * 60 + hora.second
+
+def leer_archivo(usuario_id, tipo, desde=None, hasta=None):
+    # Concatena los meses archivados que tocan [desde, hasta]; ordenado por ts
+    directorio = _dir_archivo(tipo, usuario_id)
+    if not os.path.isdir(directorio):
+        return np.empty(0, dtype=_dtype_archivo(tipo))
+    minimo = _ts_de(desde, datetime.min.time()) if desde else None
+    maximo = _ts_de(hasta, datetime.max.time().replace(microsecond=0)) if hasta else None
+    partes = []
+    for nombre in sorted(os.listdir(directorio)):
+        if not nombre.endswith('.npy'):
+            continue
+        mes = datetime.strptime(nombre[:-4], '%Y-%m').date()
+        if (desde and _inicio_mes(mes, 1) <= desde) or (hasta and mes > hasta):
+            continue
+        datos = np.load(os.path.join(directorio, nombre), mmap_mode='r')
+        inicio = np.searchsorted(datos['ts'], minimo, 'left') if minimo is not None else 0
+        fin = np.searchsorted(datos['ts'], maximo, 'right') if maximo is not None else datos.size
+        if fin > inicio:
+            # Los meses archivados antes del cambio a int32 se convierten al leerlos
+            partes.append(datos[inicio:fin].astype(_dtype_archivo(tipo), copy=False))
+    if not partes:
+        return np.empty(0, dtype=_dtype_archivo(tipo))
+    return np.concatenate(partes)
+
+def combinar_con_archivo(resultado, usuario_id, tipo, desde=None, hasta=None):
+    # Añade las lecturas archivadas a una respuesta de historial (más recientes primero)
+    archivadas = leer_archivo(usuario_id, tipo, desde, hasta)
+    if archivadas.size == 0:
+        return resultado
+    convertir = float if tipo == 'glucosa' else int
+    epoch = datetime(1970, 1, 1)
+    for fila in archivadas[::-1]:
+        ts = int(fila['ts'])
+        lectura = {"id": int(fila['id'])}
+        lectura["fecha"] = date.fromordinal(ts // 86400 + _ORDINAL_EPOCH).isoformat()
+        lectura["hora"] = f"{ts % 86400 // 3600:02d}:{ts % 3600 // 60:02d}:{ts % 60:02d}"
+        for campo in METRICAS[tipo][1]:
+            lectura[campo] = round(convertir(fila[campo]), 2)
+        lectura["fecha_creacion"] = (epoch + timedelta(microseconds=int(fila['creado_us']))).isoformat()
+        resultado.append(lectura)
+    resultado.sort(key=lambda r: (r['fecha'], r['hora']), reverse=True)
+    return resultado
+
+def _escribir_mes_archivo(ruta, nuevas):
+    # Fusiona con lo ya archivado (sin duplicar ids si un archivado anterior se interrumpió) y reemplaza de forma atómica
+    if os.path.exists(ruta):
+        nuevas = np.concatenate([np.load(ruta).astype(nuevas.dtype, copy=False), nuevas])
+        _, unicos = np.unique(nuevas['id'], return_index=True)
+        nuevas = nuevas[unicos]
+    nuevas = nuevas[np.argsort(nuevas['ts'], kind='stable')]
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta + '.tmp', 'wb') as f:
+        np.save(f, nuevas)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(ruta + '.tmp', ruta)
+
+def archivar_usuario(usuario_id, tipo, corte, lote):
+    modelo, campos = METRICAS[tipo]
+    primera = db.session.query(db.func.min(modelo.fecha)).filter(modelo.usuario_id == usuario_id, modelo.fecha < corte).scalar()
+    archivadas = 0
+    mes = _inicio_mes(primera) if primera else corte
+    while mes < corte:
+        siguiente = _inicio_mes(mes, 1)
+        filas = db.session.query(
+            modelo.id, modelo.fecha, modelo.hora, *[getattr(modelo, c) for c in campos], modelo.fecha_creacion
+        ).filter(modelo.usuario_id == usuario_id, modelo.fecha >= mes, modelo.fecha < siguiente).all()
+        if filas:
+            datos = np.empty(len(filas), dtype=_dtype_archivo(tipo))
+            columnas = list(zip(*filas))
+            datos['id'] = columnas[0]
+            datos['ts'] = [_ts_de(f, h) for f, h in zip(columnas[1], columnas[2])]
+            for i, campo in enumerate(campos):
+                datos[campo] = [float(v) for v in columnas[3 + i]]
+            datos['creado_us'] = [
+                (c - datetime(1970, 1, 1)) // timedelta(microseconds=1) if c else 0 for c in columnas[3 + len(campos)]
+            ]
+            _escribir_mes_archivo(os.path.join(_dir_archivo(tipo, usuario_id), f'{mes:%Y-%m}.npy'), datos)
+            # DELETE por lotes sin eventos del ORM: no son bajas para la sincronización, el cliente las conserva
+            ids = [int(i) for i in columnas[0]]
+            for inicio in range(0, len(ids), lote):
+                modelo.query.filter(modelo.id.in_(ids[inicio:inicio + lote])).delete(synchronize_session=False)
+                db.session.commit()
+            archivadas += len(ids)
+        db.session.commit()
+        mes = siguiente
+    if archivadas:
+        invalidar_cache_usuario(usuario_id)
+    return archivadas
+
+@api.cli.command('archivar-lecturas')
+@click.option('--meses', default=MESES_EN_CALIENTE, show_default=True, help='Meses completos que se quedan en las tablas')
+@click.option('--lote', default=5000, show_default=True, help='Filas borradas por DELETE')
+def archivar_lecturas(meses, lote):
+    corte = _inicio_mes(date.today(), -meses)
+    total = 0
+    for shard in nombres_shard():
+        with usar_shard(shard):
+            for tipo, (modelo, _) in METRICAS.items():
+                ultimo_usuario = 0
+                while True:
+                    usuarios = [u for (u,) in db.session.query(modelo.usuario_id).filter(
+                        modelo.fecha < corte, modelo.usuario_id > ultimo_usuario
+                    ).distinct().order_by(modelo.usuario_id).limit(1000)]
+                    if not usuarios:
+                        break
+                    for usuario_id in usuarios:
+                        if enrutador_shards().en_movimiento(usuario_id):
+                            continue  # se archiva en la siguiente ejecución, ya en su nuevo shard
+                        total += archivar_usuario(usuario_id, tipo, corte, lote)
+                    ultimo_usuario = usuarios[-1]
+                print(f"{tipo} ({shard}): archivado hasta {corte}, {total} lecturas en total")
+    print(f"Archivado completado: {total} lecturas anteriores a {corte}")
+
+# ANALÍTICA POR USUARIO
+RANGOS_NORMALES = {
+    'glucosa': {'valor': (70, 180)},
+    'presion_arterial': {'sistolica': (90, 139), 'diastolica': (60, 89)},
+    'oxigenacion': {'valor': (95, 100)},
+    'frecuencia_cardiaca': {'valor': (60, 100)},
+}
+CATEGORIAS_PRESION = ['normal', 'elevada', 'hipertension_1', 'hipertension_2', 'crisis']
+DIAS_ANALITICA_DEFECTO = 90
+TTL_CACHE_ANALITICA = 300
+MAX_CACHE_ANALITICA = 1024
+
+# La clave de la caché incluye secuencias_sync.valor del usuario: toda escritura en sus tablas lo incrementa en la
+# misma transacción, así que una escritura atendida por cualquier worker invalida la caché de todos.
+# invalidar_cache_usuario solo cubre cambios que no pasan por el registro de sync (archivado, purga, movimiento)
+_cache_analitica = OrderedDict()
+_version_usuario = {}
+_lock_analitica = threading.Lock()
+
+def invalidar_cache_usuario(usuario_id):
+    with _lock_analitica:
+        _version_usuario[int(usuario_id)] = _version_usuario.get(int(usuario_id), 0) + 1
+
+def _version_datos_usuario(usuario_id):
+    with usar_shard_de(usuario_id):
+        valor = db.session.execute(select(SecuenciaSync.valor).where(SecuenciaSync.usuario_id == usuario_id)).scalar()
+        db.session.commit()
+    return valor or 0
+
+def _estadisticas(v):
+    if v.size == 0:
+        return {"lecturas": 0}
+    return {
+        "lecturas": int(v.size),
+        "promedio": round(float(v.mean()), 2),
+        "desviacion": round(float(v.std()), 2),
+        "min": float(v.min()),
+        "max": float(v.max()),
+    }
+
+def _porcentaje(mascara):
+    return round(float(mascara.mean()) * 100, 2) if mascara.size else 0.0
+
+def _media_movil_diaria(ts, v, ventana):
+    # Media móvil ponderada por lecturas sobre días naturales (los días sin datos no cuentan)
+    if ts.size == 0:
+        return []
+    dias = ts // 86400
+    primero = int(dias[0])
+    offset = dias - primero
+    total_dias = int(offset[-1]) + 1
+    sumas = np.bincount(offset, weights=v, minlength=total_dias)
+    conteos = np.bincount(offset, minlength=total_dias).astype(np.float64)
+    sumas_acum = np.r_[0.0, np.cumsum(sumas)]
+    conteos_acum = np.r_[0.0, np.cumsum(conteos)]
+    inicio = np.maximum(np.arange(total_dias) - ventana + 1, 0)
+    suma_ventana = sumas_acum[1:] - sumas_acum[inicio]
+    conteo_ventana = conteos_acum[1:] - conteos_acum[inicio]
+    resultado = []
+    for i in np.flatnonzero(conteos):
+        resultado.append({
+            "fecha": date.fromordinal(_ORDINAL_EPOCH + primero + int(i)).isoformat(),
+            "promedio": round(float(suma_ventana[i] / conteo_ventana[i]), 2),
+        })
+    return resultado
+
+def _categorias_presion(sistolica, diastolica):
+    categoria = np.select(
+        [
+            (sistolica > 180) | (diastolica > 120),
+            (sistolica >= 140) | (diastolica >= 90),
+            (sistolica >= 130) | (diastolica >= 80),
+            sistolica >= 120,
+        ],
+        [4, 3, 2, 1],
+        default=0,
+    )
+    conteos = np.bincount(categoria, minlength=len(CATEGORIAS_PRESION))
+    total = max(int(sistolica.size), 1)
+    return {
+        nombre: {"lecturas": int(conteos[i]), "porcentaje": round(float(conteos[i]) * 100 / total, 2)}
+        for i, nombre in enumerate(CATEGORIAS_PRESION)
+    }
+
+def calcular_analitica(usuario_id, desde, hasta, ventana):
+    resultado = {}
+    for tipo, (_, campos) in METRICAS.items():
+        ts, valores = cargar_serie(usuario_id, tipo, desde, hasta)
+        metricas = {campo: _estadisticas(v) for campo, v in valores.items()}
+        metricas["media_movil"] = {campo: _media_movil_diaria(ts, v, ventana) for campo, v in valores.items()}
+        fuera = np.zeros(ts.size, dtype=bool)
+        for campo, (minimo, maximo) in RANGOS_NORMALES[tipo].items():
+            fuera |= (valores[campo] < minimo) | (valores[campo] > maximo)
+        metricas["porcentaje_fuera_rango"] = _porcentaje(fuera)
+
+        if tipo == 'glucosa':
+            v = valores['valor']
+            minimo, maximo = RANGOS_NORMALES['glucosa']['valor']
+            metricas["tiempo_en_rango"] = {
+                "muy_bajo": _porcentaje(v < 54),
+                "bajo": _porcentaje((v >= 54) & (v < minimo)),
+                "en_rango": _porcentaje((v >= minimo) & (v <= maximo)),
+                "alto": _porcentaje((v > maximo) & (v <= 250)),
+                "muy_alto": _porcentaje(v > 250),
+            }
+            if v.size and v.mean() > 0:
+                metricas["coeficiente_variacion"] = round(float(v.std() / v.mean()) * 100, 2)
+        elif tipo == 'presion_arterial':
+            metricas["categorias"] = _categorias_presion(valores['sistolica'], valores['diastolica'])
+        resultado[tipo] = metricas
+    return resultado
+
+@api.route('/api/analitica', methods=['GET'])
+@jwt_required()
+def obtener_analitica():
+    usuario_id = int(get_jwt_identity())
+    try:
+        desde, hasta = leer_rango_fechas()
+        ventana = int(request.args.get('ventana', 7))
+        if ventana < 1:
+            raise ValueError('ventana debe ser positiva')
+    except ValueError as e:
+        print(f"Parámetros de analítica inválidos: {str(e)}")
+        return jsonify({"msg": "Parámetros inválidos (desde, hasta en YYYY-MM-DD y ventana en días)"}), 400
+    hasta = hasta or datetime.utcnow().date()
+    desde = desde or hasta - timedelta(days=DIAS_ANALITICA_DEFECTO)
+
+    version = _version_datos_usuario(usuario_id)
+    with _lock_analitica:
+        clave = (usuario_id, desde, hasta, ventana, version, _version_usuario.get(usuario_id, 0))
+        entrada = _cache_analitica.get(clave)
+        if entrada and time.monotonic() - entrada[0] < TTL_CACHE_ANALITICA:
+            _cache_analitica.move_to_end(clave)
+            print(f"Analítica servida desde caché para usuario_id: {usuario_id}")
+            return jsonify(entrada[1]), 200
+
+    resultado = {"desde": desde.isoformat(), "hasta": hasta.isoformat(), "ventana": ventana}
+    resultado.update(calcular_analitica(usuario_id, desde, hasta, ventana))
+
+    with _lock_analitica:
+        _cache_analitica[clave] = (time.monotonic(), resultado)
+        _cache_analitica.move_to_end(clave)
+        while len(_cache_analitica) > MAX_CACHE_ANALITICA:
+            _cache_analitica.popitem(last=False)
+    print(f"Analítica calculada para usuario_id: {usuario_id}, desde: {desde}, hasta: {hasta}")
+    return jsonify(resultado), 200
+
+# ANALÍTICA POBLACIONAL (trabajo por lotes)
+# Las lecturas nuevas se cuentan por ids crecientes; las editadas o borradas (cambios_sync) recuentan al usuario.
+# Las cuentas purgadas salen con sus filas de resumen_diario_usuario.
+LOTE_USUARIOS_POBLACION = 1000
+MARGEN_CAMBIOS_POBLACION = timedelta(minutes=1)
+
+def _agregar_lote_poblacion(tipo, usuario_ids, fechas_ord, valores):
+    # Cuenta lecturas y lecturas fuera de rango por (usuario, día)
+    fuera = np.zeros(usuario_ids.size, dtype=bool)
+    for campo, (minimo, maximo) in RANGOS_NORMALES[tipo].items():
+        fuera |= (valores[campo] < minimo) | (valores[campo] > maximo)
+    claves = usuario_ids * 1_000_000 + fechas_ord
+    unicas, inversa = np.unique(claves, return_inverse=True)
+    lecturas = np.bincount(inversa)
+    fuera_rango = np.bincount(inversa, weights=fuera).astype(np.int64)
+    return unicas // 1_000_000, unicas % 1_000_000, lecturas, fuera_rango
+
+def _leer_lote_metrica(tipo, desde, hasta, ultimo_id, lote):
+    modelo, campos = METRICAS[tipo]
+    consulta = (
+        select(modelo.id, modelo.usuario_id, modelo.fecha, *[getattr(modelo, c) for c in campos])
+        .where(modelo.id > ultimo_id, modelo.fecha >= desde, modelo.fecha <= hasta)
+        .order_by(modelo.id)
+        .limit(lote)
+        .execution_options(stream_results=True)
+    )
+    filas = db.session.execute(consulta).all()
+    db.session.commit()  # no mantener la transacción (ni su snapshot) abierta entre lotes
+    if not filas:
+        return None
+    columnas = list(zip(*filas))
+    n = len(filas)
+    return (
+        int(columnas[0][-1]),
+        np.asarray(columnas[1], dtype=np.int64),
+        np.fromiter((f.toordinal() for f in columnas[2]), dtype=np.int64, count=n),
+        {c: np.asarray(columnas[3 + i], dtype=np.float64) for i, c in enumerate(campos)},
+    )
+
+def _sumar_resumenes(tipo, resultado):
+    usuario_ids, fechas_ord, lecturas, fuera_rango = resultado
+    fechas = [date.fromordinal(int(f)) for f in fechas_ord]
+    ids = sorted({int(u) for u in usuario_ids})
+    existentes = {}
+    # IN por tramos: un lote de 50000 lecturas puede tocar otros tantos usuarios
+    for inicio in range(0, len(ids), LOTE_USUARIOS_POBLACION):
+        existentes.update(((r.usuario_id, r.fecha), r) for r in ResumenDiarioUsuario.query.filter(
+            ResumenDiarioUsuario.tipo == tipo,
+            ResumenDiarioUsuario.usuario_id.in_(ids[inicio:inicio + LOTE_USUARIOS_POBLACION]),
+            ResumenDiarioUsuario.fecha.in_(set(fechas)),
+        ))
+    for i, fecha in enumerate(fechas):
+        usuario_id = int(usuario_ids[i])
+        fila = existentes.get((usuario_id, fecha))
+        if fila is None:
+            fila = ResumenDiarioUsuario(usuario_id=usuario_id, fecha=fecha, tipo=tipo, lecturas=0, fuera_rango=0)
+            db.session.add(fila)
+        fila.lecturas += int(lecturas[i])
+        fila.fuera_rango += int(fuera_rango[i])
+
+def _guardar_lote_poblacion(tipo, trabajo, ultimo_id, resultado):
+    _sumar_resumenes(tipo, resultado)
+    punto = db.session.get(PuntoControlTrabajo, trabajo) or PuntoControlTrabajo(trabajo=trabajo)
+    punto.ultimo_id = ultimo_id
+    db.session.add(punto)
+    # Los contadores y el punto de control se confirman juntos: al reanudar no se cuenta dos veces
+    db.session.commit()
+    db.session.expunge_all()
+
+def _recontar_usuarios_poblacion(tipo, shard, usuario_ids, desde, hasta, ultimo_id):
+    # Recuento desde cero de las lecturas ya contadas (id <= ultimo_id), incluidas las archivadas después
+    modelo, campos = METRICAS[tipo]
+    ResumenDiarioUsuario.query.filter(
+        ResumenDiarioUsuario.tipo == tipo,
+        ResumenDiarioUsuario.usuario_id.in_(usuario_ids),
+        ResumenDiarioUsuario.fecha >= desde,
+        ResumenDiarioUsuario.fecha <= hasta,
+    ).delete(synchronize_session=False)
+    with usar_shard(shard):
+        filas = db.session.execute(
+            select(modelo.usuario_id, modelo.fecha, *[getattr(modelo, c) for c in campos]).where(
+                modelo.usuario_id.in_(usuario_ids), modelo.id <= ultimo_id, modelo.fecha >= desde, modelo.fecha <= hasta
+            )
+        ).all()
+    columnas = list(zip(*filas)) or [()] * (2 + len(campos))
+    ids = [np.asarray(columnas[0], dtype=np.int64)]
+    fechas_ord = [np.fromiter((f.toordinal() for f in columnas[1]), dtype=np.int64, count=len(filas))]
+    valores = {c: [np.asarray(columnas[2 + i], dtype=np.float64)] for i, c in enumerate(campos)}
+    for usuario_id in usuario_ids:
+        archivadas = leer_archivo(usuario_id, tipo, desde, hasta)
+        archivadas = archivadas[archivadas['id'] <= ultimo_id]
+        ids.append(np.full(archivadas.size, usuario_id, dtype=np.int64))
+        fechas_ord.append(archivadas['ts'] // 86400 + _ORDINAL_EPOCH)
+        for c in campos:
+            valores[c].append(archivadas[c].astype(np.float64))
+    ids = np.concatenate(ids)
+    if ids.size:
+        valores = {c: np.concatenate(v) for c, v in valores.items()}
+        _sumar_resumenes(tipo, _agregar_lote_poblacion(tipo, ids, np.concatenate(fechas_ord).astype(np.int64), valores))
+
+def _aplicar_cambios_poblacion(shard, desde, hasta, trabajo, limite):
+    # Ediciones y bajas (cambios_sync 'u'/'d') posteriores al último pase: se recuenta a cada usuario afectado
+    cursor = db.session.get(PuntoControlTrabajo, trabajo).marca_tiempo
+    tablas = {METRICAS[tipo][0].__tablename__: tipo for tipo in METRICAS}
+    with usar_shard(shard):
+        cambios = db.session.query(CambioSync.usuario_id, CambioSync.tabla).filter(
+            CambioSync.tabla.in_(tablas),
+            CambioSync.operacion.in_(('u', 'd')),
+            CambioSync.fecha_creacion > cursor,
+            CambioSync.fecha_creacion <= limite,
+        ).distinct().all()
+    db.session.commit()
+    afectados = {}
+    for usuario_id, tabla in cambios:
+        afectados.setdefault(tablas[tabla], []).append(usuario_id)
+    for tipo, usuario_ids in afectados.items():
+        trabajo_tipo = f'poblacion:{tipo}:{desde}:{hasta}' + ('' if shard == SHARD_PRINCIPAL else f':{shard}')
+        contado = db.session.get(PuntoControlTrabajo, trabajo_tipo)
+        ultimo_id = contado.ultimo_id if contado else 0
+        usuario_ids.sort()
+        for inicio in range(0, len(usuario_ids), LOTE_USUARIOS_POBLACION):
+            # Cada tramo se confirma solo: repetir un recuento tras una caída da el mismo resultado
+            _recontar_usuarios_poblacion(tipo, shard, usuario_ids[inicio:inicio + LOTE_USUARIOS_POBLACION], desde, hasta, ultimo_id)
+            db.session.commit()
+            db.session.expunge_all()
+        print(f"{tipo} ({shard}): {len(usuario_ids)} usuarios recontados por ediciones o bajas")
+    db.session.get(PuntoControlTrabajo, trabajo).marca_tiempo = limite
+    db.session.commit()
+
+def _recalcular_poblacion(desde, hasta):
+    dias_fuera = db.func.sum(db.case((ResumenDiarioUsuario.fuera_rango > 0, 1), else_=0))
+    filas = db.session.query(
+        ResumenDiarioUsuario.fecha,
+        ResumenDiarioUsuario.tipo,
+        db.func.count(),
+        dias_fuera,
+        db.func.sum(ResumenDiarioUsuario.lecturas),
+        db.func.sum(ResumenDiarioUsuario.fuera_rango),
+    ).filter(
+        ResumenDiarioUsuario.fecha >= desde, ResumenDiarioUsuario.fecha <= hasta
+    ).group_by(ResumenDiarioUsuario.fecha, ResumenDiarioUsuario.tipo).all()
+
+    ResumenDiarioPoblacion.query.filter(
+        ResumenDiarioPoblacion.fecha >= desde, ResumenDiarioPoblacion.fecha <= hasta
+    ).delete(synchronize_session=False)
+    for fecha, tipo, usuarios, usuarios_fuera, lecturas, lecturas_fuera in filas:
+        db.session.add(ResumenDiarioPoblacion(
+            fecha=fecha,
+            tipo=tipo,
+            usuarios=int(usuarios),
+            usuarios_fuera_rango=int(usuarios_fuera or 0),
+            lecturas=int(lecturas or 0),
+            lecturas_fuera_rango=int(lecturas_fuera or 0),
+        ))
+    db.session.commit()
+    return len(filas)
+
+@api.cli.command('analitica-poblacion')
+@click.option('--desde', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--hasta', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--lote', default=50000, show_default=True, help='Filas leídas por consulta')
+@click.option('--reiniciar', is_flag=True, help='Descarta resultados y puntos de control previos del rango')
+def analitica_poblacion(desde, hasta, lote, reiniciar):
+    desde, hasta = desde.date(), hasta.date()
+    db.create_all()
+    if reiniciar:
+        ResumenDiarioUsuario.query.filter(
+            ResumenDiarioUsuario.fecha >= desde, ResumenDiarioUsuario.fecha <= hasta
+        ).delete(synchronize_session=False)
+        PuntoControlTrabajo.query.filter(
+            PuntoControlTrabajo.trabajo.like(f'poblacion:%:{desde}:{hasta}%')
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    # Los cambios confirmados hace menos de MARGEN_CAMBIOS_POBLACION pueden no ser visibles aún: quedan para la próxima
+    limite = datetime.utcnow() - MARGEN_CAMBIOS_POBLACION
+    # Sin pool de procesos: agregar un lote de 50000 lecturas con numpy cuesta ~2 ms frente a ~100 ms de leerlo y
+    # varios segundos de guardar los resúmenes, y ambas cosas son secuenciales por el punto de control
+    # Cada shard tiene su propia secuencia de ids y, por tanto, su propio punto de control
+    for shard in nombres_shard():
+        sufijo = '' if shard == SHARD_PRINCIPAL else f':{shard}'
+        trabajo_cambios = f'poblacion:cambios:{desde}:{hasta}{sufijo}'
+        if db.session.get(PuntoControlTrabajo, trabajo_cambios) is None:
+            # Primera ejecución: los cambios anteriores ya se ven en las filas que lee el pase por ids
+            db.session.add(PuntoControlTrabajo(trabajo=trabajo_cambios, marca_tiempo=limite))
+        db.session.commit()
+        for tipo in METRICAS:
+            trabajo = f'poblacion:{tipo}:{desde}:{hasta}{sufijo}'
+            punto = db.session.get(PuntoControlTrabajo, trabajo)
+            ultimo_id = punto.ultimo_id if punto else 0
+            print(f"Procesando {tipo} ({shard}) desde id > {ultimo_id}")
+            procesadas = 0
+            while True:
+                with usar_shard(shard):
+                    leido = _leer_lote_metrica(tipo, desde, hasta, ultimo_id, lote)
+                if leido is None:
+                    break
+                ultimo_id, usuario_ids, fechas_ord, valores = leido
+                _guardar_lote_poblacion(tipo, trabajo, ultimo_id, _agregar_lote_poblacion(tipo, usuario_ids, fechas_ord, valores))
+                procesadas += usuario_ids.size
+                print(f"{tipo}: {procesadas} lecturas procesadas (último id {ultimo_id})")
+        _aplicar_cambios_poblacion(shard, desde, hasta, trabajo_cambios, limite)
+
+    total = _recalcular_poblacion(desde, hasta)
+    print(f"Analítica poblacional completada: {total} agregados de {desde} a {hasta}")
+
+# MOTOR DE REGLAS DE ALERTA
+NOMBRES_METRICAS = {
+    'glucosa': 'Glucosa',
+    'presion_arterial': 'Presión arterial',
+    'oxigenacion': 'Oxigenación',
+    'frecuencia_cardiaca': 'Frecuencia cardíaca',
+}
+UNIDADES_METRICAS = {'glucosa': 'mg/dL', 'presion_arterial': 'mmHg', 'oxigenacion': '%', 'frecuencia_cardiaca': 'bpm'}
+INTERVALO_VERIFICACION_REGLAS = 30
+
+class TablaIntervalos:
+    # Intervalos [minimo, maximo) solapables compilados en segmentos disjuntos ordenados:
+    # cada segmento guarda las reglas que lo cubren y la búsqueda es un bisect, O(log n)
+    def __init__(self, reglas):
+        puntos = sorted({r[0] for r in reglas if r[0] is not None} | {r[1] for r in reglas if r[1] is not None})
+        self.limites = [float('-inf')] + puntos
+        self.segmentos = []
+        for inicio in self.limites:
+            self.segmentos.append(tuple(
+                r[2] for r in reglas
+                if (r[0] is None or r[0] <= inicio) and (r[1] is None or inicio < r[1])
+            ))
+
+    def buscar(self, valor):
+        return self.segmentos[bisect_right(self.limites, valor) - 1]
+
+class MotorReglas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tablas = {}
+        self._usuarios_compilados = set()
+        self._firma = None
+        self._verificado = 0.0
+
+    def invalidar(self):
+        with self._lock:
+            self._tablas = {}
+            self._usuarios_compilados = set()
+            self._firma = None
+
+    def _verificar_cambios(self):
+        # Detecta cambios hechos por otros procesos sin reiniciar el servidor
+        ahora = time.monotonic()
+        if self._firma is not None and ahora - self._verificado < INTERVALO_VERIFICACION_REGLAS:
+            return
+        firma = tuple(db.session.query(
+            db.func.count(ReglaAlerta.id), db.func.max(ReglaAlerta.fecha_actualizacion)
+        ).one())
+        with self._lock:
+            if firma != self._firma:
+                self._tablas = {}
+                self._usuarios_compilados = set()
+                self._firma = firma
+                self._cargar(None)
+            self._verificado = ahora
+
+    def _cargar(self, usuario_id):
+        reglas = ReglaAlerta.query.filter_by(usuario_id=usuario_id, activa=True).all()
+        agrupadas = {}
+        for regla in reglas:
+            info = {
+                "id": regla.id,
+                "tipo": regla.tipo,
+                "campo": regla.campo,
+                "mensaje": regla.mensaje,
+            }
+            agrupadas.setdefault((regla.tipo, regla.campo), []).append((regla.minimo, regla.maximo, info))
+        for (tipo, campo), intervalos in agrupadas.items():
+            self._tablas[(usuario_id, tipo, campo)] = TablaIntervalos(intervalos)
+        self._usuarios_compilados.add(usuario_id)
+
+    def _tabla(self, usuario_id, tipo, campo):
+        # Con el lock: invalidar() y _cargar() sustituyen o rellenan las tablas desde otros hilos
+        with self._lock:
+            if usuario_id not in self._usuarios_compilados:
+                self._cargar(usuario_id)
+            # Las reglas del usuario sustituyen a las globales para el mismo tipo y campo
+            return self._tablas.get((usuario_id, tipo, campo)) or self._tablas.get((None, tipo, campo))
+
+    def tiene_reglas(self, usuario_id, tipo):
+        self._verificar_cambios()
+        usuario_id = int(usuario_id)
+        return any(self._tabla(usuario_id, tipo, campo) is not None for campo in METRICAS[tipo][1])
+
+    def evaluar(self, usuario_id, tipo, lecturas):
+        # lecturas: lista de dicts {campo: valor}; devuelve [(lectura, regla)] que disparan alerta
+        self._verificar_cambios()
+        usuario_id = int(usuario_id)
+        disparadas = []
+        for campo in METRICAS[tipo][1]:
+            tabla = self._tabla(usuario_id, tipo, campo)
+            if tabla is None:
+                continue
+            for lectura in lecturas:
+                for regla in tabla.buscar(float(lectura[campo])):
+                    disparadas.append((lectura, regla))
+        return disparadas
+
+motor_reglas = MotorReglas()
+
+def _registrar_reglas_modificadas(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, ReglaAlerta):
+            session.info['reglas_modificadas'] = True
+            return
+
+def _invalidar_reglas_tras_commit(session):
+    if session.info.pop('reglas_modificadas', False):
+        motor_reglas.invalidar()
+
+event.listen(Session, 'after_flush', _registrar_reglas_modificadas)
+event.listen(Session, 'after_commit', _invalidar_reglas_tras_commit)
+event.listen(Session, 'after_rollback', lambda session: session.info.pop('reglas_modificadas', None))
+
+def mensaje_alerta(tipo, lectura, regla):
+    valor = lectura[regla['campo']]
+    if regla['mensaje']:
+        return regla['mensaje'].replace('{valor}', str(valor))
+    return f"Alerta de {NOMBRES_METRICAS[tipo].lower()}: {regla['campo']} {valor} {UNIDADES_METRICAS[tipo]} fuera del rango configurado"
+
+def emitir_alertas(usuario_id, tipo, disparadas, fecha, hora):
+    if not disparadas:
+        return
+    if len(disparadas) == 1:
+        mensaje = mensaje_alerta(tipo, *disparadas[0])
+    else:
+        # En ingestas por lotes se agrupan en una sola notificación y un solo push
+        mensaje = f"{len(disparadas)} alertas de {NOMBRES_METRICAS[tipo].lower()}. Última: {mensaje_alerta(tipo, *disparadas[-1])}"
+    db.session.add(Notificacion(usuario_id=usuario_id, mensaje=mensaje[:255], fecha=fecha, hora=hora))
+    db.session.commit()
+    enviar_notificacion_fcm(usuario_id, f'WHS Medicine - Alerta de {NOMBRES_METRICAS[tipo]}', mensaje, None)
+    print(f"Alertas emitidas para usuario_id: {usuario_id}, tipo: {tipo}, total: {len(disparadas)}")
+
+def _regla_a_dict(regla):
+    return {
+        "id": regla.id,
+        "global": regla.usuario_id is None,
+        "tipo": regla.tipo,
+        "campo": regla.campo,
+        "minimo": regla.minimo,
+        "maximo": regla.maximo,
+        "mensaje": regla.mensaje,
+        "activa": regla.activa,
+    }
+
+def _aplicar_datos_regla(regla, data):
+    if 'tipo' in data:
+        regla.tipo = data['tipo']
+    if 'campo' in data:
+        regla.campo = data['campo']
+    if regla.tipo not in METRICAS or (regla.campo or 'valor') not in METRICAS[regla.tipo][1]:
+        raise ValueError('Tipo o campo de regla inválido')
+    for limite in ('minimo', 'maximo'):
+        if limite in data:
+            setattr(regla, limite, float(data[limite]) if data[limite] is not None else None)
+    if regla.minimo is None and regla.maximo is None:
+        raise ValueError('La regla necesita minimo, maximo o ambos')
+    if regla.minimo is not None and regla.maximo is not None and regla.minimo >= regla.maximo:
+        raise ValueError('minimo debe ser menor que maximo')
+    if 'mensaje' in data:
+        regla.mensaje = data['mensaje']
+    if 'activa' in data:
+        regla.activa = bool(data['activa'])
+
+@api.route('/api/reglas_alerta', methods=['GET'])
+@jwt_required()
+def obtener_reglas_alerta():
+    usuario_id = get_jwt_identity()
+    reglas = ReglaAlerta.query.filter(
+        (ReglaAlerta.usuario_id == usuario_id) | (ReglaAlerta.usuario_id.is_(None))
+    ).order_by(ReglaAlerta.tipo, ReglaAlerta.campo, ReglaAlerta.minimo).all()
+    print(f"Reglas de alerta obtenidas para usuario_id: {usuario_id}, total: {len(reglas)}")
+    return jsonify([_regla_a_dict(r) for r in reglas]), 200
+
+@api.route('/api/reglas_alerta', methods=['POST'])
+@jwt_required()
+def crear_regla_alerta():
+    usuario_id = get_jwt_identity()
+    data = request.get_json(force=True)
+    regla = ReglaAlerta(usuario_id=usuario_id, campo='valor')
+    try:
+        _aplicar_datos_regla(regla, data)
+    except (ValueError, TypeError) as e:
+        print(f"Regla de alerta inválida: {str(e)}")
+        return jsonify({"msg": f"Regla inválida: {str(e)}"}), 400
+    try:
+        db.session.add(regla)
+        db.session.commit()
+        print(f"Regla de alerta creada para usuario_id: {usuario_id}, id: {regla.id}")
+        return jsonify({"msg": "Regla creada", "id": regla.id}), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al crear regla de alerta: {str(e)}")
+        return jsonify({"msg": f"Error al crear regla: {str(e)}"}), 500
+
+@api.route('/api/reglas_alerta/<int:id>', methods=['PUT'])
+@jwt_required()
+def actualizar_regla_alerta(id):
+    usuario_id = get_jwt_identity()
+    regla = db.session.get(ReglaAlerta, id)
+    if not regla:
+        return jsonify({"msg": "Regla no encontrada"}), 404
+    if regla.usuario_id != int(usuario_id):
+        print(f"Usuario no autorizado para regla id: {id}, usuario_id: {usuario_id}")
+        return jsonify({"msg": "No autorizado"}), 403
+    try:
+        _aplicar_datos_regla(regla, request.get_json(force=True))
+    except (ValueError, TypeError) as e:
+        db.session.rollback()
+        print(f"Regla de alerta inválida: {str(e)}")
+        return jsonify({"msg": f"Regla inválida: {str(e)}"}), 400
+    try:
+        db.session.commit()
+        print(f"Regla de alerta actualizada: id={id}")
+        return jsonify({"msg": "Regla actualizada"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al actualizar regla de alerta: {str(e)}")
+        return jsonify({"msg": f"Error al actualizar regla: {str(e)}"}), 500
+
+@api.route('/api/reglas_alerta/<int:id>', methods=['DELETE'])
+@jwt_required()
+def eliminar_regla_alerta(id):
+    usuario_id = get_jwt_identity()
+    regla = db.session.get(ReglaAlerta, id)
+    if not regla:
+        return jsonify({"msg": "Regla no encontrada"}), 404
+    if regla.usuario_id != int(usuario_id):
+        print(f"Usuario no autorizado para regla id: {id}, usuario_id: {usuario_id}")
+        return jsonify({"msg": "No autorizado"}), 403
+    try:
+        db.session.delete(regla)
+        db.session.commit()
+        print(f"Regla de alerta eliminada: id={id}")
+        return jsonify({"msg": "Regla eliminada"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al eliminar regla de alerta: {str(e)}")
+        return jsonify({"msg": f"Error al eliminar regla: {str(e)}"}), 500
+
+@api.cli.command('reglas-por-defecto')
+def reglas_por_defecto():
+    # Crea reglas globales de alerta a partir de RANGOS_NORMALES si todavía no existen
+    db.create_all()
+    creadas = 0
+    for tipo, campos in RANGOS_NORMALES.items():
+        resolucion = 0.01 if tipo == 'glucosa' else 1
+        for campo, (minimo, maximo) in campos.items():
+            if ReglaAlerta.query.filter_by(usuario_id=None, tipo=tipo, campo=campo).first():
+                continue
+            db.session.add(ReglaAlerta(tipo=tipo, campo=campo, maximo=minimo))
+            db.session.add(ReglaAlerta(tipo=tipo, campo=campo, minimo=maximo + resolucion))
+            creadas += 2
+    db.session.commit()
+    print(f"Reglas globales creadas: {creadas}")
+
+# RECORDATORIOS DE MEDICAMENTOS
+# Las horas de toma se guardan en la hora local del servidor, igual que las captura la app
+# Un reclamo 'enviando' más antiguo que esto es de un proceso que murió antes de confirmar el envío
+RECLAMO_RECORDATORIO_CADUCADO = timedelta(minutes=2)
+# Los envíos fallidos se reintentan con espera exponencial (2, 4, 8, 16 min) hasta MAX_INTENTOS_RECORDATORIO
+ESPERA_REINTENTO_RECORDATORIO = timedelta(minutes=2)
+MAX_INTENTOS_RECORDATORIO = 5
+LOTE_RECUPERACION_RECORDATORIOS = 1000
+FIN_PAUTA = datetime(9999, 12, 31)
+
+def filtro_fecha_hora(columna_fecha, columna_hora, desde, hasta):
+    # [desde, hasta) sobre (fecha, hora) aunque la ventana cruce la medianoche; usa el índice (fecha, hora)
+    return db.and_(
+        db.or_(columna_fecha > desde.date(), db.and_(columna_fecha == desde.date(), columna_hora >= desde.time())),
+        db.or_(columna_fecha < hasta.date(), db.and_(columna_fecha == hasta.date(), columna_hora < hasta.time())),
+    )
+
+class ProgramadorRecordatorios:
+    def __init__(self, ventana=300, lote=500, gracia=600):
+        self.ventana = timedelta(seconds=ventana)
+        self.gracia = timedelta(seconds=gracia)
+        self.lote = lote
+        self.propietario = str(uuid.uuid4())
+        self.detener = threading.Event()
+        self._heap = []
+        self._en_cola = set()
+
+    def _ocurrencias(self, desde, hasta):
+        for shard in nombres_shard():
+            with usar_shard(shard):
+                consulta = Medicamento.query.filter(
+                    filtro_fecha_hora(Medicamento.fecha, Medicamento.hora_toma, desde, hasta)
+                ).order_by(Medicamento.id).yield_per(5000)
+                for m in consulta:
+                    cuando = datetime.combine(m.fecha, m.hora_toma)
+                    yield (
+                        cuando,
+                        f'med:{m.id}:{cuando.isoformat()}',
+                        m.usuario_id,
+                        'WHS Medicine - Recordatorio',
+                        f'Es hora de tomar {m.nombre} ({m.dosis})',
+                    )
+
+        pautas = self._pautas_en_ventana(desde, hasta)
+        tomadas = set()
+        ids = [p.id for p in pautas]
+        for inicio in range(0, len(ids), 1000):
+            tomadas.update(
+                (t.pauta_id, t.fecha, t.hora) for t in TomaMedicamento.query.filter(
+                    TomaMedicamento.pauta_id.in_(ids[inicio:inicio + 1000]),
+                    TomaMedicamento.fecha >= desde.date(),
+                    TomaMedicamento.fecha <= hasta.date(),
+                )
+            )
+        for pauta in pautas:
+            for fecha, hora in expandir_pauta(pauta, pauta.proxima_toma.date(), hasta.date()):
+                cuando = datetime.combine(fecha, hora)
+                if desde <= cuando < hasta and (pauta.id, fecha, hora) not in tomadas:
+                    yield (
+                        cuando,
+                        f'pauta:{pauta.id}:{cuando.isoformat()}',
+                        pauta.usuario_id,
+                        'WHS Medicine - Recordatorio',
+                        f'Es hora de tomar {pauta.nombre} ({pauta.dosis})',
+                    )
+
+    def _pautas_en_ventana(self, desde, hasta):
+        # Solo las pautas con una toma pendiente antes de hasta (índice por proxima_toma), no todas las activas.
+        # Las que se quedaron atrás (toma ya registrada, reclamo perdido) o aún sin calcular se ponen al día
+        pautas = PautaMedicamento.query.filter(
+            (PautaMedicamento.proxima_toma < hasta) | PautaMedicamento.proxima_toma.is_(None)
+        ).order_by(PautaMedicamento.id).all()
+        for pauta in pautas:
+            if pauta.proxima_toma is None or pauta.proxima_toma < desde:
+                pauta.proxima_toma = proxima_toma_pauta(pauta, desde)
+        db.session.commit()
+        return [p for p in pautas if p.proxima_toma < hasta]
+
+    def _avanzar_pautas(self, reclamados):
+        # Tras reclamar una toma de pauta, su proxima_toma pasa a la siguiente (nunca hacia atrás)
+        ultimas = {}
+        for o in reclamados:
+            if o[1].startswith('pauta:'):
+                pauta_id = int(o[1].split(':', 2)[1])
+                ultimas[pauta_id] = max(o[0], ultimas.get(pauta_id, o[0]))
+        if not ultimas:
+            return
+        for pauta in PautaMedicamento.query.filter(PautaMedicamento.id.in_(ultimas)):
+            PautaMedicamento.query.filter(
+                PautaMedicamento.id == pauta.id, PautaMedicamento.proxima_toma <= ultimas[pauta.id]
+            ).update({"proxima_toma": proxima_toma_pauta(pauta, ultimas[pauta.id] + timedelta(seconds=1))},
+                     synchronize_session=False)
+        db.session.commit()
+
+    def cargar_ventana(self, desde, hasta):
+        candidatos = [o for o in self._ocurrencias(desde, hasta) if o[1] not in self._en_cola]
+        cargados = 0
+        caducado = datetime.utcnow() - RECLAMO_RECORDATORIO_CADUCADO
+        for inicio in range(0, len(candidatos), 1000):
+            bloque = candidatos[inicio:inicio + 1000]
+            # Los reclamos caducados se vuelven a cargar para que otro proceso los termine
+            enviados = {
+                c for (c,) in db.session.query(RecordatorioEnviado.clave).filter(
+                    RecordatorioEnviado.clave.in_([o[1] for o in bloque]),
+                    db.or_(RecordatorioEnviado.estado != 'enviando', RecordatorioEnviado.fecha_creacion >= caducado),
+                )
+            }
+            for ocurrencia in bloque:
+                if ocurrencia[1] not in enviados:
+                    heapq.heappush(self._heap, ocurrencia)
+                    self._en_cola.add(ocurrencia[1])
+                    cargados += 1
+        db.session.commit()
+        print(f"Recordatorios cargados para {desde:%Y-%m-%d %H:%M} - {hasta:%Y-%m-%d %H:%M}: {cargados}, en cola: {len(self._heap)}")
+
+    def _encolar(self, ocurrencias):
+        for ocurrencia in ocurrencias:
+            if ocurrencia[1] not in self._en_cola:
+                heapq.heappush(self._heap, ocurrencia)
+                self._en_cola.add(ocurrencia[1])
+
+    def _reclamar(self, vencidos):
+        # INSERT IGNORE sobre la clave primaria: solo uno de los procesos gana cada toma, incluso tras reinicios
+        filas = [{
+            "clave": o[1], "usuario_id": o[2], "programado_para": o[0],
+            "propietario": self.propietario, "estado": 'enviando', "fecha_creacion": datetime.utcnow(),
+        } for o in vencidos]
+        db.session.execute(
+            insert(RecordatorioEnviado).prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite'),
+            filas,
+        )
+        # Reclamos caducados y fallidos cuyo reintento ya toca: el UPDATE condicional también deja un único ganador
+        ahora = datetime.utcnow()
+        claves = [o[1] for o in vencidos]
+        RecordatorioEnviado.query.filter(
+            RecordatorioEnviado.clave.in_(claves),
+            RecordatorioEnviado.estado == 'enviando',
+            RecordatorioEnviado.fecha_creacion < ahora - RECLAMO_RECORDATORIO_CADUCADO,
+        ).update({"propietario": self.propietario, "fecha_creacion": ahora}, synchronize_session=False)
+        RecordatorioEnviado.query.filter(
+            RecordatorioEnviado.clave.in_(claves),
+            RecordatorioEnviado.estado == 'fallido',
+            RecordatorioEnviado.proximo_intento <= ahora,
+        ).update({"estado": 'enviando', "propietario": self.propietario, "fecha_creacion": ahora},
+                 synchronize_session=False)
+        db.session.commit()
+        propias = dict(db.session.query(RecordatorioEnviado.clave, RecordatorioEnviado.intentos).filter(
+            RecordatorioEnviado.clave.in_(claves),
+            RecordatorioEnviado.propietario == self.propietario,
+            RecordatorioEnviado.estado == 'enviando',
+        ).all())
+        return [o for o in vencidos if o[1] in propias], propias
+
+    def despachar(self, ahora):
+        while self._heap and self._heap[0][0] <= ahora:
+            vencidos = []
+            while self._heap and self._heap[0][0] <= ahora and len(vencidos) < self.lote:
+                ocurrencia = heapq.heappop(self._heap)
+                self._en_cola.discard(ocurrencia[1])
+                vencidos.append(ocurrencia)
+            try:
+                reclamados, intentos = self._reclamar(vencidos)
+                exito = enviar_lote_fcm([(o[2], o[3], o[4]) for o in reclamados])
+                ahora_utc = datetime.utcnow()
+                resultados = []
+                for i, o in enumerate(reclamados):
+                    if exito.get(i):
+                        resultados.append({"clave": o[1], "estado": 'enviado', "proximo_intento": None})
+                        continue
+                    fallos = intentos[o[1]] + 1
+                    resultados.append({
+                        "clave": o[1],
+                        "estado": 'fallido',
+                        "intentos": fallos,
+                        "proximo_intento": ahora_utc + ESPERA_REINTENTO_RECORDATORIO * 2 ** (fallos - 1)
+                        if fallos < MAX_INTENTOS_RECORDATORIO else None,
+                    })
+                for estado in ('enviado', 'fallido'):
+                    filas = [r for r in resultados if r["estado"] == estado]
+                    if filas:
+                        db.session.execute(update(RecordatorioEnviado), filas)
+                db.session.commit()
+                self._avanzar_pautas(reclamados)
+            except Exception:
+                # Nada se pierde: lo reclamado sigue siendo de este proceso y _reclamar lo devuelve otra vez
+                db.session.rollback()
+                self._encolar(vencidos)
+                raise
+            print(f"Recordatorios despachados: {len(reclamados)} de {len(vencidos)} vencidos")
+
+    def _reconstruir(self, filas):
+        # Ocurrencias a partir de recordatorios_enviados (clave "med:<id>:<iso>" o "pauta:<id>:<iso>")
+        ids = {'med': set(), 'pauta': set()}
+        for clave, _, _ in filas:
+            origen, id_origen, _ = clave.split(':', 2)
+            ids[origen].add(int(id_origen))
+        origenes = {'med': {}, 'pauta': {}}
+        if ids['pauta']:
+            origenes['pauta'] = {p.id: p for p in PautaMedicamento.query.filter(PautaMedicamento.id.in_(ids['pauta']))}
+        if ids['med']:
+            for shard in nombres_shard():
+                with usar_shard(shard):
+                    origenes['med'].update((m.id, m) for m in Medicamento.query.filter(Medicamento.id.in_(ids['med'])))
+        ocurrencias, borradas = [], []
+        for clave, usuario_id, programado in filas:
+            origen, id_origen, _ = clave.split(':', 2)
+            registro = origenes[origen].get(int(id_origen))
+            if registro is None:
+                borradas.append(clave)
+                continue
+            ocurrencias.append((
+                programado, clave, usuario_id, 'WHS Medicine - Recordatorio',
+                f'Es hora de tomar {registro.nombre} ({registro.dosis})',
+            ))
+        if borradas:
+            # El medicamento o la pauta ya no existe: no se reintenta más
+            RecordatorioEnviado.query.filter(RecordatorioEnviado.clave.in_(borradas)).update(
+                {"proximo_intento": None}, synchronize_session=False
+            )
+        db.session.commit()
+        return ocurrencias
+
+    def recuperar(self, ahora):
+        # Reclamos de procesos caídos (tomas pasadas dentro del periodo de gracia) y envíos fallidos cuyo reintento
+        # ya toca; se reconstruyen desde recordatorios_enviados y vuelven a la cola
+        columnas = (RecordatorioEnviado.clave, RecordatorioEnviado.usuario_id, RecordatorioEnviado.programado_para)
+        filas = db.session.query(*columnas).filter(
+            RecordatorioEnviado.programado_para >= ahora - self.gracia,
+            RecordatorioEnviado.programado_para <= ahora,
+            RecordatorioEnviado.estado == 'enviando',
+            RecordatorioEnviado.fecha_creacion < datetime.utcnow() - RECLAMO_RECORDATORIO_CADUCADO,
+        ).limit(LOTE_RECUPERACION_RECORDATORIOS).all()
+        filas += db.session.query(*columnas).filter(
+            RecordatorioEnviado.estado == 'fallido',
+            RecordatorioEnviado.proximo_intento <= datetime.utcnow(),
+        ).limit(LOTE_RECUPERACION_RECORDATORIOS).all()
+        db.session.commit()
+        filas = [f for f in filas if f[0] not in self._en_cola]
+        if filas:
+            ocurrencias = self._reconstruir(filas)
+            self._encolar(ocurrencias)
+            print(f"Recordatorios recuperados o reintentados: {len(ocurrencias)}")
+
+    def ejecutar(self):
+        ahora = datetime.now()
+        self.cargar_ventana(ahora - self.gracia, ahora + self.ventana)
+        self.recuperar(ahora)
+        siguiente_carga = ahora + self.ventana / 2
+        cargado_hasta = ahora + self.ventana
+        while not self.detener.is_set():
+            ahora = datetime.now()
+            if ahora >= siguiente_carga:
+                self.recuperar(ahora)
+                self.cargar_ventana(cargado_hasta - self.ventana / 2, ahora + self.ventana)
+                cargado_hasta = ahora + self.ventana
+                siguiente_carga = ahora + self.ventana / 2
+            try:
+                self.despachar(ahora)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error al despachar recordatorios: {str(e)}")
+            proximo = min(self._heap[0][0], siguiente_carga) if self._heap else siguiente_carga
+            self.detener.wait(max(0.0, min((proximo - datetime.now()).total_seconds(), 1.0)))
+
+@api.cli.command('recordatorios')
+@click.option('--ventana', default=300, show_default=True, help='Segundos de tomas cargados en memoria por ventana')
+@click.option('--lote', default=500, show_default=True, help='Recordatorios por lote de envío FCM')
+@click.option('--gracia', default=600, show_default=True, help='Segundos hacia atrás revisados al arrancar')
+def recordatorios(ventana, lote, gracia):
+    db.create_all()
+    programador = ProgramadorRecordatorios(ventana=ventana, lote=lote, gracia=gracia)
+    signal.signal(signal.SIGTERM, lambda *_: programador.detener.set())
+    # Proceso de larga vida: también recoge las purgas de cuentas que un worker dejó a medias
+    threading.Thread(
+        target=bucle_purgas, args=(current_app._get_current_object(), programador.detener), name='purgas', daemon=True
+    ).start()
+    print(f"Programador de recordatorios iniciado (propietario {programador.propietario})")
+    try:
+        programador.ejecutar()
+    except KeyboardInterrupt:
+        pass
+    print("Programador de recordatorios detenido")
+
+@api.route('/api/notificaciones/locales', methods=['POST'])
+@jwt_required()
+@idempotente
+def registrar_notificacion_local():
+    usuario_id = get_jwt_identity()
+    data = request.get_json(force=True)
+    mensaje = data.get('mensaje')
+    if not mensaje or not data.get('fecha') or not data.get('hora'):
+        return jsonify({"msg": "Mensaje, fecha y hora son requeridos"}), 400
+    try:
+        fecha = datetime.strptime(data['fecha'], '%Y-%m-%d').date()
+        hora = datetime.strptime(data['hora'], '%H:%M:%S').time()
+    except ValueError:
+        print(f"Formato de fecha u hora inválido: {data}")
+        return jsonify({"msg": "Formato de fecha u hora inválido"}), 400
+    try:
+        db.session.add(Notificacion(usuario_id=usuario_id, mensaje=mensaje[:255], fecha=fecha, hora=hora))
+        db.session.commit()
+        print(f"Notificación local registrada para usuario_id: {usuario_id}")
+        return jsonify({"msg": "Notificación local registrada"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al registrar notificación local: {str(e)}")
+        return jsonify({"msg": f"Error al registrar notificación: {str(e)}"}), 500
+
+# PAUTAS DE MEDICAMENTOS RECURRENTES
+FRECUENCIAS_PAUTA = ('diaria', 'semanal')
+MAX_DIAS_OCURRENCIAS = 366
+
+def horas_pauta(pauta):
+    return [datetime.strptime(h, '%H:%M:%S').time() for h in pauta.horas.split(',') if h]
+
+def expandir_pauta(pauta, desde, hasta):
+    # Genera las tomas (fecha, hora) de la pauta dentro de [desde, hasta] sin guardarlas
+    inicio = max(desde, pauta.fecha_inicio)
+    fin = min(hasta, pauta.fecha_fin) if pauta.fecha_fin else hasta
+    if inicio > fin:
+        return
+    horas = horas_pauta(pauta)
+    if pauta.frecuencia == 'semanal':
+        dias = {int(d) for d in (pauta.dias_semana or '').split(',') if d != ''} or {pauta.fecha_inicio.weekday()}
+        lunes_inicio = pauta.fecha_inicio - timedelta(days=pauta.fecha_inicio.weekday())
+        dia = inicio
+        while dia <= fin:
+            if dia.weekday() in dias and ((dia - lunes_inicio).days // 7) % pauta.intervalo == 0:
+                for hora in horas:
+                    yield dia, hora
+            dia += timedelta(days=1)
+    else:
+        desfase = (inicio - pauta.fecha_inicio).days % pauta.intervalo
+        dia = inicio + timedelta(days=(pauta.intervalo - desfase) % pauta.intervalo)
+        while dia <= fin:
+            for hora in horas:
+                yield dia, hora
+            dia += timedelta(days=pauta.intervalo)
+
+def proxima_toma_pauta(pauta, desde):
+    # Primera toma de la pauta en o después de desde (datetime local); FIN_PAUTA si ya no quedan
+    dia = max(desde.date(), pauta.fecha_inicio)
+    while pauta.fecha_fin is None or dia <= pauta.fecha_fin:
+        # Cualquier tramo de intervalo + 1 semanas contiene al menos una toma
+        hasta = dia + timedelta(days=7 * pauta.intervalo + 7)
+        for fecha, hora in expandir_pauta(pauta, dia, hasta):
+            if datetime.combine(fecha, hora) >= desde:
+                return datetime.combine(fecha, hora)
+        dia = hasta + timedelta(days=1)
+    return FIN_PAUTA
+
+def pautas_en_rango(desde, hasta, usuario_id=None):
+    query = PautaMedicamento.query.filter(
+        PautaMedicamento.fecha_inicio <= hasta,
+        (PautaMedicamento.fecha_fin.is_(None)) | (PautaMedicamento.fecha_fin >= desde),
+    )
+    if usuario_id is not None:
+        query = query.filter(PautaMedicamento.usuario_id == usuario_id)
+    return query
+
+def ocurrencias_pautas(usuario_id, desde, hasta):
+    pautas = pautas_en_rango(desde, hasta, usuario_id).all()
+    tomas = {
+        (t.pauta_id, t.fecha, t.hora): t
+        for t in TomaMedicamento.query.filter(
+            TomaMedicamento.usuario_id == usuario_id,
+            TomaMedicamento.fecha >= desde,
+            TomaMedicamento.fecha <= hasta,
+        )
+    }
+    resultado = []
+    for pauta in pautas:
+        for fecha, hora in expandir_pauta(pauta, desde, hasta):
+            toma = tomas.get((pauta.id, fecha, hora))
+            resultado.append({
+                "pauta_id": pauta.id,
+                "nombre": pauta.nombre,
+                "dosis": pauta.dosis,
+                "fecha": fecha.isoformat(),
+                "hora_toma": hora.strftime('%H:%M:%S'),
+                "tomada": toma is not None,
+                "toma_id": toma.id if toma else None
+            })
+    return resultado
+
+def _pauta_a_dict(pauta):
+    return {
+        "id": pauta.id,
+        "nombre": pauta.nombre,
+        "dosis": pauta.dosis,
+        "frecuencia": pauta.frecuencia,
+        "intervalo": pauta.intervalo,
+        "dias_semana": [int(d) for d in pauta.dias_semana.split(',')] if pauta.dias_semana else [],
+        "horas": pauta.horas.split(','),
+        "fecha_inicio": pauta.fecha_inicio.isoformat(),
+        "fecha_fin": pauta.fecha_fin.isoformat() if pauta.fecha_fin else None,
+        "sintomas": pauta.sintomas
+    }
+
+def _aplicar_datos_pauta(pauta, data):
+    for campo in ('nombre', 'dosis', 'sintomas'):
+        if campo in data:
+            setattr(pauta, campo, data[campo])
+    if 'frecuencia' in data:
+        if data['frecuencia'] not in FRECUENCIAS_PAUTA:
+            raise ValueError('frecuencia debe ser diaria o semanal')
+        pauta.frecuencia = data['frecuencia']
+    if 'intervalo' in data:
+        pauta.intervalo = int(data['intervalo'])
+        if pauta.intervalo < 1:
+            raise ValueError('intervalo debe ser mayor que 0')
+    if 'dias_semana' in data:
+        dias = sorted({int(d) for d in data['dias_semana'] or []})
+        if any(d < 0 or d > 6 for d in dias):
+            raise ValueError('dias_semana debe contener valores de 0 (lunes) a 6 (domingo)')
+        pauta.dias_semana = ','.join(str(d) for d in dias) or None
+    if 'horas' in data:
+        horas = sorted({datetime.strptime(h, '%H:%M:%S').time() for h in data['horas'] or []})
+        if not horas:
+            raise ValueError('se requiere al menos una hora')
+        pauta.horas = ','.join(h.strftime('%H:%M:%S') for h in horas)
+    if 'fecha_inicio' in data:
+        pauta.fecha_inicio = datetime.strptime(data['fecha_inicio'], '%Y-%m-%d').date()
+    if 'fecha_fin' in data:
+        pauta.fecha_fin = datetime.strptime(data['fecha_fin'], '%Y-%m-%d').date() if data['fecha_fin'] else None
+    if not pauta.nombre or not pauta.dosis or not pauta.horas or not pauta.fecha_inicio:
+        raise ValueError('nombre, dosis, horas y fecha_inicio son obligatorios')
+    if pauta.fecha_fin and pauta.fecha_fin < pauta.fecha_inicio:
+        raise ValueError('fecha_fin es anterior a fecha_inicio')
+    pauta.proxima_toma = proxima_toma_pauta(pauta, datetime.now())
+
+@api.route('/api/pautas_medicamento', methods=['POST'])
+@jwt_required()
+@idempotente
+def crear_pauta_medicamento():
+    usuario_id = get_jwt_identity()
+    data = request.get_json(force=True)
+    pauta = PautaMedicamento(usuario_id=usuario_id, frecuencia='diaria', intervalo=1)
+    try:
+        _aplicar_datos_pauta(pauta, data)
+    except (ValueError, TypeError) as e:
+        print(f"Pauta de medicamento inválida: {str(e)}")
+        return jsonify({"msg": f"Pauta inválida: {str(e)}"}), 400
+    try:
+        db.session.add(pauta)
+        db.session.commit()
+        print(f"Pauta de medicamento creada para usuario_id: {usuario_id}, id: {pauta.id}")
+        return jsonify({"msg": "Pauta creada", "id": pauta.id}), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al crear pauta de medicamento: {str(e)}")
+        return jsonify({"msg": f"Error al crear pauta: {str(e)}"}), 500
+
+@api.route('/api/pautas_medicamento', methods=['GET'])
+@jwt_required()
+def obtener_pautas_medicamento():
+    usuario_id = get_jwt_identity()
+    pautas = PautaMedicamento.query.filter_by(usuario_id=usuario_id).order_by(PautaMedicamento.fecha_inicio.desc()).all()
+    print(f"Pautas de medicamento obtenidas para usuario_id: {usuario_id}, total: {len(pautas)}")
+    return jsonify([_pauta_a_dict(p) for p in pautas]), 200
+
+@api.route('/api/pautas_medicamento/<int:id>', methods=['PUT'])
+@jwt_required()
+def actualizar_pauta_medicamento(id):
+    usuario_id = get_jwt_identity()
+    pauta = db.session.get(PautaMedicamento, id)
+    if not pauta:
+        return jsonify({"msg": "Pauta no encontrada"}), 404
+    if pauta.usuario_id != int(usuario_id):
+        print(f"Usuario no autorizado para pauta id: {id}, usuario_id: {usuario_id}")
+        return jsonify({"msg": "No autorizado"}), 403
+    try:
+        _aplicar_datos_pauta(pauta, request.get_json(force=True))
+    except (ValueError, TypeError) as e:
+        db.session.rollback()
+        print(f"Pauta de medicamento inválida: {str(e)}")
+        return jsonify({"msg": f"Pauta inválida: {str(e)}"}), 400
+    try:
+        db.session.commit()
+        print(f"Pauta de medicamento actualizada: id={id}")
+        return jsonify({"msg": "Pauta actualizada"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al actualizar pauta de medicamento: {str(e)}")
+        return jsonify({"msg": f"Error al actualizar pauta: {str(e)}"}), 500
+
+@api.route('/api/pautas_medicamento/<int:id>', methods=['DELETE'])
+@jwt_required()
+def eliminar_pauta_medicamento(id):
+    usuario_id = get_jwt_identity()
+    pauta = db.session.get(PautaMedicamento, id)
+    if not pauta:
+        return jsonify({"msg": "Pauta no encontrada"}), 404
+    if pauta.usuario_id != int(usuario_id):
+        print(f"Usuario no autorizado para pauta id: {id}, usuario_id: {usuario_id}")
+        return jsonify({"msg": "No autorizado"}), 403
+    try:
+        tomas = [t for (t,) in db.session.query(TomaMedicamento.id).filter_by(pauta_id=id)]
+        TomaMedicamento.query.filter_by(pauta_id=id).delete(synchronize_session=False)
+        registrar_cambios(usuario_id, 'tomas_medicamento', tomas, 'd')
+        db.session.delete(pauta)
+        db.session.commit()
+        print(f"Pauta de medicamento eliminada: id={id}")
+        return jsonify({"msg": "Pauta eliminada"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al eliminar pauta de medicamento: {str(e)}")
+        return jsonify({"msg": f"Error al eliminar pauta: {str(e)}"}), 500
+
+@api.route('/api/pautas_medicamento/ocurrencias', methods=['GET'])
+@jwt_required()
+def obtener_ocurrencias_medicamento():
+    usuario_id = get_jwt_identity()
+    try:
+        desde, hasta = leer_rango_fechas()
+    except ValueError:
+        return jsonify({"msg": "Formato de fecha inválido"}), 400
+    if not desde or not hasta:
+        return jsonify({"msg": "desde y hasta son requeridos (YYYY-MM-DD)"}), 400
+    if (hasta - desde).days > MAX_DIAS_OCURRENCIAS:
+        return jsonify({"msg": f"El rango máximo es de {MAX_DIAS_OCURRENCIAS} días"}), 400
+
+    resultado = ocurrencias_pautas(usuario_id, desde, hasta)
+    resultado.sort(key=lambda o: (o["fecha"], o["hora_toma"]))
+    print(f"Ocurrencias de medicamentos para usuario_id: {usuario_id}, total: {len(resultado)}")
+    return responder_lista(resultado)
+
+@api.route('/api/pautas_medicamento/<int:id>/tomas', methods=['POST'])
+@jwt_required()
+@idempotente
+def registrar_toma_medicamento(id):
+    usuario_id = get_jwt_identity()
+    pauta = db.session.get(PautaMedicamento, id)
+    if not pauta:
+        return jsonify({"msg": "Pauta no encontrada"}), 404
+    if pauta.usuario_id != int(usuario_id):
+        print(f"Usuario no autorizado para pauta id: {id}, usuario_id: {usuario_id}")
+        return jsonify({"msg": "No autorizado"}), 403
+    data = request.get_json(force=True)
+    try:
+        fecha = datetime.strptime(data.get('fecha', ''), '%Y-%m-%d').date()
+        hora = datetime.strptime(data.get('hora', ''), '%H:%M:%S').time()
+    except ValueError:
+        return jsonify({"msg": "Formato de fecha u hora inválido"}), 400
+    if (fecha, hora) not in set(expandir_pauta(pauta, fecha, fecha)):
+        return jsonify({"msg": "La pauta no tiene una toma programada en esa fecha y hora"}), 400
+    if TomaMedicamento.query.filter_by(pauta_id=id, fecha=fecha, hora=hora).first():
+        return jsonify({"msg": "Toma ya registrada"}), 409
+    toma = TomaMedicamento(pauta_id=id, usuario_id=usuario_id, fecha=fecha, hora=hora, sintomas=data.get('sintomas'))
+    try:
+        db.session.add(toma)
+        db.session.commit()
+        print(f"Toma registrada para pauta id: {id}, fecha: {fecha}, hora: {hora}")
+        return jsonify({"msg": "Toma registrada", "id": toma.id}), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al registrar toma: {str(e)}")
+        return jsonify({"msg": f"Error al registrar toma: {str(e)}"}), 500
+
+# SINCRONIZACIÓN INCREMENTAL
+# Columnas que se envían por tabla en formato compacto (filas como listas)
+COLUMNAS_SYNC = {
+    'glucosas': (Glucosa, ('id', 'fecha', 'hora', 'valor', 'fecha_creacion')),
+    'presiones_arteriales': (PresionArterial, ('id', 'fecha', 'hora', 'sistolica', 'diastolica', 'fecha_creacion')),
+    'oxigenaciones': (Oxigenacion, ('id', 'fecha', 'hora', 'valor', 'fecha_creacion')),
+    'frecuencias_cardiacas': (FrecuenciaCardiaca, ('id', 'fecha', 'hora', 'valor', 'fecha_creacion')),
+    'medicamentos': (Medicamento, ('id', 'nombre', 'dosis', 'hora_toma', 'fecha', 'sintomas')),
+    'notificaciones': (Notificacion, ('id', 'mensaje', 'fecha', 'hora', 'fecha_creacion', 'delete_request_id')),
+    'pautas_medicamento': (PautaMedicamento, (
+        'id', 'nombre', 'dosis', 'frecuencia', 'intervalo', 'dias_semana', 'horas', 'fecha_inicio', 'fecha_fin', 'sintomas'
+    )),
+    'tomas_medicamento': (TomaMedicamento, ('id', 'pauta_id', 'fecha', 'hora', 'tomada_en', 'sintomas')),
+}
+LIMITE_SYNC_DEFECTO = 1000
+MAX_LIMITE_SYNC = 5000
+# Los cambios se anotan en la sesión y se numeran en before_commit: el UPDATE del contador del usuario bloquea su
+# fila hasta el commit, así que los seq de un usuario se hacen visibles en orden y un lector nunca salta un hueco
+# de una transacción aún abierta, dure lo que dure (importaciones, purgas, borrados por lotes)
+CLAVE_CAMBIOS_PENDIENTES = 'cambios_sync_pendientes'
+
+def _anotar_cambios(session, filas):
+    # Cada cambio se guarda en el shard del usuario, en la misma transacción que sus datos
+    pendientes = session.info.setdefault(CLAVE_CAMBIOS_PENDIENTES, {})
+    for fila in filas:
+        shard = session.info['shard'] if 'shard' in session.info else enrutador_shards().shard_de(fila['usuario_id'])
+        pendientes.setdefault(shard, []).append(fila)
+
+def registrar_cambios(usuario_id, tabla, registro_ids, operacion):
+    # Para rutas que escriben con DELETE/INSERT masivos que no pasan por los eventos del ORM
+    _anotar_cambios(db.session(), [
+        {"usuario_id": int(usuario_id), "tabla": tabla, "registro_id": int(registro_id), "operacion": operacion}
+        for registro_id in registro_ids
+    ])
+
+def _registrar_cambios_sync(session, flush_context):
+    filas = []
+    for operacion, objetos in (('i', session.new), ('u', session.dirty), ('d', session.deleted)):
+        for obj in objetos:
+            tabla = getattr(obj, '__tablename__', None)
+            if tabla not in COLUMNAS_SYNC or obj.usuario_id is None:
+                continue
+            if operacion == 'u' and not session.is_modified(obj, include_collections=False):
+                continue
+            filas.append({"usuario_id": int(obj.usuario_id), "tabla": tabla, "registro_id": obj.id, "operacion": operacion})
+    if filas:
+        _anotar_cambios(session, filas)
+
+def _reservar_seq(conexion, usuario_id, cantidad):
+    # Devuelve el último seq reservado; la fila del contador queda bloqueada hasta el commit
+    tabla = SecuenciaSync.__table__
+    actualizar = tabla.update().where(tabla.c.usuario_id == usuario_id).values(valor=tabla.c.valor + cantidad)
+    if conexion.execute(actualizar).rowcount == 0:
+        conexion.execute(
+            insert(tabla).prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite'),
+            {"usuario_id": usuario_id, "valor": 0, "compactado": 0},
+        )
+        conexion.execute(actualizar)
+    return conexion.execute(select(tabla.c.valor).where(tabla.c.usuario_id == usuario_id)).scalar()
+
+def bloquear_secuencias_sync(conexion, usuario_ids):
+    # Toma hasta el commit la fila del contador de cada usuario (en orden, como _asignar_seq_sync). Cualquier otra
+    # transacción que escriba datos suyos necesita esa fila para confirmar, así que no se confirma en medio
+    for usuario_id in sorted(set(usuario_ids)):
+        _reservar_seq(conexion, usuario_id, 0)
+
+def insertar_con_cambios(conexion, modelo, filas):
+    # INSERT masivo por Core (executemany) que anota sus altas en el registro de sync. Sin RETURNING (MySQL no lo
+    # admite en executemany): los ids nuevos son los de cada usuario por encima de su máximo previo, porque el
+    # autoincremento siempre queda por encima. Requiere bloquear_secuencias_sync de esos usuarios antes
+    usuario_ids = sorted({fila['usuario_id'] for fila in filas})
+    anteriores = dict(conexion.execute(
+        select(modelo.usuario_id, db.func.max(modelo.id)).where(modelo.usuario_id.in_(usuario_ids)).group_by(modelo.usuario_id)
+    ).all())
+    conexion.execute(insert(modelo.__table__), filas)
+    nuevos = {}
+    for usuario_id, registro_id in conexion.execute(select(modelo.usuario_id, modelo.id).where(
+        modelo.usuario_id.in_(usuario_ids), modelo.id > min(anteriores.get(u) or 0 for u in usuario_ids)
+    )):
+        if registro_id > (anteriores.get(usuario_id) or 0):
+            nuevos.setdefault(usuario_id, []).append(registro_id)
+    for usuario_id, ids in nuevos.items():
+        registrar_cambios(usuario_id, modelo.__tablename__, ids, 'i')
+
+def _asignar_seq_sync(session):
+    session.flush()  # el último flush del commit también anota sus cambios
+    pendientes = session.info.get(CLAVE_CAMBIOS_PENDIENTES)
+    if not pendientes:
+        return
+    enrutador = enrutador_shards()
+    for filas in pendientes.values():
+        for usuario_id in {fila['usuario_id'] for fila in filas}:
+            if enrutador.en_movimiento(usuario_id):
+                raise UsuarioEnMovimiento(usuario_id)
+    session.info.pop(CLAVE_CAMBIOS_PENDIENTES)
+    ahora = datetime.utcnow()
+    # Orden fijo de bloqueo para que dos transacciones con varios usuarios no se interbloqueen
+    for shard in sorted(pendientes):
+        por_usuario = {}
+        for fila in pendientes[shard]:
+            por_usuario.setdefault(fila['usuario_id'], []).append(fila)
+        conexion = session.connection(bind_arguments={'bind': engine_shard(shard)})
+        for usuario_id in sorted(por_usuario):
+            filas = por_usuario[usuario_id]
+            ultimo = _reservar_seq(conexion, usuario_id, len(filas))
+            for indice, fila in enumerate(filas):
+                fila['seq'] = ultimo - len(filas) + 1 + indice
+                fila['fecha_creacion'] = ahora
+            conexion.execute(insert(CambioSync), filas)
+
+def _descartar_cambios_pendientes(session, transaccion):
+    if transaccion.parent is None:
+        session.info.pop(CLAVE_CAMBIOS_PENDIENTES, None)
+
+event.listen(Session, 'after_flush', _registrar_cambios_sync)
+event.listen(Session, 'before_commit', _asignar_seq_sync)
+event.listen(Session, 'after_transaction_end', _descartar_cambios_pendientes)
+
+def _valor_json(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, date):
+        return valor.isoformat()
+    if hasattr(valor, 'strftime'):
+        return valor.strftime('%H:%M:%S')
+    if isinstance(valor, Decimal):
+        return float(valor)
+    return valor
+
+@api.route('/api/sync/cambios', methods=['GET'])
+@jwt_required()
+def obtener_cambios_sync():
+    usuario_id = int(get_jwt_identity())
+    try:
+        desde = int(request.args.get('desde', 0))
+        limite = max(1, min(int(request.args.get('limite', LIMITE_SYNC_DEFECTO)), MAX_LIMITE_SYNC))
+    except ValueError:
+        return jsonify({"msg": "desde y limite deben ser enteros"}), 400
+
+    # reiniciar = true: el cliente descarga el estado completo con los endpoints de listado (/api/glucosas,
+    # /api/medicamentos, ...) y después pide cambios desde el seq devuelto. Pasa en la primera sincronización
+    # (desde = 0: los datos anteriores al registro de cambios no tienen fila en cambios_sync) y cuando el
+    # historial que necesita el cliente ya se compactó
+    secuencia = db.session.get(SecuenciaSync, usuario_id)
+    if desde == 0 or (secuencia and desde < secuencia.compactado):
+        if secuencia is None or secuencia.valor == 0:
+            # Se reserva un seq sin cambios como punto de partida para que el siguiente desde sea > 0
+            try:
+                conexion = db.session.connection(
+                    bind_arguments={'bind': engine_shard(enrutador_shards().shard_de(usuario_id))})
+                seq = _reservar_seq(conexion, usuario_id, 1)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error al iniciar la secuencia de sync para usuario_id: {usuario_id}: {str(e)}")
+                return jsonify({"msg": "Error al iniciar la sincronización"}), 500
+        else:
+            seq = secuencia.valor
+        print(f"Sync reiniciada para usuario_id: {usuario_id}, desde: {desde}, seq: {seq}")
+        return jsonify({"reiniciar": True, "seq": seq, "mas": False, "tablas": {}}), 200
+
+    cambios = CambioSync.query.filter(
+        CambioSync.usuario_id == usuario_id, CambioSync.seq > desde
+    ).order_by(CambioSync.seq).limit(limite + 1).all()
+    mas = len(cambios) > limite
+    cambios = cambios[:limite]
+
+    # Solo cuenta la última operación de cada registro dentro de la página
+    ultimo = {}
+    for cambio in cambios:
+        ultimo[(cambio.tabla, cambio.registro_id)] = cambio.operacion
+
+    tablas = {}
+    for tabla, (modelo, columnas) in COLUMNAS_SYNC.items():
+        vivos = [rid for (t, rid), op in ultimo.items() if t == tabla and op != 'd']
+        eliminados = [rid for (t, rid), op in ultimo.items() if t == tabla and op == 'd']
+        filas = []
+        if vivos:
+            encontrados = set()
+            for fila in db.session.query(*[getattr(modelo, c) for c in columnas]).filter(
+                modelo.id.in_(vivos), modelo.usuario_id == usuario_id
+            ):
+                encontrados.add(fila[0])
+                filas.append([_valor_json(v) for v in fila])
+            eliminados.extend(rid for rid in vivos if rid not in encontrados)
+        if filas or eliminados:
+            tablas[tabla] = {"columnas": list(columnas), "filas": filas, "eliminados": eliminados}
+
+    seq = cambios[-1].seq if cambios else desde
+    print(f"Cambios de sync para usuario_id: {usuario_id}, desde: {desde}, hasta: {seq}, registros: {len(ultimo)}")
+    return jsonify({"seq": seq, "mas": mas, "tablas": tablas}), 200
+
+@api.cli.command('compactar-sync')
+@click.option('--dias', default=30, show_default=True, help='Antigüedad de los cambios que se eliminan')
+@click.option('--lote', default=10000, show_default=True)
+def compactar_sync(dias, lote):
+    # Los clientes con una secuencia anterior al punto compactado de su usuario reciben reiniciar = true
+    limite = datetime.utcnow() - timedelta(days=dias)
+    eliminados = usuarios = 0
+    for shard in nombres_shard():
+        with usar_shard(shard):
+            while True:
+                grupos = db.session.query(CambioSync.usuario_id, db.func.min(CambioSync.seq), db.func.max(CambioSync.seq)).filter(
+                    CambioSync.fecha_creacion < limite
+                ).group_by(CambioSync.usuario_id).limit(1000).all()
+                if not grupos:
+                    break
+                for usuario_id, primero, ultimo in grupos:
+                    # El punto compactado se confirma antes de borrar: ningún cliente recibe un historial incompleto
+                    SecuenciaSync.query.filter(
+                        SecuenciaSync.usuario_id == usuario_id, SecuenciaSync.compactado < ultimo
+                    ).update({"compactado": ultimo}, synchronize_session=False)
+                    db.session.commit()
+                    for inicio in range(primero, ultimo + 1, lote):
+                        eliminados += CambioSync.query.filter(
+                            CambioSync.usuario_id == usuario_id, CambioSync.seq >= inicio, CambioSync.seq < min(inicio + lote, ultimo + 1)
+                        ).delete(synchronize_session=False)
+                        db.session.commit()
+                    usuarios += 1
+    print(f"Cambios de sync compactados: {eliminados} de {usuarios} usuarios")
+
+# PANEL DE CUIDADORES
+# Un paciente concede acceso de lectura a un cuidador; el panel devuelve las últimas constantes de todos sus
+# pacientes con una consulta con ROW_NUMBER por métrica y shard (requiere MySQL 8 o SQLite 3.25)
+MAX_PACIENTES_PANEL = 500
+
+def ultimas_lecturas(tipo, usuario_ids):
+    # {usuario_id: fila} con la última lectura de cada usuario
+    modelo, campos = METRICAS[tipo]
+    numero = db.func.row_number().over(
+        partition_by=modelo.usuario_id, order_by=(modelo.fecha.desc(), modelo.hora.desc())
+    ).label('numero')
+    ultimas = select(
+        modelo.usuario_id, modelo.fecha, modelo.hora, *[getattr(modelo, c) for c in campos], numero
+    ).where(modelo.usuario_id.in_(usuario_ids)).subquery()
+    return {fila.usuario_id: fila for fila in db.session.execute(select(ultimas).where(ultimas.c.numero == 1))}
+
+def _constante_panel(tipo, lectura, ahora):
+    if lectura is None:
+        return None
+    campos = METRICAS[tipo][1]
+    valores = {campo: float(getattr(lectura, campo)) if tipo == 'glucosa' else int(getattr(lectura, campo)) for campo in campos}
+    fuera = any(not minimo <= valores[campo] <= maximo for campo, (minimo, maximo) in RANGOS_NORMALES[tipo].items())
+    return dict(
+        valores,
+        fecha=lectura.fecha.isoformat(),
+        hora=lectura.hora.strftime('%H:%M:%S'),
+        fuera_rango=fuera,
+        antiguedad_segundos=max(0, int((ahora - datetime.combine(lectura.fecha, lectura.hora)).total_seconds())),
+    )
+
+@api.route('/api/cuidadores', methods=['POST'])
+@jwt_required()
+def conceder_acceso_cuidador():
+    paciente_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    cuidador = Usuario.query.filter_by(correo=data.get('correo')).first() if data.get('correo') else None
+    if not cuidador:
+        return jsonify({"msg": "No existe un usuario con ese correo"}), 404
+    if cuidador.id == paciente_id:
+        return jsonify({"msg": "No puedes concederte acceso a ti mismo"}), 400
+    if db.session.get(AccesoCuidador, (cuidador.id, paciente_id)):
+        return jsonify({"msg": "El cuidador ya tiene acceso"}), 409
+    try:
+        db.session.add(AccesoCuidador(cuidador_id=cuidador.id, paciente_id=paciente_id))
+        db.session.commit()
+        print(f"Acceso concedido al cuidador {cuidador.id} para paciente_id: {paciente_id}")
+        return jsonify({"msg": "Acceso concedido", "cuidador_id": cuidador.id}), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al conceder acceso a cuidador: {str(e)}")
+        return jsonify({"msg": f"Error al conceder acceso: {str(e)}"}), 500
+
+@api.route('/api/cuidadores', methods=['GET'])
+@jwt_required()
+def obtener_cuidadores():
+    paciente_id = int(get_jwt_identity())
+    filas = db.session.query(Usuario.id, Usuario.nombre, Usuario.correo, AccesoCuidador.fecha_creacion).join(
+        AccesoCuidador, AccesoCuidador.cuidador_id == Usuario.id
+    ).filter(AccesoCuidador.paciente_id == paciente_id).all()
+    return jsonify([{
+        "cuidador_id": i, "nombre": nombre, "correo": correo, "fecha_creacion": creado.isoformat() if creado else None,
+    } for i, nombre, correo, creado in filas]), 200
+
+@api.route('/api/cuidadores/<int:cuidador_id>', methods=['DELETE'])
+@jwt_required()
+def revocar_acceso_cuidador(cuidador_id):
+    paciente_id = int(get_jwt_identity())
+    acceso = db.session.get(AccesoCuidador, (cuidador_id, paciente_id))
+    if not acceso:
+        return jsonify({"msg": "Acceso no encontrado"}), 404
+    try:
+        db.session.delete(acceso)
+        db.session.commit()
+        print(f"Acceso revocado al cuidador {cuidador_id} para paciente_id: {paciente_id}")
+        return jsonify({"msg": "Acceso revocado"}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al revocar acceso de cuidador: {str(e)}")
+        return jsonify({"msg": f"Error al revocar acceso: {str(e)}"}), 500
+
+@api.route('/api/cuidador/pacientes', methods=['GET'])
+@jwt_required()
+@lectura_replica
+def panel_cuidador():
+    cuidador_id = int(get_jwt_identity())
+    # Lista de acceso cargada una vez; ?pacientes=1,2,3 limita el panel a un subconjunto
+    pacientes = dict(db.session.query(Usuario.id, Usuario.nombre).join(
+        AccesoCuidador, AccesoCuidador.paciente_id == Usuario.id
+    ).filter(AccesoCuidador.cuidador_id == cuidador_id).all())
+    if request.args.get('pacientes'):
+        try:
+            pedidos = {int(i) for i in request.args['pacientes'].split(',') if i}
+        except ValueError:
+            return jsonify({"msg": "pacientes debe ser una lista de ids separados por comas"}), 400
+        if pedidos - pacientes.keys():
+            return jsonify({"msg": "No tienes acceso a alguno de los pacientes"}), 403
+        pacientes = {i: pacientes[i] for i in pedidos}
+    if len(pacientes) > MAX_PACIENTES_PANEL:
+        return jsonify({"msg": f"Máximo {MAX_PACIENTES_PANEL} pacientes por consulta"}), 400
+
+    por_shard = {}
+    for paciente_id, shard in enrutador_shards().shards_de(pacientes).items():
+        por_shard.setdefault(shard, []).append(paciente_id)
+    ultimas = {tipo: {} for tipo in METRICAS}
+    for shard, ids in por_shard.items():
+        with usar_shard(shard):
+            for tipo in METRICAS:
+                ultimas[tipo].update(ultimas_lecturas(tipo, ids))
+
+    ahora = datetime.now()
+    resultado = []
+    for paciente_id, nombre in sorted(pacientes.items()):
+        fila = {"usuario_id": paciente_id, "nombre": nombre}
+        for tipo in METRICAS:
+            lectura = ultimas[tipo].get(paciente_id)
+            if tipo in TIPOS_STREAMING:
+                lectura = _mas_reciente(lectura, buffer_streaming().ultima(paciente_id, tipo))
+            fila[tipo] = _constante_panel(tipo, lectura, ahora)
+        fila["alertas"] = sum(1 for tipo in METRICAS if fila[tipo] and fila[tipo]["fuera_rango"])
+        resultado.append(fila)
+    print(f"Panel de cuidador obtenido para cuidador_id: {cuidador_id}, pacientes: {len(resultado)}")
+    return responder_lista(resultado)
+
+# PURGA DE CUENTAS
+# Borra todos los datos de un usuario con DELETE por lotes (una transacción corta por lote) en un hilo aparte.
+# El progreso queda en purgas_cuenta. Si el worker se recicla o cae, el hilo muere con él: el programador de
+# recordatorios reanuda cada INTERVALO_REANUDAR_PURGAS las "pendiente" y las "en_curso" sin latido reciente
+# (igual que "purgar-cuentas").
+# (tabla, columna con el id del usuario), en un orden que respeta las claves foráneas
+TABLAS_PURGA = [(nombre, 'usuario_id') for nombre in ('tomas_medicamento', 'pautas_medicamento') + TABLAS_SHARD + (
+    'fcm_tokens', 'reglas_alerta', 'recordatorios_enviados', 'resumen_diario_usuario',
+    'claves_idempotencia', 'directorio_shards', 'elementos_eliminacion',
+)] + [('accesos_cuidador', 'paciente_id'), ('accesos_cuidador', 'cuidador_id')]
+LOTE_PURGA = 2000
+PAUSA_PURGA = 0.05  # respiro entre lotes para no acaparar bloqueos
+MAX_PASADAS_PURGA = 5
+PURGA_ABANDONADA = timedelta(minutes=10)
+INTERVALO_REANUDAR_PURGAS = 60
+
+def _purga_a_dict(purga):
+    return {
+        "id": purga.id,
+        "estado": purga.estado,
+        "tabla_actual": purga.tabla_actual,
+        "filas_borradas": purga.filas_borradas,
+        "total_estimado": purga.total_estimado,
+        "porcentaje": round(100 * purga.filas_borradas / purga.total_estimado, 1) if purga.total_estimado else None,
+        "error": purga.error,
+        "fecha_creacion": purga.fecha_creacion.isoformat() if purga.fecha_creacion else None,
+        "fecha_actualizacion": purga.fecha_actualizacion.isoformat() if purga.fecha_actualizacion else None,
+    }
+
+def reclamar_purga(purga_id, propietario, incluir_fallidas=False):
+    # Solo un proceso ejecuta cada purga; las "en_curso" sin progreso reciente se consideran abandonadas
+    estados = (PurgaCuenta.estado == 'pendiente') | (
+        (PurgaCuenta.estado == 'en_curso') & (PurgaCuenta.fecha_actualizacion < datetime.utcnow() - PURGA_ABANDONADA)
+    )
+    if incluir_fallidas:
+        estados = estados | (PurgaCuenta.estado == 'fallida')
+    reclamadas = PurgaCuenta.query.filter(PurgaCuenta.id == purga_id, estados).update(
+        {"estado": 'en_curso', "propietario": propietario, "error": None, "fecha_actualizacion": datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return reclamadas == 1
+
+def _borrar_lote_usuario(purga_id, tabla, columna, usuario_id, lote):
+    # Se leen las claves primarias del lote y se borran con un único DELETE; el progreso va en la misma transacción
+    pk = list(tabla.primary_key.columns)
+    claves = db.session.execute(select(*pk).where(tabla.c[columna] == usuario_id).limit(lote)).all()
+    if claves:
+        condicion = pk[0].in_([c[0] for c in claves]) if len(pk) == 1 else tuple_(*pk).in_([tuple(c) for c in claves])
+        db.session.execute(tabla.delete().where(condicion))
+        db.session.execute(PurgaCuenta.__table__.update().where(PurgaCuenta.id == purga_id).values(
+            filas_borradas=PurgaCuenta.filas_borradas + len(claves),
+            tabla_actual=tabla.name,
+            fecha_actualizacion=datetime.utcnow(),
+        ))
+    db.session.commit()
+    return len(claves)
+
+def _filas_restantes_purga(usuario_id):
+    # Con el shard del usuario fijado en la sesión
+    restantes = sum(
+        db.session.execute(select(db.func.count()).where(db.metadata.tables[nombre].c[columna] == usuario_id)).scalar()
+        for nombre, columna in TABLAS_PURGA
+    )
+    db.session.commit()
+    return restantes
+
+def _borrar_puntos_importacion(usuario_id):
+    # Pueden quedar en la principal y en cualquier shard por el que haya pasado el usuario
+    for shard in nombres_shard():
+        with engine_shard(shard).begin() as conexion:
+            conexion.execute(PuntoControlTrabajo.__table__.delete().where(_condicion_puntos_importacion(usuario_id)))
+
+def _olvidar_idempotencia(usuario_id):
+    with _lock_idempotencia:
+        for clave in [c for c in _cache_idempotencia if c[0] == usuario_id]:
+            del _cache_idempotencia[clave]
+
+def ejecutar_purga(purga_id, lote=LOTE_PURGA):
+    purga = db.session.get(PurgaCuenta, purga_id)
+    usuario_id = purga.usuario_id
+    shard = enrutador_shards().shard_de(usuario_id)
+    try:
+        with usar_shard(shard):
+            if purga.total_estimado is None:
+                purga.total_estimado = sum(
+                    db.session.execute(select(db.func.count()).where(db.metadata.tables[nombre].c[columna] == usuario_id)).scalar()
+                    for nombre, columna in TABLAS_PURGA
+                )
+                db.session.commit()
+                print(f"Purga {purga_id} del usuario {usuario_id}: {purga.total_estimado} filas estimadas")
+            # Con un JWT aún válido se puede seguir escribiendo mientras se borra (en los shards no hay clave foránea
+            # que lo impida ni siquiera sin la fila del usuario): solo se da por completada cuando una comprobación
+            # posterior a borrar al usuario ya no encuentra filas
+            for pasada in range(MAX_PASADAS_PURGA):
+                for nombre, columna in TABLAS_PURGA:
+                    tabla = db.metadata.tables[nombre]
+                    while True:
+                        borradas = _borrar_lote_usuario(purga_id, tabla, columna, usuario_id, lote)
+                        if borradas < lote:
+                            break
+                        time.sleep(PAUSA_PURGA)
+                    if pasada == 0:
+                        print(f"Purga {purga_id}: {nombre} vaciada")
+                _borrar_puntos_importacion(usuario_id)
+                db.session.execute(Usuario.__table__.delete().where(Usuario.id == usuario_id))
+                db.session.commit()
+                restantes = _filas_restantes_purga(usuario_id)
+                if not restantes:
+                    break
+                print(f"Purga {purga_id}: {restantes} filas escritas durante la pasada {pasada + 1}, se repite")
+            else:
+                raise RuntimeError(f'Siguen apareciendo filas del usuario tras {MAX_PASADAS_PURGA} pasadas')
+        for tipo in METRICAS:
+            shutil.rmtree(_dir_archivo(tipo, usuario_id), ignore_errors=True)
+        db.session.execute(PurgaCuenta.__table__.update().where(PurgaCuenta.id == purga_id).values(
+            estado='completada', tabla_actual=None, fecha_actualizacion=datetime.utcnow()
+        ))
+        db.session.commit()
+        print(f"Purga {purga_id} completada: usuario {usuario_id} eliminado")
+    except Exception as e:
+        db.session.rollback()
+        db.session.execute(PurgaCuenta.__table__.update().where(PurgaCuenta.id == purga_id).values(
+            estado='fallida', error=str(e)[:255], fecha_actualizacion=datetime.utcnow()
+        ))
+        db.session.commit()
+        print(f"Error en la purga {purga_id} del usuario {usuario_id}: {str(e)}")
+    finally:
+        # Los DELETE masivos no pasan por los eventos del ORM que mantienen estas cachés
+        enrutador_shards().invalidar(usuario_id)
+        invalidar_cache_usuario(usuario_id)
+        motor_reglas.invalidar()
+        buffer_streaming().descartar_usuario(usuario_id)
+        _olvidar_idempotencia(usuario_id)
+
+def lanzar_purga(purga_id):
+    app = current_app._get_current_object()
+
+    def tarea():
+        with app.app_context():
+            if reclamar_purga(purga_id, str(uuid.uuid4())):
+                ejecutar_purga(purga_id)
+
+    threading.Thread(target=tarea, name=f'purga-{purga_id}', daemon=True).start()
+
+@api.route('/api/cuenta', methods=['DELETE'])
+@limitar('confirmar_eliminacion')
+@jwt_required()
+def eliminar_cuenta():
+    usuario_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    usuario = db.session.get(Usuario, usuario_id)
+    if not usuario:
+        return jsonify({"msg": "Usuario no encontrado"}), 404
+    if not usuario.check_password(data.get('password') or ''):
+        print(f"Contraseña incorrecta al eliminar la cuenta, usuario_id: {usuario_id}")
+        return jsonify({"msg": "Contraseña incorrecta"}), 401
+    try:
+        purga = PurgaCuenta.query.filter(
+            PurgaCuenta.usuario_id == usuario_id, PurgaCuenta.estado.in_(('pendiente', 'en_curso'))
+        ).first()
+        if purga is None:
+            purga = PurgaCuenta(usuario_id=usuario_id)
+            db.session.add(purga)
+            # Sin tokens FCM el usuario deja de recibir avisos desde ya
+            FcmToken.query.filter_by(usuario_id=usuario_id).delete(synchronize_session=False)
+            db.session.commit()
+            lanzar_purga(purga.id)
+        print(f"Purga de cuenta {purga.id} solicitada para usuario_id: {usuario_id}")
+        return jsonify({"msg": "Eliminación de la cuenta en curso", "purga": _purga_a_dict(purga)}), 202
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al solicitar la eliminación de la cuenta: {str(e)}")
+        return jsonify({"msg": f"Error al eliminar la cuenta: {str(e)}"}), 500
+
+@api.route('/api/cuenta/purga', methods=['GET'])
+@jwt_required()
+def estado_purga_cuenta():
+    usuario_id = int(get_jwt_identity())
+    purga = PurgaCuenta.query.filter_by(usuario_id=usuario_id).order_by(PurgaCuenta.id.desc()).first()
+    if not purga:
+        return jsonify({"msg": "No hay eliminación de cuenta solicitada"}), 404
+    return jsonify(_purga_a_dict(purga)), 200
+
+def reanudar_purgas(propietario, lote=LOTE_PURGA, reintentar_fallidas=False):
+    # reclamar_purga decide: las "en_curso" con latido reciente siguen siendo de su hilo y no se tocan
+    estados = ['pendiente', 'en_curso'] + (['fallida'] if reintentar_fallidas else [])
+    ids = [i for (i,) in db.session.query(PurgaCuenta.id).filter(PurgaCuenta.estado.in_(estados)).order_by(PurgaCuenta.id)]
+    db.session.commit()
+    ejecutadas = 0
+    for purga_id in ids:
+        if reclamar_purga(purga_id, propietario, reintentar_fallidas):
+            ejecutar_purga(purga_id, lote)
+            ejecutadas += 1
+    return ejecutadas, len(ids)
+
+def bucle_purgas(app, detener):
+    propietario = str(uuid.uuid4())
+    while not detener.wait(INTERVALO_REANUDAR_PURGAS):
+        with app.app_context():
+            try:
+                ejecutadas, _ = reanudar_purgas(propietario)
+                if ejecutadas:
+                    print(f"Purgas reanudadas: {ejecutadas}")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error al reanudar purgas de cuentas: {str(e)}")
+
+@api.cli.command('purgar-cuentas')
+@click.option('--lote', default=LOTE_PURGA, show_default=True, help='Filas borradas por transacción')
+@click.option('--reintentar-fallidas', is_flag=True)
+def purgar_cuentas(lote, reintentar_fallidas):
+    ejecutadas, total = reanudar_purgas(str(uuid.uuid4()), lote, reintentar_fallidas)
+    print(f"Purgas ejecutadas: {ejecutadas} de {total} pendientes")
+
+# ELIMINACIÓN POR LOTES
+# Una sola solicitud para muchos registros: una notificación, un push y una comprobación de contraseña
+MODELOS_ELIMINACION = {
+    'glucosa': Glucosa,
+    'presion_arterial': PresionArterial,
+    'oxigenacion': Oxigenacion,
+    'frecuencia_cardiaca': FrecuenciaCardiaca,
+    'medicamento': Medicamento,
+}
+MAX_REGISTROS_ELIMINACION = 1000
+LOTE_ELIMINACION = 500
+
+@api.route('/api/eliminaciones', methods=['POST'])
+@jwt_required()
+def solicitar_eliminacion_lote():
+    usuario_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    registros = data.get('registros')
+    if not isinstance(registros, list) or not registros:
+        return jsonify({"msg": "registros debe ser una lista no vacía"}), 400
+    if len(registros) > MAX_REGISTROS_ELIMINACION:
+        return jsonify({"msg": f"Máximo {MAX_REGISTROS_ELIMINACION} registros por solicitud"}), 400
+
+    por_tipo = {}
+    for indice, registro in enumerate(registros):
+        tipo = registro.get('tipo') if isinstance(registro, dict) else None
+        registro_id = registro.get('id') if isinstance(registro, dict) else None
+        if tipo not in MODELOS_ELIMINACION or not isinstance(registro_id, int) or isinstance(registro_id, bool):
+            return jsonify({"msg": "Cada registro necesita un tipo válido y un id entero", "indice": indice}), 400
+        por_tipo.setdefault(tipo, set()).add(registro_id)
+
+    # Una consulta por tipo y lote; los registros de otros usuarios cuentan como no encontrados
+    no_encontrados = {}
+    for tipo, ids in por_tipo.items():
+        modelo = MODELOS_ELIMINACION[tipo]
+        ids = sorted(ids)
+        propios = set()
+        for inicio in range(0, len(ids), LOTE_ELIMINACION):
+            propios.update(i for (i,) in db.session.query(modelo.id).filter(
+                modelo.id.in_(ids[inicio:inicio + LOTE_ELIMINACION]), modelo.usuario_id == usuario_id
+            ))
+        faltan = [i for i in ids if i not in propios]
+        if faltan:
+            no_encontrados[tipo] = faltan
+    if no_encontrados:
+        print(f"Registros no encontrados en eliminación por lotes, usuario_id: {usuario_id}: {no_encontrados}")
+        return jsonify({"msg": "Registros no encontrados", "no_encontrados": no_encontrados}), 404
+
+    total = sum(len(ids) for ids in por_tipo.values())
+    detalle = ', '.join(f'{tipo}: {len(ids)}' for tipo, ids in por_tipo.items())
+    delete_request_id = str(uuid.uuid4())
+    mensaje = f'Confirma la eliminación de {total} registros ({detalle})'
+    try:
+        db.session.add(Notificacion(
+            usuario_id=usuario_id,
+            mensaje=mensaje,
+            fecha=datetime.utcnow().date(),
+            hora=datetime.utcnow().time(),
+            delete_request_id=delete_request_id
+        ))
+        db.session.execute(insert(ElementoEliminacion), [
+            {"delete_request_id": delete_request_id, "usuario_id": usuario_id, "tipo": tipo, "registro_id": registro_id}
+            for tipo, ids in por_tipo.items() for registro_id in ids
+        ])
+        db.session.commit()
+        print(f"Notificación creada con delete_request_id: {delete_request_id}, mensaje: {mensaje}")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al crear la solicitud de eliminación por lotes: {str(e)}")
+        return jsonify({"msg": f"Error al crear notificación: {str(e)}"}), 500
+
+    if enviar_notificacion_fcm(usuario_id, 'WHS Medicine - Confirmar Eliminación', mensaje, delete_request_id):
+        return jsonify({
+            "msg": "Solicitud de eliminación enviada. Confirma desde la notificación.",
+            "delete_request_id": delete_request_id,
+            "registros": total,
+        }), 200
+    print(f"Error al enviar notificación FCM para usuario_id: {usuario_id}")
+    return jsonify({"msg": "Error al enviar notificación"}), 500
+
+def confirmar_eliminacion_lote(usuario_id, notificacion, elementos):
+    # La contraseña ya se comprobó en confirm_delete; todos los DELETE van en una sola transacción
+    por_tipo = {}
+    for tipo, registro_id in elementos:
+        por_tipo.setdefault(tipo, []).append(registro_id)
+    eliminados = 0
+    try:
+        for tipo, ids in por_tipo.items():
+            modelo = MODELOS_ELIMINACION[tipo]
+            for inicio in range(0, len(ids), LOTE_ELIMINACION):
+                parte = ids[inicio:inicio + LOTE_ELIMINACION]
+                eliminados += modelo.query.filter(
+                    modelo.id.in_(parte), modelo.usuario_id == usuario_id
+                ).delete(synchronize_session=False)
+                # DELETE masivo sin eventos del ORM: las bajas de sync se registran a mano
+                registrar_cambios(usuario_id, modelo.__tablename__, parte, 'd')
+        ElementoEliminacion.query.filter_by(
+            delete_request_id=notificacion.delete_request_id
+        ).delete(synchronize_session=False)
+        db.session.delete(notificacion)
+        db.session.add(Notificacion(
+            usuario_id=usuario_id,
+            mensaje=f'{eliminados} registros eliminados correctamente',
+            fecha=datetime.utcnow().date(),
+            hora=datetime.utcnow().time(),
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error en la eliminación por lotes delete_request_id: {notificacion.delete_request_id}: {str(e)}")
+        return jsonify({"msg": f"Error al eliminar registros: {str(e)}"}), 500
+
+    invalidar_cache_usuario(usuario_id)
+    print(f"Eliminación por lotes completada para usuario_id: {usuario_id}, registros: {eliminados}")
+    enviar_notificacion_fcm(
+        usuario_id,
+        'WHS Medicine - Eliminación Exitosa',
+        f'{eliminados} registros eliminados correctamente',
+        None
+    )
+    return jsonify({"msg": "Registros eliminados", "eliminados": eliminados}), 200
+
+# INGESTA EN STREAMING (frecuencia cardiaca y oxigenación)
+# Los wearables envían muestras cada pocos segundos: se acumulan en memoria y se escriben en micro-lotes
+# (una transacción por lote) en vez de un commit por muestra
+TIPOS_STREAMING = ('frecuencia_cardiaca', 'oxigenacion')
+RANGOS_LECTURA = {
+    'glucosa': {'valor': (0, 999.99)},
+    'presion_arterial': {'sistolica': (0, None), 'diastolica': (0, None)},
+    'oxigenacion': {'valor': (0, 100)},
+    'frecuencia_cardiaca': {'valor': (0, 300)},
+}
+TAMANO_LOTE_STREAMING = 500
+INTERVALO_STREAMING = 2.0
+MAX_PENDIENTES_STREAMING = 50000
+MAX_MUESTRAS_POR_PETICION = 1000
+MUESTRAS_RECIENTES_USUARIO = 32
+MAX_USUARIOS_BUFFER = 20000
+
+def validar_lectura(tipo, data):
+    # Mismas reglas que crear_registro; devuelve (lectura, None) o (None, mensaje de error)
+    try:
+        fecha = datetime.strptime(data.get('fecha'), '%Y-%m-%d').date()
+        hora = datetime.strptime(data.get('hora'), '%H:%M:%S').time()
+    except (ValueError, TypeError):
+        return None, "Formato de fecha o hora inválido"
+    lectura = {"fecha": fecha, "hora": hora}
+    for campo, (minimo, maximo) in RANGOS_LECTURA[tipo].items():
+        nombre = NOMBRES_METRICAS[tipo].lower() if campo == 'valor' else campo
+        try:
+            valor = float(data.get(campo)) if tipo == 'glucosa' else int(data.get(campo))
+        except (ValueError, TypeError):
+            return None, f"Valor de {nombre} inválido"
+        if maximo is None and valor < minimo:
+            return None, f"El valor de {nombre} debe ser positivo"
+        if maximo is not None and not minimo <= valor <= maximo:
+            return None, f"El valor de {nombre} debe estar entre {minimo} y {maximo}"
+        lectura[campo] = valor
+    return lectura, None
+
+def _usuarios_vigentes(usuario_ids):
+    # Usuarios que existen y no tienen una eliminación de cuenta solicitada; IN por tramos
+    ids = sorted(usuario_ids)
+    vigentes = set()
+    for inicio in range(0, len(ids), LOTE_USUARIOS_POBLACION):
+        vigentes.update(i for (i,) in db.session.query(Usuario.id).filter(
+            Usuario.id.in_(ids[inicio:inicio + LOTE_USUARIOS_POBLACION]),
+            ~Usuario.id.in_(select(PurgaCuenta.usuario_id)),
+        ))
+    db.session.commit()
+    return vigentes
+
+class BufferEscritura:
+    # WAL por proceso (<ruta_wal>.<pid>-<id>) con un cerrojo fcntl tomado mientras el proceso vive: cada worker
+    # solo vuelca lo suyo y, al arrancar, adopta los WAL cuyo cerrojo ya no tiene dueño (procesos caídos).
+    # Al volcar, el WAL activo pasa a "<gen>.volcando" y cada bloque se escribe en su "<gen>.<i>.bloque", que se borra
+    # al confirmarse: tras una caída solo se repiten los bloques sin confirmar. Entrega al menos una vez.
+    def __init__(self, app, tamano_lote, intervalo, ruta_wal=None):
+        self.app = app
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self.ruta_wal = ruta_wal
+        self._lock = threading.Lock()
+        self._lock_volcado = threading.Lock()
+        self._pendientes = []  # (tipo, fila)
+        self._recientes = OrderedDict()  # (usuario_id, tipo) -> deque con las últimas muestras
+        self._aviso = threading.Event()
+        self._pid = None
+        self._wal = None
+        self._base_wal = None
+        self._cerrojo = None
+        self._generacion = 0
+
+    def _arrancar(self):
+        # El hilo de volcado se crea en el primer uso de cada proceso (los hilos no sobreviven a un fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pendientes = []
+            if self.ruta_wal:
+                import fcntl
+                self._base_wal = f'{self.ruta_wal}.{os.getpid()}-{uuid.uuid4().hex[:8]}'
+                self._cerrojo = open(self._base_wal + '.lock', 'w')
+                fcntl.flock(self._cerrojo, fcntl.LOCK_EX)
+                self._wal = open(self._base_wal, 'a', encoding='utf-8')
+                self._generacion = 0
+                self._adoptar_huerfanos()
+            self._pid = os.getpid()
+            threading.Thread(target=self._bucle, name='buffer-streaming', daemon=True).start()
+            if self._pendientes:
+                print(f"Recuperadas {len(self._pendientes)} muestras de WAL de streaming huérfanos")
+                self._aviso.set()
+
+    def _adoptar_huerfanos(self):
+        import fcntl
+        for ruta_cerrojo in glob.glob(glob.escape(self.ruta_wal) + '.*.lock'):
+            base = ruta_cerrojo[:-len('.lock')]
+            if base == self._base_wal:
+                continue
+            try:
+                cerrojo = open(ruta_cerrojo, 'r')
+            except FileNotFoundError:
+                continue
+            with cerrojo:
+                try:
+                    fcntl.flock(cerrojo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # su proceso sigue vivo
+                if not os.path.exists(ruta_cerrojo):
+                    continue  # otro proceso lo adoptó mientras esperábamos
+                muestras, rutas = self._leer_restos(base)
+                # Primero al WAL propio y después se borran los del huérfano: una caída aquí repite, no pierde
+                self._escribir_wal(muestras)
+                self._pendientes.extend(muestras)
+                for ruta in rutas:
+                    os.remove(ruta)
+                os.remove(ruta_cerrojo)
+                print(f"WAL de streaming adoptado de {os.path.basename(base)}: {len(muestras)} muestras")
+
+    def _leer_restos(self, base):
+        rutas = glob.glob(glob.escape(base) + '.*.tmp')
+        volcando = {ruta[len(base) + 1:].split('.')[0]: ruta for ruta in glob.glob(glob.escape(base) + '.*.volcando')}
+        muestras = []
+        for ruta in sorted(glob.glob(glob.escape(base) + '.*.bloque')):
+            # Si el ".volcando" de la generación sigue ahí, sus bloques no llegaron a escribirse del todo
+            if ruta[len(base) + 1:].split('.')[0] not in volcando:
+                muestras.extend(self._leer_wal(ruta))
+            rutas.append(ruta)
+        for ruta in volcando.values():
+            muestras.extend(self._leer_wal(ruta))
+            rutas.append(ruta)
+        if os.path.exists(base):
+            muestras.extend(self._leer_wal(base))
+            rutas.append(base)
+        return muestras, rutas
+
+    def _leer_wal(self, ruta):
+        filas = []
+        if not os.path.exists(ruta):
+            return filas
+        with open(ruta, encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    tipo, fila = json.loads(linea)
+                except ValueError:
+                    continue  # última línea incompleta tras una caída
+                fila['fecha'] = date.fromisoformat(fila['fecha'])
+                fila['hora'] = datetime.strptime(fila['hora'], '%H:%M:%S').time()
+                filas.append((tipo, fila))
+        return filas
+
+    @staticmethod
+    def _lineas_wal(muestras):
+        return ''.join(json.dumps([tipo, fila], default=_valor_json) + '\n' for tipo, fila in muestras)
+
+    def _escribir_wal(self, muestras):
+        # Con self._lock tomado
+        if self._wal is not None and muestras:
+            self._wal.write(self._lineas_wal(muestras))
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+
+    def _escribir_bloque(self, ruta, muestras):
+        # Reemplazo atómico: el archivo siempre contiene exactamente las muestras aún sin confirmar
+        if not muestras:
+            os.remove(ruta)
+            return
+        with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self._lineas_wal(muestras))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta + '.tmp', ruta)
+
+    def agregar(self, usuario_id, tipo, lecturas):
+        self._arrancar()
+        filas = [dict(lectura, usuario_id=int(usuario_id)) for lectura in lecturas]
+        with self._lock:
+            if len(self._pendientes) + len(filas) > MAX_PENDIENTES_STREAMING:
+                return False
+            self._escribir_wal([(tipo, fila) for fila in filas])
+            self._pendientes.extend((tipo, fila) for fila in filas)
+            clave = (int(usuario_id), tipo)
+            recientes = self._recientes.pop(clave, None) or deque(maxlen=MUESTRAS_RECIENTES_USUARIO)
+            recientes.extend(filas)
+            self._recientes[clave] = recientes
+            while len(self._recientes) > MAX_USUARIOS_BUFFER:
+                self._recientes.popitem(last=False)
+            lleno = len(self._pendientes) >= self.tamano_lote
+        if lleno:
+            self._aviso.set()
+        return True
+
+    def descartar_usuario(self, usuario_id):
+        # Cuenta purgada: sus muestras salen de la cola y de las recientes de este proceso. Las que estén en otros
+        # procesos o en un WAL se descartan al volcar (_usuarios_vigentes)
+        usuario_id = int(usuario_id)
+        with self._lock:
+            self._pendientes = [muestra for muestra in self._pendientes if muestra[1]['usuario_id'] != usuario_id]
+            for clave in [clave for clave in self._recientes if clave[0] == usuario_id]:
+                del self._recientes[clave]
+
+    def _devolver(self, muestras):
+        # Vuelven al principio de la cola y al WAL activo
+        with self._lock:
+            self._escribir_wal(muestras)
+            self._pendientes[:0] = muestras
+
+    def ultima(self, usuario_id, tipo):
+        with self._lock:
+            recientes = self._recientes.get((int(usuario_id), tipo))
+            if not recientes:
+                return None
+            fila = max(recientes, key=lambda f: (f['fecha'], f['hora']))
+        return METRICAS[tipo][0](**fila)
+
+    def _bucle(self):
+        while True:
+            self._aviso.wait(self.intervalo)
+            self._aviso.clear()
+            try:
+                self.volcar()
+            except Exception as e:
+                print(f"Error al volcar el buffer de streaming: {str(e)}")
+
+    def volcar(self):
+        with self._lock_volcado:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, []
+                volcando = self._rotar_wal() if lote and self._wal is not None else None
+            if not lote:
+                return 0
+            with self.app.app_context():
+                # Cada bloque va entero a un shard: se agrupa por el shard de cada usuario
+                por_shard, retenidas, eliminadas = {}, [], 0
+                enrutador = enrutador_shards()
+                try:
+                    vigentes = _usuarios_vigentes({fila['usuario_id'] for _, fila in lote})
+                    for tipo, fila in lote:
+                        if fila['usuario_id'] not in vigentes:
+                            eliminadas += 1  # cuenta eliminada o en purga
+                            continue
+                        if enrutador.en_movimiento(fila['usuario_id']):
+                            retenidas.append((tipo, fila))  # se vuelcan cuando el usuario ya está en su nuevo shard
+                            continue
+                        por_shard.setdefault(enrutador.shard_de(fila['usuario_id']), []).append((tipo, fila))
+                except Exception:
+                    db.session.rollback()
+                    self._devolver(lote)
+                    if volcando:
+                        os.remove(volcando)
+                    raise
+                if eliminadas:
+                    print(f"Muestras de streaming de cuentas eliminadas descartadas: {eliminadas}")
+                bloques = [
+                    (shard, filas[inicio:inicio + self.tamano_lote])
+                    for shard, filas in por_shard.items()
+                    for inicio in range(0, len(filas), self.tamano_lote)
+                ]
+                rutas = [None] * len(bloques)
+                if volcando:
+                    for indice, (_, muestras) in enumerate(bloques):
+                        rutas[indice] = f'{self._base_wal}.{self._generacion}.{indice}.bloque'
+                        self._escribir_bloque(rutas[indice], muestras)
+                if retenidas:
+                    self._devolver(retenidas)
+                if volcando:
+                    os.remove(volcando)
+
+                confirmadas = []
+                for indice, ((shard, muestras), ruta) in enumerate(zip(bloques, rutas)):
+                    restantes, error = self._volcar_bloque(shard, muestras, ruta, confirmadas)
+                    if error is not None:
+                        # Error transitorio (BD no disponible, usuario moviéndose): lo que falta se reintenta
+                        self._devolver(restantes + [m for _, resto in bloques[indice + 1:] for m in resto])
+                        for ruta_pendiente in rutas[indice:]:
+                            if ruta_pendiente and os.path.exists(ruta_pendiente):
+                                os.remove(ruta_pendiente)
+                        self._evaluar_alertas(confirmadas)
+                        raise error
+                self._evaluar_alertas(confirmadas)
+            print(f"Buffer de streaming volcado: {len(confirmadas)} muestras")
+            return len(confirmadas)
+
+    def _volcar_bloque(self, shard, muestras, ruta, confirmadas):
+        # Un bloque que falla por sus datos se parte en mitades hasta aislar las muestras que no entran, que van
+        # a "<ruta_wal>.descartadas" en vez de bloquear la cola. Devuelve (restantes, error transitorio o None)
+        trozos = [muestras]
+        while trozos:
+            trozo = trozos.pop(0)
+            try:
+                with usar_shard(shard):
+                    conexion = db.session.connection(bind_arguments={'bind': engine_shard(shard)})
+                    bloquear_secuencias_sync(conexion, (fila['usuario_id'] for _, fila in trozo))
+                    por_tipo = {}
+                    for tipo, fila in trozo:
+                        por_tipo.setdefault(tipo, []).append(fila)
+                    for tipo, filas in por_tipo.items():
+                        insertar_con_cambios(conexion, METRICAS[tipo][0], filas)
+                    db.session.commit()
+                confirmadas.extend(trozo)
+            except (OperationalError, UsuarioEnMovimiento) as e:
+                db.session.rollback()
+                return trozo + [m for t in trozos for m in t], e
+            except Exception as e:
+                db.session.rollback()
+                if len(trozo) > 1:
+                    trozos[:0] = [trozo[:len(trozo) // 2], trozo[len(trozo) // 2:]]
+                    continue
+                self._descartar(trozo[0], e)
+            if ruta:
+                self._escribir_bloque(ruta, [m for t in trozos for m in t])
+        return [], None
+
+    def _descartar(self, muestra, error):
+        tipo, fila = muestra
+        print(f"Muestra de streaming descartada ({tipo}, usuario_id {fila['usuario_id']}): {str(error)}")
+        if self.ruta_wal:
+            with open(self.ruta_wal + '.descartadas', 'a', encoding='utf-8') as f:
+                f.write(json.dumps([tipo, fila, str(error)], default=_valor_json) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _rotar_wal(self):
+        # Con self._lock tomado: el WAL activo pasa a "<gen>.volcando" y se abre uno nuevo
+        self._wal.close()
+        self._generacion += 1
+        volcando = f'{self._base_wal}.{self._generacion}.volcando'
+        os.replace(self._base_wal, volcando)
+        self._wal = open(self._base_wal, 'a', encoding='utf-8')
+        return volcando
+
+    def cerrar(self):
+        # Al salir: si todo quedó volcado se borran el WAL y el cerrojo; si no, otro proceso los adoptará
+        try:
+            self.volcar()
+        except Exception as e:
+            print(f"Error al volcar el buffer de streaming al salir: {str(e)}")
+        with self._lock:
+            if self._wal is None or self._pid != os.getpid():
+                return
+            self._wal.close()
+            self._wal = None
+            if not self._pendientes:
+                os.remove(self._base_wal)
+                os.remove(self._base_wal + '.lock')
+            self._cerrojo.close()
+
+    def _evaluar_alertas(self, lote):
+        agrupadas = {}
+        for tipo, fila in lote:
+            agrupadas.setdefault((fila['usuario_id'], tipo), []).append(fila)
+        for (usuario_id, tipo), filas in agrupadas.items():
+            try:
+                ultima = max(filas, key=lambda f: (f['fecha'], f['hora']))
+                with usar_shard_de(usuario_id):
+                    emitir_alertas(usuario_id, tipo, motor_reglas.evaluar(usuario_id, tipo, filas), ultima['fecha'], ultima['hora'])
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error al evaluar reglas de alerta en streaming: {str(e)}")
+
+def buffer_streaming():
+    return current_app.extensions['buffer_streaming']
+
+@api.route('/api/registros_salud/stream', methods=['POST'])
+@limitar('streaming')
+@jwt_required()
+def crear_registros_stream():
+    usuario_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    tipo = data.get('tipo')
+    muestras = data.get('muestras')
+    if tipo not in TIPOS_STREAMING:
+        return jsonify({"msg": "tipo debe ser frecuencia_cardiaca u oxigenacion"}), 400
+    if not isinstance(muestras, list) or not muestras:
+        return jsonify({"msg": "muestras debe ser una lista no vacía"}), 400
+    if len(muestras) > MAX_MUESTRAS_POR_PETICION:
+        return jsonify({"msg": f"Máximo {MAX_MUESTRAS_POR_PETICION} muestras por petición"}), 400
+
+    lecturas = []
+    for indice, muestra in enumerate(muestras):
+        lectura, error = validar_lectura(tipo, muestra if isinstance(muestra, dict) else {})
+        if error:
+            return jsonify({"msg": error, "indice": indice}), 400
+        lecturas.append(lectura)
+
+    if not buffer_streaming().agregar(usuario_id, tipo, lecturas):
+        print(f"Buffer de streaming lleno, muestras rechazadas para usuario_id: {usuario_id}")
+        respuesta = jsonify({"msg": "Servidor ocupado, reintenta en unos segundos"})
+        respuesta.headers['Retry-After'] = str(int(INTERVALO_STREAMING) + 1)
+        return respuesta, 503
+    return jsonify({"msg": "Muestras aceptadas", "aceptadas": len(lecturas)}), 202
+
+@api.cli.command('volcar-streaming')
+def volcar_streaming():
+    # Adopta los WAL de procesos caídos que ningún worker ha recogido todavía y los vuelca
+    buffer = buffer_streaming()
+    buffer._arrancar()
+    print(f"Muestras volcadas: {buffer.volcar()}")
+
+# IMPORTACIÓN MASIVA
+LINEAS_BLOQUE_IMPORTACION = 20000
+FILAS_INSERT_IMPORTACION = 5000
+MAX_ERRORES_MOSTRADOS = 20
+TROZO_JSON_IMPORTACION = 1 << 20  # bytes leídos de cada vez de un array JSON
+MAX_ELEMENTO_JSON_IMPORTACION = 16 << 20
+BOM_UTF8 = b'\xef\xbb\xbf'
+
+def _formato_importacion(ruta, formato):
+    if formato:
+        return formato
+    nombre = ruta.lower()
+    if nombre.endswith('.json'):
+        # Un .json puede ser un array ("[{...}, ...]") o JSON por líneas: lo decide el primer carácter
+        with open(ruta, 'rb') as f:
+            inicio = f.read(64)
+        return 'json' if inicio[len(BOM_UTF8) if inicio.startswith(BOM_UTF8) else 0:].lstrip().startswith(b'[') else 'jsonl'
+    return 'jsonl' if nombre.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def _leer_bloque_importacion(f, lineas_max):
+    # Lee líneas completas en binario para conocer el offset exacto en bytes de cada una
+    bloque = []
+    while len(bloque) < lineas_max:
+        offset = f.tell()
+        linea = f.readline()
+        if not linea:
+            break
+        if linea.strip():
+            bloque.append((offset, linea))
+    return bloque, f.tell()
+
+def _leer_bloque_json(f, elementos_max):
+    # Arrays JSON sin cargarlos enteros: raw_decode localiza cada elemento, que se entrega como una línea más con su
+    # offset en bytes (al reanudar se salta la coma que lo precede). Se decodifica en latin-1 para que cada posición
+    # del texto sea la de su byte; el contenido en UTF-8 lo decodifica después cada proceso
+    decodificador = json.JSONDecoder()
+    base = f.tell()
+    datos = f.read(TROZO_JSON_IMPORTACION)
+    agotado = len(datos) == 0
+    texto = datos.decode('latin-1')
+    pos = len(BOM_UTF8) if base == 0 and datos.startswith(BOM_UTF8) else 0
+    bloque = []
+    while len(bloque) < elementos_max:
+        while pos < len(texto) and texto[pos] in ' \t\r\n[,':
+            pos += 1
+        if pos < len(texto) and texto[pos] == ']':
+            f.seek(0, os.SEEK_END)
+            return bloque, f.tell()
+        completo = pos < len(texto)
+        if completo:
+            try:
+                _, fin = decodificador.raw_decode(texto, pos)
+                # Un elemento que acaba justo al final de lo leído puede seguir en el siguiente trozo
+                completo = fin < len(texto) or agotado
+            except ValueError:
+                completo = False
+                if agotado or len(texto) - pos > MAX_ELEMENTO_JSON_IMPORTACION:
+                    raise ValueError(f'JSON mal formado cerca del byte {base + pos}')
+        if completo:
+            bloque.append((base + pos, datos[pos:fin]))
+            pos = fin
+            continue
+        if agotado:
+            break
+        mas = f.read(TROZO_JSON_IMPORTACION)
+        agotado = len(mas) == 0
+        datos, base, pos = datos[pos:] + mas, base + pos, 0
+        texto = datos.decode('latin-1')
+    f.seek(base + pos)
+    return bloque, base + pos
+
+def _procesar_bloque_importacion(formato, cabecera, tipo_defecto, bloque):
+    # Se ejecuta en los procesos del pool: parsea y valida con las mismas reglas que crear_registro
+    lecturas = {tipo: [] for tipo in METRICAS}
+    errores = []
+    for offset, linea in bloque:
+        try:
+            texto = linea.decode('utf-8')
+            if formato == 'csv':
+                fila = dict(zip(cabecera, next(csv.reader([texto]))))
+            else:
+                fila = json.loads(texto)
+            if not isinstance(fila, dict):
+                raise ValueError
+        except (ValueError, csv.Error):
+            errores.append((offset, "Línea ilegible"))
+            continue
+        tipo = fila.get('tipo') or tipo_defecto
+        if tipo not in METRICAS:
+            errores.append((offset, "Tipo de lectura inválido"))
+            continue
+        if fila.get('fecha_hora') and not fila.get('fecha'):
+            # Exportaciones con un único campo "AAAA-MM-DD HH:MM:SS" o ISO 8601
+            fecha, _, hora = str(fila['fecha_hora']).replace('T', ' ').partition(' ')
+            fila['fecha'], fila['hora'] = fecha, hora[:8]
+        lectura, error = validar_lectura(tipo, fila)
+        if error:
+            errores.append((offset, error))
+            continue
+        lecturas[tipo].append(lectura)
+    return lecturas, errores
+
+def _guardar_bloque_importacion(usuario_id, trabajo, offset, lecturas):
+    # INSERT masivo sin eventos del ORM: no se crean notificaciones ni se evalúan alertas por fila
+    while True:
+        try:
+            return _insertar_bloque_importacion(usuario_id, trabajo, offset, lecturas)
+        except UsuarioEnMovimiento:
+            # El bloque se revirtió entero; se repite cuando el usuario ya está en su nuevo shard
+            print(f"Usuario {usuario_id} moviéndose de shard, reintento en {REINTENTO_MOVIMIENTO_SHARD}s")
+            time.sleep(REINTENTO_MOVIMIENTO_SHARD)
+
+def _leer_punto_importacion(usuario_id, trabajo):
+    tabla = PuntoControlTrabajo.__table__
+    with engine_shard(enrutador_shards().shard_de(usuario_id)).connect() as conexion:
+        return conexion.execute(select(tabla.c.ultimo_id).where(tabla.c.trabajo == trabajo)).scalar()
+
+def _insertar_bloque_importacion(usuario_id, trabajo, offset, lecturas):
+    insertadas = 0
+    shard = enrutador_shards().shard_de(usuario_id)
+    try:
+        with usar_shard(shard):
+            # Misma conexión (y transacción) que usa la sesión para las tablas del shard
+            conexion = db.session.connection(bind_arguments={'bind': engine_shard(shard)})
+            # Con el contador de sync del usuario bloqueado ninguna otra escritura suya se confirma entre la lectura
+            # del id máximo y el INSERT, así que no se atribuyen a la importación filas que no son suyas
+            bloquear_secuencias_sync(conexion, [usuario_id])
+            for tipo, filas in lecturas.items():
+                modelo = METRICAS[tipo][0]
+                for inicio in range(0, len(filas), FILAS_INSERT_IMPORTACION):
+                    parte = [dict(f, usuario_id=usuario_id) for f in filas[inicio:inicio + FILAS_INSERT_IMPORTACION]]
+                    insertar_con_cambios(conexion, modelo, parte)
+                    insertadas += len(parte)
+            # El punto de control vive en el shard del usuario: lecturas y punto de control se confirman juntos
+            # y al reanudar no se duplica el bloque
+            tabla = PuntoControlTrabajo.__table__
+            valores = {"ultimo_id": offset, "fecha_actualizacion": datetime.utcnow()}
+            if conexion.execute(tabla.update().where(tabla.c.trabajo == trabajo).values(**valores)).rowcount == 0:
+                conexion.execute(insert(tabla).values(trabajo=trabajo, **valores))
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.expunge_all()
+    return insertadas
+
+@api.cli.command('importar-lecturas')
+@click.argument('usuario_id', type=int)
+@click.argument('ruta', type=click.Path(exists=True, dir_okay=False))
+@click.option('--formato', type=click.Choice(['csv', 'jsonl', 'json']), default=None, help='Por defecto según la extensión')
+@click.option('--tipo', type=click.Choice(list(METRICAS)), default=None, help='Tipo de las filas sin columna "tipo"')
+@click.option('--lote', default=LINEAS_BLOQUE_IMPORTACION, show_default=True, help='Líneas por bloque enviado a cada proceso')
+@click.option('--procesos', default=os.cpu_count() or 1, show_default=True)
+@click.option('--desde-offset', type=int, default=None, help='Byte desde el que continuar; por defecto el último punto de control')
+@click.option('--reiniciar', is_flag=True, help='Ignora el punto de control y empieza desde el principio')
+def importar_lecturas(usuario_id, ruta, formato, tipo, lote, procesos, desde_offset, reiniciar):
+    if not db.session.get(Usuario, usuario_id):
+        print(f"Error: no existe el usuario {usuario_id}")
+        return
+    formato = _formato_importacion(ruta, formato)
+    # El punto de control depende del archivo: otra exportación no reanuda desde un offset ajeno
+    huella = hashlib.sha256(f'{os.path.realpath(ruta)}:{os.path.getsize(ruta)}'.encode()).hexdigest()[:16]
+    trabajo = f'importar:{usuario_id}:{huella}'
+
+    with open(ruta, 'rb') as f:
+        cabecera = None
+        if formato == 'csv':
+            cabecera = [c.strip().lower() for c in next(csv.reader([f.readline().decode('utf-8-sig')]), [])]
+            if 'fecha' not in cabecera and 'fecha_hora' not in cabecera:
+                print("Error: la cabecera del CSV debe incluir fecha o fecha_hora")
+                return
+        punto = None if reiniciar else _leer_punto_importacion(usuario_id, trabajo)
+        if desde_offset is not None:
+            f.seek(max(desde_offset, f.tell()))
+        elif punto:
+            f.seek(punto)
+        print(f"Importando {ruta} ({formato}) para usuario_id: {usuario_id} desde el byte {f.tell()}")
+
+        insertadas = rechazadas = 0
+        interrumpida = False
+        leer_bloque = _leer_bloque_json if formato == 'json' else _leer_bloque_importacion
+        pendientes = deque()
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            while True:
+                # Solo hay en memoria los bloques en vuelo: el consumo no depende del tamaño del archivo
+                try:
+                    bloque, offset = leer_bloque(f, lote)
+                except ValueError as e:
+                    # Se guarda lo ya leído; el punto de control queda antes del error
+                    print(f"Error: {str(e)}")
+                    bloque, interrumpida = [], True
+                if bloque:
+                    pendientes.append((offset, pool.submit(_procesar_bloque_importacion, formato, cabecera, tipo, bloque)))
+                # Los bloques se guardan en orden para que el offset del punto de control sea consistente
+                while pendientes and (not bloque or len(pendientes) >= procesos * 2):
+                    bloque_offset, futuro = pendientes.popleft()
+                    lecturas, errores = futuro.result()
+                    for error_offset, error in errores:
+                        if rechazadas < MAX_ERRORES_MOSTRADOS:
+                            print(f"Fila rechazada en el byte {error_offset}: {error}")
+                        rechazadas += 1
+                    insertadas += _guardar_bloque_importacion(usuario_id, trabajo, bloque_offset, lecturas)
+                    print(f"{insertadas} lecturas importadas, {rechazadas} rechazadas (byte {bloque_offset})")
+                if not bloque:
+                    break
+
+    invalidar_cache_usuario(usuario_id)
+    estado = 'interrumpida' if interrumpida else 'completada'
+    print(f"Importación {estado} para usuario_id: {usuario_id}: {insertadas} lecturas, {rechazadas} filas rechazadas")
+
+app = create_app()
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,42 @@
+# Mide el tiempo de arranque en frío de la app: python bench_arranque.py [repeticiones]
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+def medir(codigo, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        subprocess.run([sys.executable, '-c', codigo], cwd=DIRECTORIO, check=True, stdout=subprocess.DEVNULL)
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+def mostrar(nombre, tiempos):
+    print(f"{nombre:<28} mediana {statistics.median(tiempos) * 1000:7.1f} ms   min {min(tiempos) * 1000:7.1f} ms")
+
+def modulos_mas_lentos(limite=10):
+    # -X importtime escribe en stderr el tiempo acumulado de cada import
+    salida = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=DIRECTORIO, capture_output=True, text=True
+    ).stderr
+    filas = []
+    for linea in salida.splitlines():
+        if not linea.startswith('import time:') or 'cumulative' in linea:
+            continue
+        _, acumulado, modulo = linea.split(':', 1)[1].split('|')
+        filas.append((int(acumulado), modulo.strip()))
+    for acumulado, modulo in sorted(filas, reverse=True)[:limite]:
+        print(f"  {acumulado / 1000:8.1f} ms  {modulo}")
+
+if __name__ == '__main__':
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    mostrar('intérprete vacío', medir('pass', repeticiones))
+    mostrar('import app', medir('import app', repeticiones))
+    mostrar('import app + numpy', medir('import app, numpy', repeticiones))
+    print('Imports más costosos (acumulado):')
+    modulos_mas_lentos()
@@ -0,0 +1,32 @@
+# Configuración de producción: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('MEDNOTIFY_BIND', '0.0.0.0:5000')
+
+# Un proceso por núcleo (x2 + 1) con hilos para las esperas de MySQL y FCM
+workers = int(os.environ.get('MEDNOTIFY_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('MEDNOTIFY_THREADS', 4))
+
+# La app se importa una sola vez en el maestro y los workers la heredan por copy-on-write
+preload_app = True
+
+# Reciclado de workers para acotar fugas de memoria, con jitter para que no reinicien todos a la vez
+max_requests = int(os.environ.get('MEDNOTIFY_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('MEDNOTIFY_MAX_REQUESTS_JITTER', 200))
+
+# Drenado ordenado: tras SIGTERM cada worker termina las peticiones en curso antes de salir
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    from app import app, reiniciar_tras_fork
+    reiniciar_tras_fork(app)
+    server.log.info(f"Worker {worker.pid}: conexiones de BD y Firebase reinicializadas")
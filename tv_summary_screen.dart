@@ -18,6 +18,7 @@ class _TVSummaryScreenState extends State<TVSummaryScreen> {
   bool _isLoading = true;
   String? _errorMessage;
   final Map<DateTime, List<String>> _daysWithData = {};
+  Map<String, dynamic>? _latestVitals;
 
   @override
   void initState() {
@@ -25,6 +26,69 @@ class _TVSummaryScreenState extends State<TVSummaryScreen> {
     _selectedDay = _focusedDay;
     _fetchDailyData(_selectedDay!);
     _fetchDaysWithData();
+    _fetchLatestVitals();
+  }
+
+  // El token de dispositivo solo permite leer el resumen de la TV; se guarda hasta que caduca
+  Future<Map<String, dynamic>?> _getDeviceToken(SharedPreferences prefs, String jwt) async {
+    final stored = prefs.getString('tv_device_token');
+    final expires = DateTime.tryParse(prefs.getString('tv_device_token_expira') ?? '');
+    final userId = prefs.getInt('tv_device_usuario_id');
+    if (stored != null && userId != null && expires != null &&
+        expires.isAfter(DateTime.now().toUtc().add(const Duration(minutes: 1)))) {
+      return {'token': stored, 'usuario_id': userId};
+    }
+
+    final response = await http.post(
+      Uri.parse('https://ec1bff1533be.ngrok-free.app/api/dispositivos/token'),
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer $jwt',
+        'ngrok-skip-browser-warning': 'true',
+      },
+      body: jsonEncode({'alcance': 'tv'}),
+    ).timeout(const Duration(seconds: 10));
+    if (response.statusCode != 200) {
+      print('Error al obtener token de dispositivo: ${response.body}');
+      return null;
+    }
+    final data = jsonDecode(response.body);
+    await prefs.setString('tv_device_token', data['token']);
+    await prefs.setString('tv_device_token_expira', '${data['expira']}Z');
+    await prefs.setInt('tv_device_usuario_id', data['usuario_id']);
+    return {'token': data['token'], 'usuario_id': data['usuario_id']};
+  }
+
+  Future<void> _fetchLatestVitals() async {
+    final prefs = await SharedPreferences.getInstance();
+    final token = prefs.getString('access_token');
+    if (token == null) return;
+
+    try {
+      final device = await _getDeviceToken(prefs, token);
+      if (device == null || !mounted) return;
+
+      // Authorization: Device <token> y no en la URL, para que no quede en logs ni en cachés compartidas
+      final response = await http.get(
+        Uri.parse('https://ec1bff1533be.ngrok-free.app/api/tv/salud/${device['usuario_id']}'),
+        headers: {
+          'Authorization': 'Device ${device['token']}',
+          'ngrok-skip-browser-warning': 'true',
+        },
+      ).timeout(const Duration(seconds: 10));
+
+      if (!mounted) return;
+
+      if (response.statusCode == 200) {
+        setState(() {
+          _latestVitals = jsonDecode(response.body);
+        });
+      } else if (response.statusCode == 401) {
+        await prefs.remove('tv_device_token');
+      }
+    } catch (e) {
+      print('Error fetching latest vitals: $e');
+    }
   }
 
   Future<void> _fetchDaysWithData() async {
@@ -208,6 +272,19 @@ class _TVSummaryScreenState extends State<TVSummaryScreen> {
               color: Colors.black87,
             ),
           ),
+          if (_latestVitals != null)
+            Padding(
+              padding: EdgeInsets.only(top: size.height * 0.01),
+              child: Text(
+                'Últimos: ${_latestVitals!['glucosa']} · ${_latestVitals!['presion_arterial']} · '
+                '${_latestVitals!['oxigenacion']} · ${_latestVitals!['frecuencia_cardiaca']}',
+                style: TextStyle(
+                  fontSize: fontSizeBase,
+                  fontFamily: 'Roboto',
+                  color: Colors.black54,
+                ),
+              ),
+            ),
           SizedBox(height: size.height * 0.015),
           Expanded(
             child: SingleChildScrollView(
@@ -0,0 +1,4 @@
+# Punto de entrada WSGI para gunicorn (ver gunicorn.conf.py)
+from app import app
+
+__all__ = ['app']